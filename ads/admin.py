@@ -1,5 +1,34 @@
 from django.contrib import admin
-from .models import Ad, ExchangeProposal
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
 
-admin.site.register(Ad)
-admin.site.register(ExchangeProposal)
\ No newline at end of file
+from .deletion import delete_ads, delete_user
+from .models import Ad, ArchivedProposal, ExchangeProposal
+
+
+@admin.register(Ad)
+class AdAdmin(admin.ModelAdmin):
+    """Удаление из админки идёт через ads/deletion.py: без загрузки всех предложений в память"""
+
+    def delete_model(self, request, obj):
+        delete_ads([obj.pk])
+
+    def delete_queryset(self, request, queryset):
+        delete_ads(list(queryset.values_list('pk', flat=True)))
+
+
+class FastDeleteUserAdmin(UserAdmin):
+    """Пользователь с объявлениями удаляется так же, как объявления: сначала скрытие, затем очистка"""
+
+    def delete_model(self, request, obj):
+        delete_user(obj)
+
+    def delete_queryset(self, request, queryset):
+        for user in queryset:
+            delete_user(user)
+
+
+admin.site.register(ExchangeProposal)
+admin.site.register(ArchivedProposal)
+admin.site.unregister(User)
+admin.site.register(User, FastDeleteUserAdmin)
@@ -0,0 +1,330 @@
+"""JSON API объявлений и предложений обмена.
+
+Списки повторяют фильтры HTML-страниц (``AdFilterMixin``,
+``ProposalFilterMixin``) и их keyset-пагинацию: курсоры соседних страниц
+приходят в полях ``next``/``previous``. Параметр ``fields`` выбирает поля
+ответа и превращается в ``.only()`` — ненужные колонки (например, длинное
+описание) не читаются из базы, а JOIN с авторами добавляется, только если
+запрошено имя автора. ``updated_since`` отдаёт объекты, изменённые после
+метки, в порядке (updated_at, id) — для инкрементальной синхронизации.
+
+Ответы — JSON без пробелов и \\u-экранирования, с ETag (хэш тела) и
+Last-Modified (самый поздний ``updated_at``): повторный запрос с
+If-None-Match или If-Modified-Since получает 304 без тела. ``compact=1``
+отдаёт список колонками — имена полей один раз, дальше массивы значений.
+Тела сжимаются gzip; brotli, если нужен, включается на обратном прокси.
+"""
+import hashlib
+import json
+from operator import attrgetter
+
+from django.core.exceptions import PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
+from django.utils.http import http_date
+from django.views import View
+from django.views.decorators.gzip import gzip_page
+
+from .archive import ProposalHistory
+from .forms import AdForm, ExchangeProposalForm
+from .models import Ad, ExchangeProposal
+from .pagination import InvalidCursor, KeysetPaginator
+from .routers import ReplicaReadMixin
+from .views import AdFilterMixin, ProposalFilterMixin
+
+
+class ApiError(Exception):
+    """Ошибка запроса, которая отдаётся клиенту как JSON с кодом ``status``"""
+
+    def __init__(self, status, message, **extra):
+        super().__init__(message)
+        self.status = status
+        self.data = {'error': message, **extra}
+
+
+def dumps(data):
+    """Компактная сериализация: без пробелов-разделителей, кириллица как есть"""
+    return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def json_response(request, data, status=200, last_modified=None):
+    """Ответ с ETag по телу и Last-Modified; на совпавший условный GET — 304"""
+    body = dumps(data)
+    response = None
+    if status == 200:
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        if request.method in ('GET', 'HEAD'):
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+    else:
+        response = HttpResponse(body, status=status, content_type='application/json')
+    # Ответ зависит от пользователя: хранить можно только в браузере и с проверкой по ETag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+class Field:
+    """Поле ответа: колонки для ``.only()`` и функция, достающая значение из объекта"""
+
+    def __init__(self, *columns, get=None):
+        self.columns = columns
+        self.get = get or attrgetter(columns[0].replace('__', '.'))
+
+
+def _thumbnail(ad):
+    if not ad.image_url:
+        return None
+    return reverse('ad_image', kwargs={'pk': ad.pk, 'size': 'card'}) + f'?v={ad.image_version}'
+
+
+@method_decorator(gzip_page, name='dispatch')
+class ApiView(View):
+    """Основа представлений API: ошибки в JSON, выбор полей и проекция запроса"""
+    fields = {}
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except ApiError as error:
+            return json_response(request, error.data, status=error.status)
+        except Http404 as error:
+            return json_response(request, {'error': str(error) or 'Не найдено'}, status=404)
+        except PermissionDenied:
+            return json_response(request, {'error': 'Доступ запрещён'}, status=403)
+
+    def require_user(self):
+        """Пишущие методы доступны только после входа; вместо перенаправления — 401"""
+        if not self.request.user.is_authenticated:
+            raise ApiError(401, 'Требуется вход')
+        return self.request.user
+
+    def get_field_names(self):
+        """Поля из ``?fields=a,b`` в порядке запроса, по умолчанию все"""
+        value = self.request.GET.get('fields')
+        if not value:
+            return list(self.fields)
+        names = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+        unknown = [name for name in names if name not in self.fields]
+        if unknown or not names:
+            raise ApiError(400, 'Неизвестные поля', unknown=unknown, allowed=list(self.fields))
+        return names
+
+    def project(self, queryset, names, extra=()):
+        """Ограничивает запрос колонками выбранных полей; связи — только нужные"""
+        columns = {column for name in names for column in self.fields[name].columns} | set(extra)
+        related = {column.rsplit('__', 1)[0] for column in columns if '__' in column}
+        if related:
+            queryset = queryset.select_related(*sorted(related))
+        return queryset.only(*sorted(columns))
+
+    def serialize(self, obj, names):
+        return {name: self.fields[name].get(obj) for name in names}
+
+    def get_data(self):
+        """Тело запроса: JSON-объект или обычная форма"""
+        if self.request.content_type != 'application/json':
+            return self.request.POST
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise ApiError(400, 'Тело запроса — не JSON')
+        if not isinstance(data, dict):
+            raise ApiError(400, 'Ожидается JSON-объект')
+        return data
+
+    def get_object(self, queryset, pk, names):
+        obj = self.project(queryset.filter(pk=pk), names, extra=['updated_at']).first()
+        if obj is None:
+            raise Http404
+        return obj
+
+    def detail(self, queryset, pk):
+        names = self.get_field_names()
+        obj = self.get_object(queryset, pk, names)
+        return json_response(self.request, self.serialize(obj, names), last_modified=obj.updated_at)
+
+    def created(self, obj, url_name):
+        response = json_response(self.request, self.serialize(obj, list(self.fields)), status=201)
+        response['Location'] = reverse(url_name, kwargs={'pk': obj.pk})
+        return response
+
+
+class ApiListMixin:
+    """Keyset-страница списка: ``cursor``, ``limit``, ``updated_since`` и ``compact``"""
+    default_ordering = ('-created_at', '-id')
+    sync_ordering = ('updated_at', 'id')
+    page_size = 50
+    max_page_size = 200
+
+    @cached_property
+    def updated_since(self):
+        value = self.request.GET.get('updated_since')
+        if not value:
+            return None
+        # «+» часового пояса в строке запроса без кодирования превращается в пробел
+        try:
+            parsed = parse_datetime(value.replace(' ', '+'))
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ApiError(400, 'updated_since: ожидается дата и время ISO 8601')
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    @property
+    def keyset_ordering(self):
+        return self.sync_ordering if self.updated_since is not None else self.default_ordering
+
+    def get_keyset_ordering(self):
+        return self.keyset_ordering
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.GET.get('limit', self.page_size))
+        except ValueError:
+            raise ApiError(400, 'limit: ожидается число')
+        return min(max(limit, 1), self.max_page_size)
+
+    def filter_updated(self, queryset):
+        since = self.updated_since
+        return queryset if since is None else queryset.filter(updated_at__gt=since)
+
+    def paginate(self, queryset):
+        names = self.get_field_names()
+        ordering = self.get_keyset_ordering()
+        keys = [name.lstrip('-') for name in ordering if name.lstrip('-') != 'rank']
+        queryset = self.project(queryset, names, extra=keys + ['updated_at'])
+        paginator = KeysetPaginator(queryset, self.get_limit(), ordering=ordering)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise ApiError(400, 'Неверный курсор страницы')
+
+        data = {'next': page.next_cursor, 'previous': page.previous_cursor}
+        if self.request.GET.get('compact') in ('1', 'true'):
+            data['fields'] = names
+            data['rows'] = [[self.fields[name].get(obj) for name in names] for obj in page]
+        else:
+            data['results'] = [self.serialize(obj, names) for obj in page]
+        last_modified = max((obj.updated_at for obj in page), default=None)
+        return json_response(self.request, data, last_modified=last_modified)
+
+
+AD_FIELDS = {
+    'id': Field('id'),
+    'title': Field('title'),
+    'description': Field('description'),
+    'category': Field('category'),
+    'condition': Field('condition'),
+    'image_url': Field('image_url'),
+    'thumbnail': Field('image_url', get=_thumbnail),
+    'user': Field('user__username'),
+    'proposals_count': Field('proposals_count'),
+    'created_at': Field('created_at'),
+    'updated_at': Field('updated_at'),
+}
+
+PROPOSAL_FIELDS = {
+    'id': Field('id'),
+    'status': Field('status'),
+    'comment': Field('comment'),
+    'ad_sender': Field('ad_sender_id'),
+    'ad_sender_title': Field('ad_sender__title'),
+    'sender': Field('ad_sender__user__username'),
+    'ad_receiver': Field('ad_receiver_id'),
+    'ad_receiver_title': Field('ad_receiver__title'),
+    'receiver': Field('ad_receiver__user__username'),
+    'created_at': Field('created_at'),
+    'updated_at': Field('updated_at'),
+}
+
+
+class AdCollectionApiView(ReplicaReadMixin, AdFilterMixin, ApiListMixin, ApiView):
+    """GET — лента объявлений (без своих, как на главной), POST — новое объявление"""
+    fields = AD_FIELDS
+
+    def get(self, request):
+        queryset = Ad.objects.visible()
+        if request.user.is_authenticated:
+            queryset = queryset.exclude(user=request.user)
+        return self.paginate(self.filter_updated(self.filter_ads(queryset)))
+
+    def post(self, request):
+        user = self.require_user()
+        form = AdForm(self.get_data())
+        if not form.is_valid():
+            raise ApiError(400, 'Ошибка в данных', errors=form.errors.get_json_data())
+        form.instance.user = user
+        return self.created(form.save(), 'api_ad')
+
+
+class AdApiView(ApiView):
+    """Одно объявление"""
+    fields = AD_FIELDS
+
+    def get(self, request, pk):
+        return self.detail(Ad.objects.visible(), pk)
+
+
+class ProposalCollectionApiView(ReplicaReadMixin, ApiListMixin, ProposalFilterMixin, ApiView):
+    """GET — предложения с фильтрами списка обменов, POST — новое предложение"""
+    fields = PROPOSAL_FIELDS
+
+    def get(self, request):
+        queryset = self.filter_proposals(ProposalHistory().visible())
+        return self.paginate(self.filter_updated(queryset))
+
+    def post(self, request):
+        user = self.require_user()
+        form = ExchangeProposalForm(self.get_data(), user=user)
+        if not form.is_valid():
+            raise ApiError(400, 'Ошибка в данных', errors=form.errors.get_json_data())
+        form.instance.status = ExchangeProposal.PENDING
+        return self.created(form.save(), 'api_proposal')
+
+
+class ProposalApiView(ApiView):
+    """Одно предложение"""
+    fields = PROPOSAL_FIELDS
+
+    def get(self, request, pk):
+        return self.detail(ProposalHistory().visible(), pk)
+
+
+class ProposalAnswerApiView(ApiView):
+    """POST — принять или отклонить предложение; доступно только получателю.
+
+    Статус меняют ``ExchangeProposalQuerySet.accept``/``reject``, как и в
+    списке полученных предложений: при принятии конкурирующие предложения
+    отклоняются. Если предложение уже не ожидало ответа — 409.
+    """
+    fields = PROPOSAL_FIELDS
+    action = None
+
+    def post(self, request, pk):
+        user = self.require_user()
+        proposals = ProposalHistory().visible().filter(pk=pk, ad_receiver__user=user)
+        if not proposals.exists():
+            raise Http404
+        if self.action == 'accept':
+            changed = bool(proposals.live.accept()['accepted'])
+        else:
+            changed = bool(proposals.live.reject())
+        names = list(self.fields)
+        data = self.serialize(self.get_object(ProposalHistory(), pk, names), names)
+        if not changed:
+            raise ApiError(409, 'Предложение уже обработано', proposal=data)
+        return json_response(request, data)
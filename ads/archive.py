@@ -0,0 +1,173 @@
+"""Архив решённых предложений обмена.
+
+Принятые и отклонённые предложения никогда не удаляются, и история
+растёт без предела, а входящие, исходящие и общий список читают её вместе
+с живыми ожидающими предложениями. ``archive_proposals`` переносит
+решённые предложения, не менявшиеся дольше ``ADS_ARCHIVE_AFTER_DAYS``
+дней, в таблицу ``ArchivedProposal``: пачками в порядке индекса
+``(updated_at, id)``, каждая пачка — одна транзакция (копия в архив и
+DELETE из основной таблицы), с паузой между пачками, чтобы не забирать у
+базы весь ввод-вывод. Прерванный перенос
+продолжается повторным запуском с того же места: перенесённые строки уже
+не попадают в выборку.
+
+Перенос — не удаление: сигналы удаления не отправляются, счётчики
+``proposals_count``/``proposals_*`` не меняются (архив в них входит), а в
+графе обменов и так только ожидающие предложения.
+
+Списки истории читают обе таблицы через ``ProposalHistory``: фильтры и
+сортировка применяются к обеим частям, страница берёт по N строк из
+каждой и сливает их по ключу сортировки — keyset-пагинация работает как
+раньше, каждая часть читается по своему индексу.
+"""
+import heapq
+import time
+from datetime import timedelta
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ArchivedProposal, ExchangeProposal
+
+# Поля, которые архив копирует из ExchangeProposal
+COPIED_FIELDS = ('id', 'ad_sender_id', 'ad_receiver_id', 'comment', 'status', 'created_at', 'updated_at')
+
+
+def get_archive_age():
+    return timedelta(days=getattr(settings, 'ADS_ARCHIVE_AFTER_DAYS', 180))
+
+
+def archivable(before):
+    """Решённые предложения, не менявшиеся с ``before``, в порядке переноса (индекс updated_at, id)"""
+    return (ExchangeProposal.objects.exclude(status=ExchangeProposal.PENDING)
+            .filter(updated_at__lt=before).order_by('updated_at', 'id'))
+
+
+def archive_batch(before, batch_size=1000):
+    """Переносит одну пачку в архив, возвращает число перенесённых предложений"""
+    with transaction.atomic():
+        # Блокировка строк: параллельная правка предложения дождётся переноса, а не потеряется
+        rows = list(archivable(before).select_for_update().values(*COPIED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        now = timezone.now()
+        ArchivedProposal.objects.bulk_create([ArchivedProposal(**row, archived_at=now) for row in rows])
+        moved = ExchangeProposal.objects.filter(pk__in=[row['id'] for row in rows])
+        moved._raw_delete(moved.db)
+    return len(rows)
+
+
+def archive_proposals(before=None, batch_size=1000, pause=0.0, max_batches=None, progress=None):
+    """Переносит в архив всё, что решено раньше ``before`` (по умолчанию — ``ADS_ARCHIVE_AFTER_DAYS`` назад).
+
+    ``pause`` — секунды сна между пачками, ``max_batches`` — предел пачек
+    за запуск, ``progress(перенесено всего)`` вызывается после каждой
+    пачки. Возвращает число перенесённых предложений.
+    """
+    if before is None:
+        before = timezone.now() - get_archive_age()
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        moved = archive_batch(before, batch_size)
+        if not moved:
+            break
+        total += moved
+        batches += 1
+        if progress:
+            progress(total)
+        if moved < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+class ProposalHistory:
+    """Действующие и архивные предложения одним списком.
+
+    Поддерживает то, что нужно спискам и пагинаторам: методы, возвращающие
+    QuerySet (``filter``, ``only``, ``for_list``, ``order_by``...),
+    применяются к обеим частям; срез ``[a:b]`` читает по ``b`` строк из
+    каждой части и сливает их по общей сортировке; ``count``/``acount``
+    складывают части, ``aiterator`` читает их асинхронно. Сортировка — по
+    полям одного направления, как ``('-created_at', '-id')``.
+    """
+    model = ExchangeProposal
+    chained = ('filter', 'exclude', 'only', 'select_related', 'order_by', 'using', 'for_list', 'visible')
+
+    def __init__(self, live=None, archived=None, bounds=(None, None)):
+        self.live = ExchangeProposal.objects.all() if live is None else live
+        self.archived = ArchivedProposal.objects.all() if archived is None else archived
+        # Срез объединённого списка: части уже ограничены концом среза, начало отрезается после слияния
+        self.bounds = slice(*bounds)
+        self._result_cache = None
+
+    def __getattr__(self, name):
+        if name not in self.chained:
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            archived = getattr(self.archived, name)(*args, **kwargs)
+            if name == 'filter' and kwargs.get('status') == ExchangeProposal.PENDING:
+                # Ожидающих в архиве не бывает: такой список к архиву не обращается
+                archived = archived.none()
+            return ProposalHistory(getattr(self.live, name)(*args, **kwargs), archived)
+        return method
+
+    @property
+    def parts(self):
+        return self.live, self.archived
+
+    @property
+    def db(self):
+        return self.live.db
+
+    @property
+    def ordered(self):
+        return self.live.ordered
+
+    def _merge(self, live, archived):
+        ordering = self.live.query.order_by
+        if not ordering:
+            return [*live, *archived][self.bounds]
+        descending = {name.startswith('-') for name in ordering}
+        if len(descending) != 1:
+            raise ValueError('Сортировка составного списка — по полям одного направления')
+        key = attrgetter(*(name.lstrip('-') for name in ordering))
+        return list(heapq.merge(live, archived, key=key, reverse=descending.pop()))[self.bounds]
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self[key:key + 1])[0]
+        if key.stop is None or key.step is not None:
+            raise TypeError('Составной список режется только с концом: [a:b]')
+        return ProposalHistory(self.live[:key.stop], self.archived[:key.stop], bounds=(key.start, key.stop))
+
+    def __iter__(self):
+        if self._result_cache is None:
+            self._result_cache = self._merge(list(self.live), list(self.archived))
+        return iter(self._result_cache)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    async def aiterator(self):
+        live = [obj async for obj in self.live.aiterator()]
+        archived = [obj async for obj in self.archived.aiterator()]
+        for obj in self._merge(live, archived):
+            yield obj
+
+    def count(self):
+        return self.live.count() + self.archived.count()
+
+    async def acount(self):
+        return await self.live.acount() + await self.archived.acount()
+
+    def exists(self):
+        return self.live.exists() or self.archived.exists()
+
+    def first(self):
+        rows = list(self[:1])
+        return rows[0] if rows else None
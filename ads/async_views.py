@@ -0,0 +1,120 @@
+"""Асинхронные версии представлений только для чтения (режим ASGI).
+
+Запросы строятся теми же синхронными классами из ``views.py`` (построение
+queryset к базе не обращается), а выполняются через асинхронный ORM:
+``auser()``, ``aiterator()``, ``acount()``. Шаблон рендерится прямо в
+цикле событий, поэтому любое ленивое обращение к базе из шаблона сразу
+даст SynchronousOnlyOperation — списки должны выбирать связанные данные
+заранее (см. ``AdQuerySet.for_feed`` и ``ExchangeProposalQuerySet.for_list``).
+"""
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse
+from django.shortcuts import redirect, render
+from django.views import View
+
+from .cache import aattach_card_versions, afeed_page_key, get_cache, get_feed_timeout
+from .models import UserStats
+from .pagination import InvalidCursor
+from .routers import ReplicaReadMixin
+from .views import AdListView, ExchangeProposalListView, MyAdsView, ReceivedProposalsView, SentProposalsView
+
+
+class AsyncListView(ReplicaReadMixin, View):
+    """Асинхронный список поверх синхронного ListView с keyset-пагинацией"""
+    list_view_class = None
+    login_required = False
+
+    async def get(self, request, *args, **kwargs):
+        # Пользователь загружается асинхронно и подменяет ленивый объект,
+        # чтобы шаблон не обращался к сессии синхронно
+        request.user = await request.auser()
+        if self.login_required and not request.user.is_authenticated:
+            return redirect('/admin/login/')
+        context = await self.get_context_data(request, *args, **kwargs)
+        return render(request, self.view.get_template_names(), context)
+
+    async def get_context_data(self, request, *args, **kwargs):
+        view = self.view = self.list_view_class()
+        view.setup(request, *args, **kwargs)
+        queryset = view.get_queryset()
+        paginator = view.get_keyset_paginator(queryset, view.get_paginate_by(queryset))
+        try:
+            page = await paginator.apage(request.GET.get(view.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404('Неверный курсор страницы')
+        if page.has_other_pages():
+            await paginator.acount()
+        view._annotate_page(page)
+        view.object_list = page.object_list
+        return {
+            'view': view,
+            'paginator': paginator,
+            'page_obj': page,
+            'is_paginated': page.has_other_pages(),
+            'object_list': page.object_list,
+            view.get_context_object_name(page.object_list): page.object_list,
+        }
+
+
+class AsyncAdListView(AsyncListView):
+    """Лента объявлений с асинхронным кэшем страниц для анонимных пользователей"""
+    list_view_class = AdListView
+
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        timeout = get_feed_timeout()
+        key = None
+        if timeout and not request.user.is_authenticated:
+            key = await afeed_page_key(request)
+        if key:
+            cached = await get_cache().aget(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+        response = await super().get(request, *args, **kwargs)
+        if key and response.status_code == 200:
+            await get_cache().aset(key, (response.content, response['Content-Type']), timeout)
+        return response
+
+    async def get_context_data(self, request, *args, **kwargs):
+        context = await super().get_context_data(request, *args, **kwargs)
+        await aattach_card_versions(context['object_list'])
+        context['ad_card_timeout'] = get_feed_timeout()
+        context['facets'] = await self.view.aget_facets()
+        return context
+
+
+class AsyncMyAdsView(AsyncListView):
+    list_view_class = MyAdsView
+    login_required = True
+
+
+class AsyncExchangeProposalListView(AsyncListView):
+    list_view_class = ExchangeProposalListView
+
+
+class AsyncProposalStatsMixin:
+    """Счётчики пользователя загружаются заранее, шаблон не обращается к базе"""
+
+    async def get_context_data(self, request, *args, **kwargs):
+        context = await super().get_context_data(request, *args, **kwargs)
+        if 'stats' not in self.view.__dict__:
+            self.view.stats = await UserStats.objects.afor_user(request.user)
+        context['stats'] = self.view.stats
+        return context
+
+
+class AsyncSentProposalsView(AsyncProposalStatsMixin, AsyncListView):
+    list_view_class = SentProposalsView
+    login_required = True
+
+
+class AsyncReceivedProposalsView(AsyncProposalStatsMixin, AsyncListView):
+    """Входящие предложения; изменение статуса выполняет синхронное представление"""
+    list_view_class = ReceivedProposalsView
+    login_required = True
+
+    async def post(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        return await sync_to_async(ReceivedProposalsView.as_view())(request, *args, **kwargs)
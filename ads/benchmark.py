@@ -0,0 +1,287 @@
+"""Бенчмарк представлений: все маршруты ads/urls.py через тестовый клиент.
+
+Каждый сценарий — GET одного маршрута с реалистичными параметрами (самый
+загруженный пользователь, глубокая страница ленты, поиск). Для сценария
+замеряются задержка (p50/p95 по ``repeat`` прогонам после прогрева),
+число и время SQL-запросов и пик выделенной памяти (отдельным прогоном
+под tracemalloc, чтобы трассировка не искажала время). Отчёт — JSON,
+который сравнивается с сохранённым эталоном функцией ``compare``.
+
+Прогон идёт в транзакции, которая откатывается: сессии входа и права
+сотрудника для выгрузки не остаются в базе.
+
+``run_profile`` прогоняет те же сценарии с настройками другого профиля
+(bartersystem/production_settings.py): сначала с текущими, затем с каждой
+отличающейся настройкой по отдельности и со всеми вместе — видно, что даёт
+каждая. Клиенты, как браузеры, принимают gzip, поэтому в отчёте есть и
+объём ответа.
+"""
+import logging
+import platform
+import statistics
+import time
+import tracemalloc
+from importlib import import_module
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Ad, ExchangeProposal, UserStats
+from .pagination import NEXT, encode_cursor
+
+
+class Scenario:
+    """Запрос к маршруту ``url_name``; ``kwargs`` и ``query`` — функции от ``Fixture``"""
+
+    def __init__(self, name, url_name, kwargs=None, query=None, login=True, expect=(200,)):
+        self.name = name
+        self.url_name = url_name
+        self.kwargs = kwargs or (lambda fixture: {})
+        self.query = query or (lambda fixture: {})
+        self.login = login
+        self.expect = expect
+
+
+SCENARIOS = [
+    Scenario('ad_list', 'ad_list', login=False),
+    Scenario('ad_list_filtered', 'ad_list', login=False,
+             query=lambda f: {'category': Ad.CATEGORIES[0][0], 'condition': Ad.CONDITION_CHOICES[1][0]}),
+    Scenario('ad_list_search', 'ad_list', login=False, query=lambda f: {'q': f.search}),
+    Scenario('ad_list_deep', 'ad_list', login=False, query=lambda f: {'cursor': f.deep_cursor}),
+    Scenario('ad_create', 'ad_create'),
+    Scenario('my_ads', 'my_ads'),
+    Scenario('ad_edit', 'ad_edit', kwargs=lambda f: {'pk': f.own_ad}),
+    Scenario('ad_delete', 'ad_delete', kwargs=lambda f: {'pk': f.own_ad}),
+    # У синтетических объявлений нет изображений: замеряется путь до ответа 404 без обращений к сети
+    Scenario('ad_image', 'ad_image', kwargs=lambda f: {'pk': f.own_ad, 'size': 'card'}, expect=(404,)),
+    Scenario('exchange_list', 'exchange_list'),
+    Scenario('exchange_list_filtered', 'exchange_list', query=lambda f: {'status': 'pending', 'receiver': f.username}),
+    Scenario('exchange_create', 'exchange_create', query=lambda f: {'receiver': f.other_ad}),
+    Scenario('exchange_export', 'exchange_export', query=lambda f: {'mine': 'received', 'format': 'ndjson'}),
+    Scenario('exchange_sent', 'exchange_sent'),
+    Scenario('exchange_received', 'exchange_received'),
+    Scenario('trade_cycles', 'trade_cycles'),
+    Scenario('metrics', 'metrics'),
+    Scenario('api_ads', 'api_ads', login=False),
+    Scenario('api_ads_sparse', 'api_ads', login=False, query=lambda f: {'fields': 'id,title', 'compact': '1'}),
+    Scenario('api_ads_deep', 'api_ads', login=False, query=lambda f: {'cursor': f.deep_cursor}),
+    Scenario('api_ad', 'api_ad', login=False, kwargs=lambda f: {'pk': f.own_ad}),
+    Scenario('api_proposals', 'api_proposals', query=lambda f: {'mine': 'received', 'status': 'pending'}),
+    Scenario('api_proposal', 'api_proposal', kwargs=lambda f: {'pk': f.proposal}),
+    # Ответ на предложение меняет данные, поэтому замеряется только отказ GET (405)
+    Scenario('api_proposal_accept', 'api_proposal_accept', kwargs=lambda f: {'pk': f.proposal}, expect=(405,)),
+    Scenario('api_proposal_reject', 'api_proposal_reject', kwargs=lambda f: {'pk': f.proposal}, expect=(405,)),
+    Scenario('login', 'login', login=False),
+    Scenario('signup', 'signup', login=False),
+]
+
+
+def uncovered_url_names(scenarios=SCENARIOS):
+    """Маршруты приложения, для которых нет сценария"""
+    from . import urls
+
+    covered = {scenario.url_name for scenario in scenarios}
+    return sorted({pattern.name for pattern in urls.urlpatterns if pattern.name} - covered)
+
+
+class Fixture:
+    """Объекты, на которых строятся сценарии: пользователь с самыми большими входящими и т. п."""
+
+    def __init__(self, deep_offset=1000):
+        stats = UserStats.objects.order_by('-pending_received', '-proposals_sent').first()
+        self.user = stats.user if stats else User.objects.filter(ad__isnull=False).first()
+        if self.user is None:
+            raise LookupError('Нет объявлений: сначала выполните seed_benchmark')
+        self.username = self.user.username
+        own = Ad.objects.filter(user=self.user).order_by('-created_at', '-id')
+        self.own_ad = own.values_list('pk', flat=True).first()
+        self.other_ad = Ad.objects.exclude(user=self.user).values_list('pk', flat=True).first()
+        self.proposal = ExchangeProposal.objects.filter(ad_receiver__user=self.user).values_list('pk', flat=True).first() or 0
+        title = own.values_list('title', flat=True).first() or ''
+        self.search = (title.split() + [''])[1].lower() or 'телефон'
+        deep = Ad.objects.order_by('-created_at', '-id').values_list('created_at', 'pk')[deep_offset:deep_offset + 1]
+        deep = deep.first() or Ad.objects.order_by('created_at', 'id').values_list('created_at', 'pk').first()
+        self.deep_cursor = encode_cursor(NEXT, list(deep))
+
+
+# Настройки профиля, которые сравниваются с текущими; сессии сравниваются во всех вариантах хранения
+PROFILE_SETTINGS = ('DEBUG', 'TEMPLATES', 'SESSION_ENGINE', 'MIDDLEWARE')
+SESSION_ENGINES = ['django.contrib.sessions.backends.' + name for name in ('cache', 'cached_db', 'signed_cookies')]
+
+
+def _get(client, path, query):
+    response = client.get(path, query)
+    if response.streaming:
+        # Потоковый ответ считается целиком: иначе замер не включает чтение строк
+        response.size = sum(len(chunk) for chunk in response.streaming_content)
+    else:
+        response.size = len(response.content)
+    return response
+
+
+def measure(client, path, query, repeat, warmup, trace_memory=True):
+    for _ in range(warmup):
+        _get(client, path, query)
+    # При DEBUG журнал запросов ограничен 9000 записями: заполненный журнал CaptureQueriesContext не видит
+    reset_queries()
+    with CaptureQueriesContext(connection) as context:
+        response = _get(client, path, query)
+    # captured_queries — срез живого журнала, следующие запросы его очистят
+    queries = context.captured_queries
+    db_time = _db_time(response, queries)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _get(client, path, query)
+        timings.append((time.perf_counter() - started) * 1000)
+    result = {
+        'path': path,
+        'status': response.status_code,
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(_percentile(timings, 0.95), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'queries': len(queries),
+        'db_ms': round(db_time * 1000, 3),
+        'response_kb': round(response.size / 1024, 1),
+    }
+    if trace_memory:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        _get(client, path, query)
+        result['peak_memory_kb'] = round((tracemalloc.get_traced_memory()[1] - base) / 1024, 1)
+        if started_tracing:
+            tracemalloc.stop()
+    return result
+
+
+def _db_time(response, queries):
+    # Замер RequestMetricsMiddleware точнее: в captured_queries время округлено до миллисекунд
+    sample = getattr(response.wsgi_request, '_metrics_sample', None)
+    if sample is not None:
+        return sample.db_time
+    return sum(float(query['time']) for query in queries)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _run_scenarios(scenarios, results, repeat, warmup, trace_memory, progress):
+    fixture = Fixture()
+    User.objects.filter(pk=fixture.user.pk).update(is_staff=True)
+    anonymous, member = Client(headers={'Accept-Encoding': 'gzip'}), Client(headers={'Accept-Encoding': 'gzip'})
+    member.force_login(fixture.user)
+    for scenario in scenarios:
+        path = reverse(scenario.url_name, kwargs=scenario.kwargs(fixture))
+        client = member if scenario.login else anonymous
+        result = measure(client, path, scenario.query(fixture), repeat, warmup, trace_memory)
+        result['ok'] = result['status'] in scenario.expect
+        results[scenario.name] = result
+        if progress:
+            progress(scenario.name, result)
+    return fixture
+
+
+def run(scenarios=SCENARIOS, repeat=20, warmup=2, trace_memory=True, use_cache=False, progress=None, overrides=None):
+    """Прогоняет сценарии и возвращает отчёт (словарь, готовый к json.dump); ``overrides`` — другие настройки"""
+    overrides = {**(overrides or {}), 'ALLOWED_HOSTS': ['*']}
+    if not use_cache:
+        overrides['ADS_FEED_CACHE_TIMEOUT'] = 0
+    results = {}
+    # Ответы 404 ожидаемы в сценариях, предупреждения о них только засоряют вывод
+    request_logger = logging.getLogger('django.request')
+    level = request_logger.level
+    request_logger.setLevel(logging.ERROR)
+    try:
+        with override_settings(**overrides), transaction.atomic():
+            fixture = _run_scenarios(scenarios, results, repeat, warmup, trace_memory, progress)
+            transaction.set_rollback(True)
+    finally:
+        request_logger.setLevel(level)
+
+    return {
+        'meta': {
+            'created': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'repeat': repeat,
+            'cache': use_cache,
+            'dataset': {
+                'users': User.objects.count(),
+                'ads': Ad.objects.count(),
+                'proposals': ExchangeProposal.objects.count(),
+            },
+            'user': fixture.username,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=0.25, min_delta_ms=2.0, min_delta_kb=256):
+    """Сравнивает отчёт с эталоном, возвращает список строк (сценарий, метрика, было, стало, регрессия).
+
+    Время и память считаются регрессией, если выросли больше чем на
+    ``tolerance`` и на абсолютный порог (мелкие колебания — шум), число
+    SQL-запросов — при любом росте.
+    """
+    rows = []
+    for name, result in report['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        for metric, threshold in (('p50_ms', min_delta_ms), ('p95_ms', min_delta_ms), ('peak_memory_kb', min_delta_kb)):
+            if metric in result and metric in base:
+                before, after = base[metric], result[metric]
+                regression = after > before * (1 + tolerance) and after - before > threshold
+                rows.append((name, metric, before, after, regression))
+        rows.append((name, 'queries', base['queries'], result['queries'], result['queries'] > base['queries']))
+    return rows
+
+
+def profile_variants(module_name):
+    """Варианты настроек для сравнения: [(название, переопределения)], первый — текущие настройки"""
+    profile = import_module(module_name)
+    changed = {name: getattr(profile, name) for name in PROFILE_SETTINGS
+               if hasattr(profile, name) and getattr(profile, name) != getattr(settings, name)}
+    variants = [('current', {})]
+    for name, value in changed.items():
+        if name == 'SESSION_ENGINE':
+            continue
+        variants.append((name, {name: value}))
+    for engine in SESSION_ENGINES:
+        if engine != settings.SESSION_ENGINE:
+            variants.append((f"SESSION_ENGINE={engine.rsplit('.', 1)[1]}", {'SESSION_ENGINE': engine}))
+    variants.append(('profile', changed))
+    return variants
+
+
+def run_profile(module_name, scenarios=SCENARIOS, progress=None, **options):
+    """Отчёт ``run`` для каждого варианта из ``profile_variants``: {'meta': ..., 'variants': {название: отчёт}}"""
+    reports = {}
+    for label, overrides in profile_variants(module_name):
+        reports[label] = run(scenarios, overrides=overrides,
+                             progress=progress and (lambda name, result, label=label: progress(label, name, result)),
+                             **options)
+    return {'meta': {'profile': module_name, **reports['current']['meta']}, 'variants': reports}
+
+
+def summarize(report):
+    """Сумма по сценариям: p50, SQL-запросы и объём ответов — одна строка на вариант профиля"""
+    results = report['results'].values()
+    return {
+        'p50_ms': round(sum(result['p50_ms'] for result in results), 3),
+        'queries': sum(result['queries'] for result in results),
+        'response_kb': round(sum(result['response_kb'] for result in results), 1),
+    }
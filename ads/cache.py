@@ -0,0 +1,155 @@
+"""Кэширование публичной ленты объявлений.
+
+Для анонимных пользователей страница ленты кэшируется целиком по
+нормализованным параметрам фильтров и страницы, карточки объявлений —
+фрагментами шаблона. Инвалидация версионная: сигналы ``Ad`` увеличивают
+версию ленты и версию конкретного объявления, старые ключи просто
+перестают запрашиваться и вытесняются бэкендом, глобальная очистка не нужна.
+Работает с любым бэкендом Django (locmem, файловый, Redis).
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+FEED_VERSION_KEY = 'ads:feed:version'
+AD_VERSION_KEY = 'ads:ad:{}:version'
+
+# Параметры, от которых зависит содержимое ленты
+FEED_PARAMS = ('category', 'condition', 'q', 'cursor', 'page')
+
+
+def get_cache():
+    return caches[getattr(settings, 'ADS_FEED_CACHE_ALIAS', 'default')]
+
+
+def get_feed_timeout():
+    return getattr(settings, 'ADS_FEED_CACHE_TIMEOUT', 300)
+
+
+def _new_version():
+    # Версия уникальна даже после вытеснения ключа из кэша, поэтому
+    # записи, созданные под старой версией, не могут «воскреснуть»
+    return time.time_ns()
+
+
+def get_version(key):
+    """Текущая версия по ключу; создаётся при первом обращении"""
+    cache = get_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+async def aget_version(key):
+    """Асинхронный вариант get_version()"""
+    cache = get_cache()
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, _new_version(), None)
+        version = await cache.aget(key)
+    return version
+
+
+def bump_version(key):
+    """Увеличивает версию, делая недействительными все зависящие записи"""
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+def invalidate_ad(ad_id):
+    """Сбрасывает кэш ленты и карточки объявления"""
+    bump_version(FEED_VERSION_KEY)
+    bump_version(AD_VERSION_KEY.format(ad_id))
+
+
+def invalidate_feed():
+    """Сбрасывает кэш страниц ленты, не трогая карточки"""
+    bump_version(FEED_VERSION_KEY)
+
+
+def _feed_page_digest(request):
+    if set(request.GET) - set(FEED_PARAMS):
+        return None
+    params = sorted((name, request.GET[name]) for name in FEED_PARAMS if request.GET.get(name))
+    return hashlib.md5(repr(params).encode()).hexdigest()
+
+
+def feed_page_key(request):
+    """Ключ страницы ленты или None, если запрос нельзя кэшировать"""
+    digest = _feed_page_digest(request)
+    if digest is None:
+        return None
+    return f'ads:feed:page:{get_version(FEED_VERSION_KEY)}:{digest}'
+
+
+async def afeed_page_key(request):
+    """Асинхронный вариант feed_page_key()"""
+    digest = _feed_page_digest(request)
+    if digest is None:
+        return None
+    return f'ads:feed:page:{await aget_version(FEED_VERSION_KEY)}:{digest}'
+
+
+def attach_card_versions(ads):
+    """Проставляет объявлениям ``cache_version`` для ключей фрагментов карточек"""
+    cache = get_cache()
+    keys = {ad.pk: AD_VERSION_KEY.format(ad.pk) for ad in ads}
+    if keys:
+        versions = cache.get_many(keys.values())
+        missing = {key: _new_version() for key in keys.values() if key not in versions}
+        cache.set_many(missing, None)
+        _set_card_versions(ads, keys, {**versions, **missing})
+
+
+async def aattach_card_versions(ads):
+    """Асинхронный вариант attach_card_versions()"""
+    cache = get_cache()
+    keys = {ad.pk: AD_VERSION_KEY.format(ad.pk) for ad in ads}
+    if keys:
+        versions = await cache.aget_many(keys.values())
+        missing = {key: _new_version() for key in keys.values() if key not in versions}
+        await cache.aset_many(missing, None)
+        _set_card_versions(ads, keys, {**versions, **missing})
+
+
+def _set_card_versions(ads, keys, versions):
+    for ad in ads:
+        ad.cache_version = versions[keys[ad.pk]]
+
+
+class CachedFeedMixin:
+    """Кэширует страницу ленты для анонимных пользователей и версии карточек"""
+
+    def get(self, request, *args, **kwargs):
+        timeout = get_feed_timeout()
+        key = None
+        if timeout and not request.user.is_authenticated:
+            key = feed_page_key(request)
+        if key:
+            cached = get_cache().get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+        response = super().get(request, *args, **kwargs)
+        if key:
+            response.add_post_render_callback(lambda rendered: self._store_page(key, rendered, timeout))
+        return response
+
+    def _store_page(self, key, response, timeout):
+        if response.status_code == 200:
+            get_cache().set(key, (response.content, response['Content-Type']), timeout)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        attach_card_versions(context['object_list'])
+        context['ad_card_timeout'] = get_feed_timeout()
+        return context
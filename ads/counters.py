@@ -0,0 +1,78 @@
+"""Сверка денормализованных счётчиков предложений с исходными данными.
+
+Счётчики ``Ad.proposals_count`` и ``UserStats`` поддерживаются при
+создании, смене статуса и удалении предложений. Массовые вставки
+(``bulk_create``), ручные правки в базе и гонки на SQLite могут их
+разойтись с реальностью — ``reconcile_counters`` пересчитывает всё
+несколькими агрегирующими запросами и исправляет только расхождения.
+Общие счётчики включают архивные предложения (ads/archive.py).
+"""
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Ad, ArchivedProposal, ExchangeProposal, UserStats
+
+
+def _actual_user_counters():
+    actual = {}
+    pending = Count('pk', filter=Q(status=ExchangeProposal.PENDING))
+    for model in (ExchangeProposal, ArchivedProposal):
+        for side, owner in (('received', 'ad_receiver__user_id'), ('sent', 'ad_sender__user_id')):
+            rows = model.objects.order_by().values_list(owner).annotate(total=Count('pk'), pending=pending)
+            for user_id, total, pending_count in rows:
+                counters = actual.setdefault(user_id, dict.fromkeys(UserStats.COUNTERS, 0))
+                counters[f'proposals_{side}'] += total
+                counters[f'pending_{side}'] += pending_count
+    return actual
+
+
+def reconcile_counters(fix=True, batch_size=1000):
+    """Пересчитывает счётчики и возвращает расхождения.
+
+    Результат: {счётчик: (число строк с расхождением, сумма модулей
+    расхождений)}. При ``fix=False`` база не меняется.
+    """
+    report = {}
+    with transaction.atomic():
+        received = {}
+        for model in (ExchangeProposal, ArchivedProposal):
+            for pk, count in model.objects.order_by().values_list('ad_receiver_id').annotate(n=Count('pk')):
+                received[pk] = received.get(pk, 0) + count
+        drifted, total = [], 0
+        now = timezone.now()
+        ads = Ad.objects.order_by('pk').values_list('pk', 'proposals_count').iterator(chunk_size=batch_size)
+        for pk, stored in ads:
+            value = received.get(pk, 0)
+            if value != stored:
+                drifted.append(Ad(pk=pk, proposals_count=value, updated_at=now))
+                total += abs(value - stored)
+        report['ad.proposals_count'] = (len(drifted), total)
+        if fix:
+            Ad.objects.bulk_update(drifted, ['proposals_count', 'updated_at'], batch_size=batch_size)
+
+        actual = _actual_user_counters()
+        stored = {row.pk: row for row in UserStats.objects.all()}
+        drift = {counter: [0, 0] for counter in UserStats.COUNTERS}
+        changed, missing = [], []
+        for user_id in actual.keys() | stored.keys():
+            values = actual.get(user_id, dict.fromkeys(UserStats.COUNTERS, 0))
+            row = stored.get(user_id)
+            differs = False
+            for counter, value in values.items():
+                current = getattr(row, counter) if row else 0
+                if value != current:
+                    drift[counter][0] += 1
+                    drift[counter][1] += abs(value - current)
+                    differs = True
+            if row is None:
+                missing.append(UserStats(user_id=user_id, **values))
+            elif differs:
+                for counter, value in values.items():
+                    setattr(row, counter, value)
+                changed.append(row)
+        report.update({f'user.{counter}': tuple(value) for counter, value in drift.items()})
+        if fix:
+            UserStats.objects.bulk_create(missing, batch_size=batch_size, ignore_conflicts=True)
+            UserStats.objects.bulk_update(changed, UserStats.COUNTERS, batch_size=batch_size)
+    return report
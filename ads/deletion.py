@@ -0,0 +1,176 @@
+"""Удаление объявлений и пользователей с большим числом предложений.
+
+``Model.delete()`` собирает каскад в Python: загружает каждое связанное
+предложение, отправляет по нему сигналы и только потом удаляет — для
+популярного объявления или пользователя с сотнями объявлений это секунды
+запроса и всплеск памяти.
+
+Здесь удаление идёт в два шага. Надгробие: ``deleted_at`` ставится одним
+UPDATE, объявление сразу пропадает из ленты, поиска, API и списков
+(``AdQuerySet.visible``), а сигнал ``ads_deleted`` сбрасывает кэши и
+индексы. Очистка (``purge_ads``): предложения (действующие и архивные),
+поисковые термины и сами строки удаляются пачками по id прямым DELETE, без загрузки объектов;
+работа обработчиков post_delete предложений (счётчики, граф обменов)
+выполняется агрегатно — несколькими запросами на пачку. Если на удаление
+подписан обработчик, которого очистка не повторяет, пачки удаляются
+обычным ``delete()`` со всеми сигналами.
+
+Каскад до ``ADS_DELETE_SYNC_LIMIT`` предложений очищается сразу, больший —
+фоновой задачей (ads/tasks.py).
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.signals import post_delete, pre_delete
+from django.utils import timezone
+
+from .models import Ad, AdSearchTerm, ArchivedProposal, ExchangeProposal, UserStats, ads_deleted
+
+
+def get_sync_limit():
+    return getattr(settings, 'ADS_DELETE_SYNC_LIMIT', 1000)
+
+
+def _replicated_receivers():
+    """Обработчики сигналов удаления, работу которых очистка выполняет сама"""
+    from . import signals
+
+    return {
+        Ad: {signals.index_ad, signals.invalidate_ad_cache, signals.remove_from_recommendations},
+        ExchangeProposal: {signals.update_counters_on_delete, signals.remove_from_trade_graph},
+        ArchivedProposal: {signals.update_counters_on_archive_delete},
+        AdSearchTerm: set(),
+    }
+
+
+def fast_delete_allowed():
+    """Можно ли удалять строки прямым DELETE: посторонних обработчиков удаления нет"""
+    for model, replicated in _replicated_receivers().items():
+        for signal in (pre_delete, post_delete):
+            sync_receivers, async_receivers = signal._live_receivers(model)
+            if set(sync_receivers) - replicated or async_receivers:
+                return False
+    return True
+
+
+def _proposals_of(ad_ids, model=ExchangeProposal):
+    return model.objects.filter(Q(ad_sender__in=ad_ids) | Q(ad_receiver__in=ad_ids))
+
+
+def _cascade_fits(ad_ids, limit):
+    """Умещается ли каскад (действующие и архивные предложения) в ``limit`` строк"""
+    remaining = limit
+    for model in (ExchangeProposal, ArchivedProposal):
+        remaining -= _proposals_of(ad_ids, model)[:remaining + 1].count()
+        if remaining < 0:
+            return False
+    return True
+
+
+def tombstone(ad_ids):
+    """Помечает объявления удалёнными; возвращает id тех, что ещё не были помечены"""
+    with transaction.atomic():
+        ids = list(Ad.objects.visible().filter(pk__in=ad_ids).values_list('pk', flat=True))
+        if ids:
+            now = timezone.now()
+            Ad.objects.filter(pk__in=ids).update(deleted_at=now, updated_at=now)
+            transaction.on_commit(lambda: ads_deleted.send(sender=Ad, ad_ids=ids))
+    return ids
+
+
+def delete_ads(ad_ids):
+    """Удаляет объявления: надгробие сразу, очистка сразу или в фоне.
+
+    Возвращает True, если очистка отложена в фоновую задачу.
+    """
+    from .tasks import enqueue, purge_deleted_ads
+
+    ids = tombstone(ad_ids)
+    if not ids:
+        return False
+    if _cascade_fits(ids, get_sync_limit()):
+        purge_ads(ids)
+        return False
+    transaction.on_commit(lambda: enqueue(purge_deleted_ads, ids))
+    return True
+
+
+def delete_user(user):
+    """Удаляет пользователя: вход закрыт и объявления скрыты сразу, каскад — сразу или в фоне"""
+    from .tasks import enqueue, purge_deleted_user
+
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        ad_ids = list(Ad.objects.filter(user=user).values_list('pk', flat=True))
+        tombstone(ad_ids)
+        if _cascade_fits(ad_ids, get_sync_limit()):
+            purge_user(user.pk)
+            return False
+        transaction.on_commit(lambda: enqueue(purge_deleted_user, user.pk))
+    return True
+
+
+def purge_ads(ad_ids, batch_size=1000):
+    """Удаляет строки объявлений вместе с предложениями и поисковыми терминами.
+
+    Каждая пачка — своя транзакция: блокировки короткие, а прерванную
+    очистку можно просто запустить снова. Возвращает число удалённых
+    предложений.
+    """
+    ad_ids = list(ad_ids)
+    deleted_ads = set(ad_ids)
+    fast = fast_delete_allowed()
+    deleted = 0
+    for model in (ExchangeProposal, ArchivedProposal):
+        while True:
+            with transaction.atomic():
+                ids = list(_proposals_of(ad_ids, model).order_by().values_list('pk', flat=True)[:batch_size])
+                if not ids:
+                    break
+                batch = model.objects.filter(pk__in=ids)
+                if fast:
+                    _release_counters(batch, deleted_ads)
+                    batch._raw_delete(batch.db)
+                else:
+                    batch.delete()
+                deleted += len(ids)
+    with transaction.atomic():
+        for start in range(0, len(ad_ids), batch_size):
+            chunk = ad_ids[start:start + batch_size]
+            terms = AdSearchTerm.objects.filter(ad_id__in=chunk)
+            ads = Ad.objects.filter(pk__in=chunk)
+            if fast:
+                terms._raw_delete(terms.db)
+                ads._raw_delete(ads.db)
+            else:
+                ads.delete()
+    return deleted
+
+
+def _release_counters(batch, deleted_ads):
+    """Сдвигает счётчики так же, как post_delete каждого предложения пачки, но агрегатно"""
+    pending = Count('pk', filter=Q(status=ExchangeProposal.PENDING))
+    rows = batch.order_by().values_list('ad_receiver_id', 'ad_receiver__user_id', 'ad_sender__user_id').annotate(
+        total=Count('pk'), pending=pending,
+    )
+    received_ads, deltas = {}, {field: {} for field in UserStats.COUNTERS}
+    for receiver_ad, receiver, sender, total, pending_count in rows:
+        received_ads[receiver_ad] = received_ads.get(receiver_ad, 0) + total
+        for field, user_id, value in (('proposals_received', receiver, total), ('proposals_sent', sender, total),
+                                      ('pending_received', receiver, pending_count),
+                                      ('pending_sent', sender, pending_count)):
+            deltas[field][user_id] = deltas[field].get(user_id, 0) - value
+    now = timezone.now()
+    # Счётчики удаляемых объявлений не важны, остальные получатели — обычно единицы
+    for ad_id, total in received_ads.items():
+        if ad_id not in deleted_ads:
+            Ad.objects.filter(pk=ad_id).update(proposals_count=F('proposals_count') - total, updated_at=now)
+    UserStats.objects.add(deltas, create=False)
+
+
+def purge_user(user_id):
+    """Очищает объявления пользователя и удаляет его самого (остаток каскада уже невелик)"""
+    ad_ids = list(Ad.objects.filter(user_id=user_id).values_list('pk', flat=True))
+    purge_ads(ad_ids)
+    User.objects.filter(pk=user_id).delete()
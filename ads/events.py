@@ -0,0 +1,123 @@
+"""SSE-поток уведомлений о предложениях для ASGI.
+
+Приложение подключается в bartersystem/asgi.py перед Django и не проходит
+через его обработчик запросов: там каждое открытое соединение держало бы
+поток синхронного middleware до самого закрытия. Здесь соединение — одна
+корутина, ждущая свою очередь в брокере (ads/notifications.py), поэтому
+воркер выдерживает тысячи простаивающих клиентов. База нужна только при
+подключении (сессия, пользователь и счётчики): запрос выполняется в общем
+пуле потоков, и соединение с базой сразу закрывается.
+
+Раз в ``ADS_EVENTS_HEARTBEAT`` секунд отправляется комментарий-пинг, чтобы
+прокси не закрывали тихое соединение. Через ``ADS_EVENTS_MAX_AGE`` секунд
+поток завершается — EventSource переподключается сам, и соединения заново
+распределяются между воркерами.
+"""
+import asyncio
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import connections
+from django.http import HttpRequest, parse_cookie
+
+from .models import UserStats
+from .notifications import format_event, get_broker
+
+PING = b': ping\n\n'
+
+
+def load_user(session_key):
+    """id пользователя по ключу сессии и начальное событие со счётчиками; для анонима — (None, None)"""
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    user = get_user(request)
+    if not user.is_authenticated:
+        return None, None
+    stats = UserStats.objects.for_user(user)
+    return user.pk, {'pending_received': stats.pending_received, 'pending_sent': stats.pending_sent}
+
+
+def _load_user_in_pool(session_key):
+    try:
+        return load_user(session_key)
+    finally:
+        # Поток общего пула: соединение не должно жить до следующего подключения
+        connections.close_all()
+
+
+class EventStreamApp:
+    """ASGI-приложение ``GET /events/`` → text/event-stream с событиями пользователя"""
+
+    def __init__(self, broker=None, user_loader=None):
+        self.broker = broker
+        self.user_loader = user_loader or sync_to_async(_load_user_in_pool, thread_sensitive=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond(send, 405, b'', [(b'allow', b'GET')])
+            return
+        headers = dict(scope['headers'])
+        cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+        session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+        user_id, stats = await self.user_loader(session_key) if session_key else (None, None)
+        if user_id is None:
+            await self.respond(send, 401, b'', [])
+            return
+        await self.stream(receive, send, user_id, stats)
+
+    async def respond(self, send, status, body, headers):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def stream(self, receive, send, user_id, stats):
+        heartbeat = getattr(settings, 'ADS_EVENTS_HEARTBEAT', 15)
+        max_age = getattr(settings, 'ADS_EVENTS_MAX_AGE', 3600)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_age
+        subscription = (self.broker or get_broker()).subscribe(user_id)
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                # nginx не должен буферизовать поток
+                (b'x-accel-buffering', b'no'),
+            ]})
+            retry = f'retry: {heartbeat * 1000}\n\n'.encode()
+            await send({'type': 'http.response.body', 'body': retry + format_event('stats', stats), 'more_body': True})
+            while (timeout := min(heartbeat, deadline - loop.time())) > 0:
+                message = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait({message, disconnected}, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if message not in done:
+                    message.cancel()
+                if disconnected in done:
+                    return
+                await send({'type': 'http.response.body', 'body': message.result() if message in done else PING,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            # Клиент ушёл, пока отправлялось событие (uvicorn: ClientDisconnected)
+            return
+        finally:
+            disconnected.cancel()
+            subscription.close()
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+def mount(path, app, fallback):
+    """ASGI-приложение: HTTP-запросы на ``path`` — в ``app``, всё остальное — в ``fallback`` (Django)"""
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == path:
+            await app(scope, receive, send)
+        else:
+            await fallback(scope, receive, send)
+
+    return application
@@ -0,0 +1,131 @@
+"""Счётчики вариантов фильтра ленты (фасеты).
+
+Числа у категорий и состояний считаются одним сгруппированным запросом
+``GROUP BY category, condition`` по ленте с учётом поиска, но без самих
+фильтров по категории и состоянию. Из этой матрицы получаются все числа
+сразу: у категорий — с учётом выбранного состояния, у состояний — с учётом
+выбранной категории, то есть «сколько объявлений будет, если выбрать этот
+вариант».
+
+Матрица кэшируется на ``ADS_FACETS_CACHE_TIMEOUT`` секунд под версией
+ленты (ads/cache.py): сигналы ``Ad``, сбрасывающие ленту, сбрасывают и
+счётчики, а короткий срок жизни ограничивает расхождение, если версия
+осталась прежней (например, при массовом ``update()``).
+"""
+import hashlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Count
+
+from .cache import FEED_VERSION_KEY, aget_version, get_cache, get_version
+from .models import Ad
+
+FACETS_KEY = 'ads:facets:{}:{}'
+
+FacetOption = namedtuple('FacetOption', 'value label count selected')
+
+
+def get_facets_timeout():
+    return getattr(settings, 'ADS_FACETS_CACHE_TIMEOUT', 60)
+
+
+class Facets:
+    """Матрица «категория × состояние» с числом объявлений в каждой клетке"""
+
+    def __init__(self, counts, category='', condition=''):
+        self.counts = counts
+        self.category = category
+        self.condition = condition
+
+    def count(self, category=None, condition=None):
+        """Число объявлений с заданными категорией и/или состоянием"""
+        return sum(number for (cell_category, cell_condition), number in self.counts.items()
+                   if category in (None, cell_category) and condition in (None, cell_condition))
+
+    @property
+    def categories(self):
+        condition = self.condition or None
+        return [FacetOption(value, label, self.count(value, condition), value == self.category)
+                for value, label in Ad.CATEGORIES]
+
+    @property
+    def conditions(self):
+        category = self.category or None
+        return [FacetOption(value, label, self.count(category, value), value == self.condition)
+                for value, label in Ad.CONDITION_CHOICES]
+
+    @property
+    def categories_total(self):
+        """Число для варианта «Все категории»"""
+        return self.count(condition=self.condition or None)
+
+    @property
+    def conditions_total(self):
+        """Число для варианта «Любое состояние»"""
+        return self.count(category=self.category or None)
+
+
+def facet_queryset(queryset):
+    """Сгруппированный запрос: строки (category, condition, count)"""
+    if queryset.query.group_by is not None:
+        # Поиск по обратному индексу уже группирует по объявлению —
+        # поверх него считаем через подзапрос, всё так же одним запросом
+        queryset = Ad.objects.filter(pk__in=queryset.values('pk'))
+    return queryset.order_by().values_list('category', 'condition').annotate(count=Count('pk'))
+
+
+def count_facets(queryset):
+    return {(category, condition): number for category, condition, number in facet_queryset(queryset)}
+
+
+async def acount_facets(queryset):
+    """Асинхронный вариант count_facets()"""
+    return {(category, condition): number async for category, condition, number in facet_queryset(queryset)}
+
+
+def _facets_digest(request):
+    # Своих объявлений в ленте нет, поэтому счётчики вошедшего пользователя — отдельная запись
+    user_id = request.user.pk if request.user.is_authenticated else None
+    return hashlib.md5(repr((request.GET.get('q', ''), user_id)).encode()).hexdigest()
+
+
+class FacetCountsMixin:
+    """Добавляет в контекст списка ``facets``; ``get_facet_queryset()`` — лента до фильтров категории и состояния"""
+
+    def get_facet_queryset(self):
+        raise NotImplementedError
+
+    def get_facets_key(self, version):
+        return FACETS_KEY.format(version, _facets_digest(self.request))
+
+    def make_facets(self, counts):
+        return Facets(counts, self.request.GET.get('category', ''), self.request.GET.get('condition', ''))
+
+    def get_facets(self):
+        timeout = get_facets_timeout()
+        if not timeout:
+            return self.make_facets(count_facets(self.get_facet_queryset()))
+        key = self.get_facets_key(get_version(FEED_VERSION_KEY))
+        counts = get_cache().get(key)
+        if counts is None:
+            counts = count_facets(self.get_facet_queryset())
+            get_cache().set(key, counts, timeout)
+        return self.make_facets(counts)
+
+    async def aget_facets(self):
+        """Асинхронный вариант get_facets()"""
+        timeout = get_facets_timeout()
+        if not timeout:
+            return self.make_facets(await acount_facets(self.get_facet_queryset()))
+        key = self.get_facets_key(await aget_version(FEED_VERSION_KEY))
+        counts = await get_cache().aget(key)
+        if counts is None:
+            counts = await acount_facets(self.get_facet_queryset())
+            await get_cache().aset(key, counts, timeout)
+        return self.make_facets(counts)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['facets'] = self.get_facets()
+        return context
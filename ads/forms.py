@@ -1,5 +1,8 @@
 from django import forms
+from django.core.exceptions import ValidationError
+from django.utils.choices import CallableChoiceIterator
 from .models import Ad, ExchangeProposal
+from .recommendations import recommended_ads
 
 class AdForm(forms.ModelForm):
     """Форма для создания объявления"""
@@ -22,5 +25,22 @@ class ExchangeProposalForm(forms.ModelForm):
         user = kwargs.pop('user', None)
         super().__init__(*args, **kwargs)
         if user:
-            self.fields['ad_sender'].queryset = Ad.objects.filter(user=user)
-            self.fields['ad_receiver'].queryset = Ad.objects.exclude(user=user)
\ No newline at end of file
+            self.user = user
+            self.fields['ad_sender'].queryset = Ad.objects.visible().filter(user=user).select_related('user')
+            self.fields['ad_receiver'].queryset = Ad.objects.visible().exclude(user=user).select_related('user')
+            # Принимается любое чужое объявление, но в списке — только рекомендованные:
+            # выпадающий список всех объявлений сайта непригоден. Считается лениво, при выводе
+            self.fields['ad_receiver'].widget.choices = CallableChoiceIterator(self.receiver_choices)
+
+    def receiver_choices(self):
+        """Объявления, похожие на объявления пользователя (ads/recommendations.py)"""
+        field = self.fields['ad_receiver']
+        ads = recommended_ads(self.user)
+        try:
+            selected = field.to_python(self['ad_receiver'].value())
+        except ValidationError:
+            selected = None
+        if selected is not None and selected not in ads:
+            # Форма с ошибкой не теряет выбранное объявление, даже если его нет в рекомендациях
+            ads.insert(0, selected)
+        return [('', field.empty_label)] + [(ad.pk, field.label_from_instance(ad)) for ad in ads]
\ No newline at end of file
@@ -0,0 +1,301 @@
+"""Прокси изображений объявлений с миниатюрами и дисковым кэшем.
+
+Исходное изображение скачивается один раз, миниатюры нужных размеров
+(WebP или JPEG) складываются в кэш, адресуемый по содержимому: имя файла —
+SHA-256 исходных байтов, поэтому одинаковые картинки разных объявлений
+хранятся один раз, а ETag строгий. Размер кэша ограничен
+``ADS_IMAGE_CACHE_MAX_BYTES``, при переполнении удаляются давно не
+запрошенные файлы (время доступа — mtime, обновляется при каждом попадании).
+
+Без Pillow миниатюры не строятся: отдаётся закэшированный оригинал.
+"""
+import hashlib
+import http.client
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import threading
+import urllib.request
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # pragma: no cover - Pillow необязателен
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Размеры миниатюр: имя → ограничивающий прямоугольник (ширина, высота)
+DEFAULT_SIZES = {'card': (480, 240), 'large': (1280, 960)}
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+class ImageError(Exception):
+    """Изображение нельзя скачать или обработать"""
+
+
+def get_sizes():
+    return getattr(settings, 'ADS_IMAGE_SIZES', DEFAULT_SIZES)
+
+
+def get_cache_dir():
+    return Path(getattr(settings, 'ADS_IMAGE_CACHE_DIR', Path(tempfile.gettempdir()) / 'bartersystem-images'))
+
+
+def url_version(url):
+    """Короткий хэш ссылки: меняется вместе с image_url и делает адрес прокси неизменяемым"""
+    return hashlib.sha256(url.encode()).hexdigest()[:12]
+
+
+def choose_format(accept):
+    """WebP, если его принимает браузер и умеет Pillow, иначе JPEG"""
+    if Image is not None and 'image/webp' in (accept or '') and features.check('webp'):
+        return 'webp'
+    return 'jpeg'
+
+
+class ImageCache:
+    """Дисковый кэш: ``urls/`` — ссылка → хэш содержимого, ``src/`` — оригиналы, ``thumbs/`` — миниатюры"""
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None  # текущий объём, считается лениво при первой записи
+
+    def _path(self, kind, name):
+        # Двухуровневое дерево, чтобы в одном каталоге не было сотен тысяч файлов
+        return self.root / kind / name[:2] / name
+
+    def thumbnail(self, url, size, image_format):
+        """Миниатюра: (путь, ETag, Content-Type); скачивает и строит при промахе"""
+        digest = self.source_digest(url)
+        source = self._touch(self._path('src', digest)) or self._path('src', self.fetch(url))
+        if Image is None:
+            with open(source, 'rb') as handle:
+                return source, digest, sniff_content_type(handle.read(16))
+        name = f'{digest}-{size}.{image_format}'
+        path = self._path('thumbs', name)
+        if self._touch(path) is None:
+            self._write(path, render_thumbnail(source.read_bytes(), get_sizes()[size], image_format))
+        return path, name, CONTENT_TYPES[image_format]
+
+    def source_digest(self, url):
+        """Хэш содержимого по ссылке; скачивает оригинал, если ссылка ещё не встречалась"""
+        link = self._path('urls', hashlib.sha256(url.encode()).hexdigest())
+        try:
+            digest = link.read_text()
+        except FileNotFoundError:
+            digest = None
+        if digest and self._path('src', digest).exists():
+            return digest
+        return self.fetch(url)
+
+    def fetch(self, url):
+        data = fetch_image(url)
+        digest = hashlib.sha256(data).hexdigest()
+        self._write(self._path('src', digest), data)
+        self._write(self._path('urls', hashlib.sha256(url.encode()).hexdigest()), digest.encode())
+        return digest
+
+    def _touch(self, path):
+        """Отмечает обращение к файлу для LRU; None, если файла нет"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _write(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Запись во временный файл и атомарная замена: параллельные читатели не увидят половину файла
+        fd, tmp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if self.size is None:
+                self.size = self._scan_size()
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        for kind in ('urls', 'src', 'thumbs'):
+            base = self.root / kind
+            if base.exists():
+                yield from (path for path in base.glob('*/*') if path.is_file())
+
+    def _scan_size(self):
+        return sum(path.stat().st_size for path in self._files())
+
+    def _evict(self):
+        """Удаляет самые давние файлы, пока кэш не займёт 90% лимита"""
+        entries = []
+        for path in self._files():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self.size = total
+
+
+def fetch_image(url):
+    """Скачивает изображение с ограничением размера и времени ожидания"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f'Неподдерживаемая ссылка: {url}')
+
+    limit = getattr(settings, 'ADS_IMAGE_MAX_SOURCE_BYTES', 10 * 1024 * 1024)
+    request = urllib.request.Request(url, headers={'User-Agent': 'bartersystem-image-proxy'})
+    opener = _build_opener()
+    try:
+        with opener.open(request, timeout=getattr(settings, 'ADS_IMAGE_FETCH_TIMEOUT', 5)) as response:
+            if not response.headers.get_content_type().startswith('image/'):
+                raise ImageError(f'Не изображение: {url}')
+            data = response.read(limit + 1)
+    except OSError as error:
+        raise ImageError(f'Не удалось скачать {url}: {error}') from error
+    if len(data) > limit:
+        raise ImageError(f'Изображение больше {limit} байт: {url}')
+    return data
+
+
+def _build_opener():
+    if getattr(settings, 'ADS_IMAGE_ALLOW_PRIVATE', False):
+        return urllib.request.build_opener(_CheckedRedirectHandler)
+    # Без прокси из окружения: имя разрешал бы прокси, и проверенный адрес не закрепить
+    return urllib.request.build_opener(
+        urllib.request.ProxyHandler({}), _PublicHTTPHandler, _PublicHTTPSHandler, _CheckedRedirectHandler)
+
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Перенаправления только на http(s); адрес хоста проверяется при подключении"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        parts = urlsplit(newurl)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageError(f'Неподдерживаемое перенаправление: {newurl}')
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class _PublicAddressMixin:
+    """Подключается к адресу, прошедшему проверку, а не к новому ответу DNS.
+
+    Иначе между проверкой и подключением имя может указать на внутренний
+    адрес (DNS rebinding). Заголовок Host, SNI и проверка сертификата
+    по-прежнему идут по имени из ссылки.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = self._connect_public
+
+    @staticmethod
+    def _connect_public(address, *args, **kwargs):
+        host, port = address
+        return socket.create_connection((_check_public_host(host, port), port), *args, **kwargs)
+
+
+class _PublicHTTPConnection(_PublicAddressMixin, http.client.HTTPConnection):
+    pass
+
+
+class _PublicHTTPSConnection(_PublicAddressMixin, http.client.HTTPSConnection):
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+
+def _check_public_host(host, port):
+    """Запрещает обращения к локальной сети через ссылки в объявлениях; возвращает адрес для подключения"""
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    except OSError as error:
+        raise ImageError(f'Хост не найден: {host}') from error
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if not ip.is_global:
+            raise ImageError(f'Адрес {address} недоступен для прокси')
+    return addresses[0]
+
+
+def sniff_content_type(header):
+    """Тип изображения по сигнатуре первых байтов"""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG'):
+        return 'image/png'
+    if header.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def render_thumbnail(data, box, image_format):
+    """Уменьшает изображение до размеров box с сохранением пропорций"""
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(box)
+            if image_format == 'jpeg':
+                image = image.convert('RGB')
+            elif image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            output = BytesIO()
+            image.save(output, format=image_format.upper(), quality=80)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ImageError(f'Не удалось обработать изображение: {error}') from error
+    return output.getvalue()
+
+
+_cache = None
+_setup_lock = threading.Lock()
+
+
+def get_image_cache():
+    global _cache
+    root, max_bytes = get_cache_dir(), getattr(settings, 'ADS_IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+    with _setup_lock:
+        if _cache is None or _cache.root != root or _cache.max_bytes != max_bytes:
+            _cache = ImageCache(root, max_bytes)
+        return _cache
+
+
+def prefetch(url):
+    """Строит миниатюры всех размеров и форматов; ошибки только логируются"""
+    cache = get_image_cache()
+    formats = ['jpeg'] + (['webp'] if choose_format('image/webp') == 'webp' else [])
+    try:
+        for size in get_sizes():
+            for image_format in formats:
+                cache.thumbnail(url, size, image_format)
+    except ImageError as error:
+        logger.warning('Предзагрузка изображения не удалась: %s', error)
+
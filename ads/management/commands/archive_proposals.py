@@ -0,0 +1,37 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ads.archive import archivable, archive_proposals, get_archive_age
+
+
+class Command(BaseCommand):
+    help = ('Переносит решённые предложения старше ADS_ARCHIVE_AFTER_DAYS дней в архив пачками, с паузой '
+            'между ними. Прерванный запуск можно просто повторить: он продолжит с того же места.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Возраст решённых предложений для переноса, дней')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Предложений в одной транзакции')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Пауза между пачками, секунды')
+        parser.add_argument('--max-batches', type=int, help='Остановиться после стольких пачек')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, сколько предложений перенести')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+        age = timedelta(days=options['days']) if options['days'] is not None else get_archive_age()
+        before = timezone.now() - age
+        if options['dry_run']:
+            self.stdout.write(f'К переносу: {archivable(before).count()} предложений, решённых до {before:%Y-%m-%d %H:%M}')
+            return
+
+        started = time.monotonic()
+        total = archive_proposals(
+            before, batch_size=options['batch_size'], pause=options['sleep'], max_batches=options['max_batches'],
+            progress=lambda moved: self.stdout.write(f'  перенесено {moved}'),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'В архиве {total} предложений, решённых до {before:%Y-%m-%d %H:%M}, {time.monotonic() - started:.2f} с'
+        ))
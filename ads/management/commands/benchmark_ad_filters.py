@@ -0,0 +1,149 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.db.models import Q
+
+from ads.models import Ad, ExchangeProposal
+from ads.seeding import seed_dataset
+
+# Одиночные индексы внешних ключей, которые были до составных индексов
+LEGACY_INDEXES = [
+    (Ad, models.Index(fields=['user'], name='bench_ad_user_idx')),
+    (ExchangeProposal, models.Index(fields=['ad_sender'], name='bench_proposal_sender_idx')),
+    (ExchangeProposal, models.Index(fields=['ad_receiver'], name='bench_proposal_receiver_idx')),
+]
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает планы и время запросов фильтрации объявлений до и после составных индексов '
+            'на синтетических данных. По умолчанию данные откатываются после замеров.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--ads', type=int, default=200000)
+        parser.add_argument('--proposals', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5, help='Число повторов каждого запроса')
+        parser.add_argument('--depth', type=int, default=10000, help='Смещение «глубокой» страницы ленты')
+        parser.add_argument('--keep', action='store_true', help='Не откатывать сгенерированные данные')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        # SQLite разрешает менять схему внутри транзакции, только если проверки
+        # внешних ключей отключены до её начала; на PostgreSQL это no-op
+        constraints_disabled = connection.disable_constraint_checking()
+        try:
+            with transaction.atomic():
+                self._benchmark(options)
+                if not options['keep']:
+                    transaction.set_rollback(True)
+        finally:
+            if constraints_disabled:
+                connection.enable_constraint_checking()
+
+    def _benchmark(self, options):
+        counts = seed_dataset(
+            users=options['users'], ads=options['ads'], proposals=options['proposals'],
+            seed=options['seed'], prefix='bench_filters',
+        )
+        self.stdout.write(f"Сгенерировано: {counts}")
+        params = self._sample_params(options['depth'])
+
+        indexed = [(model, index) for model in (Ad, ExchangeProposal) for index in model._meta.indexes]
+        with connection.schema_editor() as editor:
+            for model, index in indexed:
+                editor.remove_index(model, index)
+            for model, index in LEGACY_INDEXES:
+                editor.add_index(model, index)
+        self._analyze()
+        before = self._measure(self._legacy_queries(params))
+
+        with connection.schema_editor() as editor:
+            for model, index in LEGACY_INDEXES:
+                editor.remove_index(model, index)
+            for model, index in indexed:
+                editor.add_index(model, index)
+        self._analyze()
+        after = self._measure(self._queries(params))
+
+        self._report(before, after)
+
+    def _sample_params(self, depth):
+        """Выбирает значения фильтров и точку «глубокой» страницы (не входит в замеры)"""
+        busiest = (
+            ExchangeProposal.objects.values('ad_receiver__user')
+            .annotate(n=models.Count('id')).order_by('-n').first()
+        )
+        deep = Ad.objects.order_by('-created_at', '-id').values('created_at', 'id')[depth:depth + 1].first()
+        return {
+            'user': busiest['ad_receiver__user'] if busiest else None,
+            'category': Ad.CATEGORIES[0][0],
+            'condition': Ad.CONDITION_CHOICES[0][0],
+            'depth': depth,
+            'deep': deep or {'created_at': None, 'id': 0},
+        }
+
+    def _legacy_queries(self, p):
+        """Запросы в том виде, в каком их строили представления до индексов"""
+        return {
+            'Лента, первая страница': Ad.objects.order_by('-created_at')[:20],
+            'Лента, глубокая страница': Ad.objects.order_by('-created_at')[p['depth']:p['depth'] + 20],
+            'Лента, подсчёт страниц': Ad.objects.all(),
+            'Категория + состояние': Ad.objects.filter(
+                category__icontains=p['category'], condition=p['condition']
+            ).order_by('-created_at')[:20],
+            'Мои объявления': Ad.objects.filter(user_id=p['user']).order_by('-created_at')[:20],
+            'Входящие предложения': ExchangeProposal.objects.filter(
+                ad_receiver__user_id=p['user'], status='pending'
+            ).order_by('-created_at')[:20],
+        }
+
+    def _queries(self, p):
+        """Запросы текущих представлений: keyset-пагинация и точные фильтры"""
+        deep = p['deep']
+        seek = Q(created_at__lt=deep['created_at']) | Q(created_at=deep['created_at'], id__lt=deep['id'])
+        return {
+            'Лента, первая страница': Ad.objects.order_by('-created_at', '-id')[:20],
+            'Лента, глубокая страница': Ad.objects.filter(seek).order_by('-created_at', '-id')[:20],
+            'Лента, подсчёт страниц': None,
+            'Категория + состояние': Ad.objects.filter(
+                category=p['category'], condition=p['condition']
+            ).order_by('-created_at', '-id')[:20],
+            'Мои объявления': Ad.objects.filter(user_id=p['user']).order_by('-created_at', '-id')[:20],
+            'Входящие предложения': ExchangeProposal.objects.filter(
+                ad_receiver__user_id=p['user'], status='pending'
+            ).order_by('-created_at')[:20],
+        }
+
+    def _measure(self, queries):
+        results = {}
+        for name, qs in queries.items():
+            if qs is None:
+                results[name] = (None, 'не выполняется (keyset-пагинация без COUNT)')
+                continue
+            run = (lambda qs=qs: qs.count()) if name == 'Лента, подсчёт страниц' else (lambda qs=qs: list(qs.all()))
+            timings = []
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - started)
+            results[name] = (min(timings) * 1000, qs.explain())
+        return results
+
+    def _analyze(self):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('ANALYZE ads_ad')
+                cursor.execute('ANALYZE ads_exchangeproposal')
+            elif connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+
+    def _report(self, before, after):
+        for name in before:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}'))
+            for label, (ms, plan) in (('до', before[name]), ('после', after[name])):
+                timing = '—' if ms is None else f'{ms:.2f} мс'
+                self.stdout.write(f'  {label}: {timing}')
+                for line in str(plan).splitlines():
+                    self.stdout.write(f'      {line}')
@@ -0,0 +1,82 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import resolve, reverse
+
+from ads import ratelimit
+from ads.middleware import RateLimitMiddleware
+
+STORES = ('ads.ratelimit.MemoryStore', 'ads.ratelimit.CacheStore')
+
+
+class Command(BaseCommand):
+    help = ('Микробенчмарк ограничения частоты: время одной проверки в MemoryStore и CacheStore (кэш default) '
+            'и накладные расходы RateLimitMiddleware на пишущий и читающий запрос по сравнению с запросом без него.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000, help='Проверок на каждый замер')
+        parser.add_argument('--keys', type=int, default=1000, help='Разных пользователей и адресов')
+
+    def handle(self, *args, **options):
+        iterations, keys = options['iterations'], options['keys']
+        if iterations < 1 or keys < 1:
+            raise CommandError('--iterations и --keys должны быть положительными')
+        self.stdout.write(f"Кэш default: {caches['default'].__class__.__name__}, проверок: {iterations}, "
+                          f"ключей: {keys}")
+        # Лимит недостижим: замеряется проверка со счётом, а не короткий путь отказа
+        rate = ratelimit.parse_rate(f'{iterations * 10}/h')
+        limits = {'exchange_create': {'user': f'{iterations * 10}/h', 'ip': f'{iterations * 10}/h'}}
+
+        self.stdout.write(f"{'замер':<44} {'мкс/запрос':>12}")
+        for name in STORES:
+            store = ratelimit.import_string(name)()
+            names = [f'ratelimit:bench:user:{i}' for i in range(keys)]
+            self._row(f'{name.rsplit(".", 1)[1]}.hit', self._time(
+                lambda i: store.hit(names[i % keys], rate), iterations))
+
+        factory = RequestFactory()
+        path = reverse('exchange_create')
+        users = [User(pk=i, username=f'bench{i}') for i in range(keys)]
+        post, get = factory.post(path), factory.get(path)
+        # Маршрут определяет обработчик Django до middleware.process_view, в замер он не входит
+        post.resolver_match = get.resolver_match = resolve(path)
+
+        def request_for(template, i):
+            template.user = users[i % keys]
+            template.META['REMOTE_ADDR'] = f'10.0.{i % keys // 256}.{i % 256}'
+            return template
+
+        def view(request):
+            return HttpResponse()
+
+        def handle(middleware, request):
+            # То же, что делает обработчик Django: process_view, затем представление
+            return middleware.process_view(request, view, (), {}) or view(request)
+
+        baseline = self._time(lambda i: view(request_for(post, i)), iterations)
+        self._row('без middleware', baseline)
+        for name in STORES:
+            with override_settings(ADS_RATE_LIMITS=limits, ADS_RATE_LIMIT_STORE=name):
+                middleware = RateLimitMiddleware(view)
+                label = name.rsplit('.', 1)[1]
+                self._row(f'middleware, POST, {label} (+{{:.2f}})', self._time(
+                    lambda i: handle(middleware, request_for(post, i)), iterations), baseline)
+                self._row(f'middleware, GET (+{{:.2f}})', self._time(
+                    lambda i: handle(middleware, request_for(get, i)), iterations), baseline)
+        self.stdout.write(self.style.SUCCESS('Готово'))
+
+    @staticmethod
+    def _time(call, iterations):
+        started = time.perf_counter()
+        for i in range(iterations):
+            call(i)
+        return (time.perf_counter() - started) / iterations * 1e6
+
+    def _row(self, label, micros, baseline=None):
+        if baseline is not None:
+            label = label.format(micros - baseline)
+        self.stdout.write(f'{label:<44} {micros:>12.2f}')
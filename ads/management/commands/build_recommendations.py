@@ -0,0 +1,40 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from ads.models import Ad
+from ads.recommendations import RecommendationEngine
+
+
+class Command(BaseCommand):
+    help = ('Строит индекс рекомендаций (TF-IDF-векторы объявлений) в ADS_RECOMMENDATIONS_DIR; '
+            'процессы сайта подхватывают его без перестройки.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Показать рекомендации пользователю')
+        parser.add_argument('--limit', type=int, default=10, help='Сколько рекомендаций вывести')
+
+    def handle(self, *args, **options):
+        engine = RecommendationEngine()
+        if not engine.available:
+            raise CommandError('Для рекомендаций нужен пакет numpy')
+        started = time.perf_counter()
+        index = engine.rebuild()
+        built = time.perf_counter()
+        self.stdout.write(self.style.SUCCESS(
+            f'Индекс: {len(index.ad_ids)} объявлений, {len(index.cols)} ненулевых весов, '
+            f'построен за {built - started:.2f} с'
+        ))
+
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"Пользователь {options['user']!r} не найден")
+            ids = engine.recommend(user, limit=options['limit'])
+            self.stdout.write(f'Рекомендации за {time.perf_counter() - built:.3f} с:')
+            ads = Ad.objects.select_related('user').in_bulk(ids)
+            for ad_id in ids:
+                if ad_id in ads:
+                    self.stdout.write(f'  {ads[ad_id]}')
@@ -0,0 +1,54 @@
+import csv
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from ads.models import Ad
+
+COLUMNS = ['id', 'username', 'title', 'description', 'image_url', 'category', 'condition', 'created_at']
+FIELDS = ['id', 'user__username', 'title', 'description', 'image_url', 'category', 'condition', 'created_at']
+
+
+class Command(BaseCommand):
+    help = ('Выгружает объявления в CSV или NDJSON с постоянным расходом памяти: строки читаются '
+            'серверным курсором через iterator(chunk_size=...). Формат совместим с import_ads.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help='Путь к файлу или «-» для stdout')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Строк на одну выборку из курсора')
+        parser.add_argument('--user', help='Только объявления пользователя')
+        parser.add_argument('--category', choices=[value for value, _ in Ad.CATEGORIES])
+
+    def handle(self, *args, **options):
+        queryset = Ad.objects.visible().order_by('pk')
+        if options['user']:
+            queryset = queryset.filter(user__username=options['user'])
+        if options['category']:
+            queryset = queryset.filter(category=options['category'])
+        rows = queryset.values_list(*FIELDS).iterator(chunk_size=options['chunk_size'])
+
+        started = time.monotonic()
+        # OutputWrapper дописывает перевод строки только если его нет, строки csv и NDJSON уже заканчиваются им
+        output = self.stdout if options['output'] == '-' else open(options['output'], 'w', encoding='utf-8', newline='')
+        try:
+            if options['format'] == 'csv':
+                writer = csv.writer(output)
+                writer.writerow(COLUMNS)
+                count = 0
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                count = 0
+                for row in rows:
+                    output.write(json.dumps(dict(zip(COLUMNS, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+                    count += 1
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+        elapsed = time.monotonic() - started
+        self.stderr.write(f'Выгружено {count} объявлений за {elapsed:.2f} с ({count / elapsed if elapsed else 0:.0f} строк/с)')
@@ -0,0 +1,55 @@
+import time
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from ads.matching import MatchingEngine, get_max_length, load_cycles
+
+
+class Command(BaseCommand):
+    help = ('Ищет цепочки обмена (A→B→…→A) по ожидающим предложениям и печатает их '
+            'вместе со временем построения графа и поиска. Построенный граф сохраняется в ADS_MATCHING_DIR '
+            'для процессов сайта.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-length', type=int, default=None, help='Максимум участников в цепочке')
+        parser.add_argument('--user', help='Только цепочки с объявлениями пользователя')
+        parser.add_argument('--limit', type=int, default=50, help='Сколько цепочек вывести')
+        parser.add_argument('--stats', action='store_true', help='Только статистика, без списка цепочек')
+
+    def handle(self, *args, **options):
+        max_length = options['max_length'] or get_max_length()
+        if max_length < 2:
+            raise CommandError('Цепочка состоит минимум из двух предложений')
+
+        engine = MatchingEngine()
+        started = time.perf_counter()
+        engine.rebuild()
+        graph = engine.graph
+        built = time.perf_counter()
+        self.stdout.write(
+            f'Граф: {len(graph.ad_ids)} объявлений, {graph.edge_count} предложений, '
+            f'построен за {built - started:.2f} с'
+        )
+
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"Пользователь {options['user']!r} не найден")
+            cycles = engine.cycles_for_user(user, max_length, limit=options['limit'])
+        else:
+            user = None
+            cycles = graph.all_cycles(max_length, limit=None if options['stats'] else options['limit'])
+        searched = time.perf_counter()
+
+        lengths = Counter(len(cycle) for cycle in cycles)
+        summary = ', '.join(f'{length}: {count}' for length, count in sorted(lengths.items())) or 'нет'
+        self.stdout.write(f'Цепочек: {len(cycles)} (по числу участников — {summary}), поиск {searched - built:.2f} с')
+        if options['stats']:
+            return
+
+        for steps in load_cycles(cycles, user=user):
+            chain = ' → '.join(f'{step.ad_sender.user.username} «{step.ad_sender.title}»' for step in steps)
+            self.stdout.write(f'  {chain} → {steps[0].ad_sender.user.username}')
@@ -0,0 +1,140 @@
+import csv
+import json
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ads.cache import invalidate_feed
+from ads.forms import AdForm
+from ads.images import url_version
+from ads.models import Ad
+from ads.search import get_search_backend
+from ads.tasks import enqueue, prefetch_image
+
+
+class Command(BaseCommand):
+    help = ('Импортирует объявления из CSV или NDJSON потоком. Строки проверяются правилами AdForm, '
+            'автор задаётся колонкой username, запись идёт пакетами через bulk_create.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу или «-» для stdin')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help='Формат; по умолчанию по расширению файла')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк в одной транзакции')
+        parser.add_argument('--max-errors', type=int, default=100, help='Остановиться после стольких ошибок')
+        parser.add_argument('--dry-run', action='store_true', help='Только проверить строки, ничего не записывать')
+
+    def handle(self, *args, **options):
+        input_format = options['format'] or ('ndjson' if options['path'].endswith(('.ndjson', '.jsonl')) else 'csv')
+        self.batch_size = options['batch_size']
+        self.dry_run = options['dry_run']
+        self.user_ids = {}
+        self.search = get_search_backend()
+        self.imported = 0
+        self.max_errors = options['max_errors']
+        errors = 0
+
+        started = time.monotonic()
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8', newline='')
+        try:
+            batch = []
+            for line_number, row in self._rows(stream, input_format):
+                if isinstance(row, str):
+                    # Строка не разобралась в объект: это ошибка строки, а не всего импорта
+                    errors += 1
+                    self.stderr.write(f'Строка {line_number}: {row}')
+                    self._check_errors(errors)
+                    continue
+                form = AdForm(data=row)
+                if not form.is_valid() or not row.get('username'):
+                    errors += 1
+                    reason = form.errors.as_json() if form.errors else '{"username": "обязательное поле"}'
+                    self.stderr.write(f'Строка {line_number}: {reason}')
+                    self._check_errors(errors)
+                    continue
+                batch.append((line_number, row['username'], form.cleaned_data))
+                if len(batch) >= self.batch_size:
+                    errors += self._flush(batch)
+                    self._check_errors(errors)
+                    batch = []
+                    self._progress(started)
+            errors += self._flush(batch)
+            self._check_errors(errors)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if self.imported and not self.dry_run:
+                invalidate_feed()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Импортировано {self.imported} объявлений, ошибок {errors}, '
+            f'{elapsed:.2f} с ({self.imported / elapsed if elapsed else 0:.0f} строк/с)'
+        ))
+
+    def _check_errors(self, errors):
+        """Останавливает импорт, когда ошибок — в строках или при записи пакета — набралось ``--max-errors``"""
+        if errors >= self.max_errors:
+            raise CommandError(f'Превышено число ошибок ({errors}), импорт остановлен')
+
+    def _rows(self, stream, input_format):
+        """Построчно читает вход, возвращает (номер строки, словарь полей или описание ошибки строки)"""
+        if input_format == 'csv':
+            reader = csv.DictReader(stream)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield line_number, f'некорректный JSON ({error})'
+                continue
+            if not isinstance(row, dict):
+                yield line_number, f'ожидается объект JSON, получено {type(row).__name__}'
+                continue
+            yield line_number, row
+
+    def _resolve_users(self, usernames):
+        """Находит id авторов одним запросом на пакет, с кэшем между пакетами"""
+        missing = set(usernames) - set(self.user_ids)
+        if missing:
+            found = dict(User.objects.filter(username__in=missing).values_list('username', 'id'))
+            for username in missing:
+                self.user_ids[username] = found.get(username)
+
+    def _flush(self, batch):
+        """Записывает пакет в одной транзакции, возвращает число ошибок"""
+        if not batch:
+            return 0
+        self._resolve_users(username for _, username, _ in batch)
+        ads, errors = [], 0
+        for line_number, username, data in batch:
+            user_id = self.user_ids[username]
+            if user_id is None:
+                errors += 1
+                self.stderr.write(f'Строка {line_number}: пользователь {username!r} не найден')
+                continue
+            ads.append(Ad(user_id=user_id, **data))
+        if self.dry_run:
+            self.imported += len(ads)
+            return errors
+        with transaction.atomic():
+            created = Ad.objects.bulk_create(ads)
+            # bulk_create не отправляет post_save, поэтому индекс обновляется пакетом
+            self.search.index_many(created)
+        # post_save не было и для миниатюр: задачи ставятся после записи пакета, одна на изображение
+        if getattr(settings, 'ADS_IMAGE_PREFETCH', True):
+            for url in dict.fromkeys(ad.image_url for ad in created if ad.image_url):
+                enqueue(prefetch_image, url, key=f'image:{url_version(url)}')
+        self.imported += len(created)
+        return errors
+
+    def _progress(self, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'  {self.imported} строк, {self.imported / elapsed if elapsed else 0:.0f} строк/с')
@@ -0,0 +1,110 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import quote, urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест запущенных серверов при фиксированной конкурентности: '
+            'запросы в секунду и перцентили задержки (p50/p95/p99). '
+            'Пример: loadtest --target wsgi=http://127.0.0.1:8000/ --target asgi=http://127.0.0.1:8001/')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True,
+                            help='Метка и URL в виде name=url; можно указать несколько раз')
+        parser.add_argument('--concurrency', type=int, default=50, help='Число одновременных соединений')
+        parser.add_argument('--requests', type=int, default=2000, help='Число запросов на цель')
+        parser.add_argument('--warmup', type=int, default=100, help='Запросы прогрева, не входят в результат')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, sep, url = target.partition('=')
+            if not sep or not url.startswith('http://'):
+                raise CommandError(f'Неверная цель {target!r}: ожидается name=http://host:port/path')
+            targets.append((name, url))
+
+        self.stdout.write(f"{'цель':<10} {'запр/с':>10} {'p50, мс':>10} {'p95, мс':>10} {'p99, мс':>10} {'ошибки':>8}")
+        for name, url in targets:
+            asyncio.run(_run(url, options['warmup'], options['concurrency']))
+            started = time.perf_counter()
+            latencies, errors = asyncio.run(_run(url, options['requests'], options['concurrency']))
+            elapsed = time.perf_counter() - started
+            if not latencies:
+                raise CommandError(f'{name}: ни один запрос не выполнен успешно')
+            p = _percentiles(latencies)
+            self.stdout.write(
+                f'{name:<10} {len(latencies) / elapsed:>10.1f} {p[50]:>10.2f} {p[95]:>10.2f} {p[99]:>10.2f} {errors:>8}'
+            )
+
+
+def _percentiles(latencies):
+    cuts = statistics.quantiles([value * 1000 for value in latencies], n=100, method='inclusive')
+    return {50: cuts[49], 95: cuts[94], 99: cuts[98]}
+
+
+async def _run(url, total, concurrency):
+    """Выполняет total запросов через concurrency keep-alive соединений"""
+    parts = urlsplit(url)
+    path = quote(parts.path or '/') + (f"?{quote(parts.query, safe='=&')}" if parts.query else '')
+    request = (
+        f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: keep-alive\r\n\r\n'
+    ).encode()
+    remaining = [total]
+    latencies, errors = [], [0]
+
+    async def worker():
+        reader = writer = None
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+                writer.write(request)
+                status, keep_alive = await _read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors[0] += 1
+                writer = _close(writer)
+                continue
+            if status >= 400:
+                errors[0] += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+            if not keep_alive:
+                writer = _close(writer)
+        _close(writer)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors[0]
+
+
+async def _read_response(reader):
+    """Читает ответ HTTP/1.1 целиком, возвращает (статус, keep-alive)"""
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers.get('connection', '').lower() != 'close'
+
+
+def _close(writer):
+    if writer is not None:
+        writer.close()
+    return None
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает счётчики предложений (по объявлениям и пользователям) '
+            'и сообщает о расхождениях. Запускается после массовых загрузок и по расписанию.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        report = reconcile_counters(fix=not options['dry_run'], batch_size=options['batch_size'])
+        self.stdout.write(f"{'счётчик':<28} {'строк':>8} {'расхождение':>12}")
+        for counter, (rows, drift) in report.items():
+            self.stdout.write(f'{counter:<28} {rows:>8} {drift:>12}')
+        drifted = sum(rows for rows, _ in report.values())
+        action = 'найдено' if options['dry_run'] else 'исправлено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} расхождений: {drifted}, {time.monotonic() - started:.2f} с'
+        ))
@@ -0,0 +1,116 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ads import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Прогоняет все маршруты ads/urls.py через тестовый клиент и пишет JSON-отчёт: задержка p50/p95, '
+            'SQL-запросы и пик памяти. С --baseline сравнивает с сохранённым отчётом, с --profile — текущие '
+            'настройки с настройками другого профиля, по одной и все вместе.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Замеров на сценарий')
+        parser.add_argument('--warmup', type=int, default=2, help='Прогревочных запросов на сценарий')
+        parser.add_argument('--only', action='append', help='Только указанные сценарии (можно несколько раз)')
+        parser.add_argument('--output', help='Куда сохранить JSON-отчёт')
+        parser.add_argument('--baseline', help='Эталонный отчёт для сравнения')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Допустимый рост времени и памяти, доля')
+        parser.add_argument('--no-memory', action='store_true', help='Не замерять память (tracemalloc)')
+        parser.add_argument('--with-cache', action='store_true', help='Не отключать кэш ленты')
+        parser.add_argument('--fail-on-regression', action='store_true', help='Код выхода 1 при регрессии')
+        parser.add_argument('--profile', help='Модуль настроек для сравнения, например bartersystem.production_settings')
+
+    def handle(self, *args, **options):
+        scenarios = benchmark.SCENARIOS
+        if options['only']:
+            known = {scenario.name for scenario in scenarios}
+            unknown = set(options['only']) - known
+            if unknown:
+                raise CommandError(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['only']]
+        missing = benchmark.uncovered_url_names()
+        if missing:
+            self.stderr.write(f"Маршруты без сценария: {', '.join(missing)}")
+
+        if options['profile']:
+            return self.handle_profile(scenarios, options)
+        self.print_header()
+        try:
+            report = benchmark.run(
+                scenarios, repeat=options['repeat'], warmup=options['warmup'],
+                trace_memory=not options['no_memory'], use_cache=options['with_cache'], progress=self.print_result,
+            )
+        except LookupError as error:
+            raise CommandError(str(error))
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as handle:
+                json.dump(report, handle, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Отчёт сохранён в {options['output']}")
+
+        failed = [name for name, result in report['results'].items() if not result['ok']]
+        if failed:
+            self.stderr.write(f"Неожиданный код ответа: {', '.join(failed)}")
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as handle:
+                baseline = json.load(handle)
+            regressions = self.print_comparison(benchmark.compare(report, baseline, tolerance=options['tolerance']))
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'Регрессий: {regressions}')
+
+    def handle_profile(self, scenarios, options):
+        try:
+            report = benchmark.run_profile(
+                options['profile'], scenarios, repeat=options['repeat'], warmup=options['warmup'],
+                trace_memory=not options['no_memory'], use_cache=options['with_cache'], progress=self.print_variant_result,
+            )
+        except (ImportError, LookupError) as error:
+            raise CommandError(str(error))
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as handle:
+                json.dump(report, handle, ensure_ascii=False, indent=2)
+            self.stdout.write(f"Отчёт сохранён в {options['output']}")
+
+        self.stdout.write(self.style.MIGRATE_HEADING('\nИтог по всем сценариям'))
+        self.stdout.write(f"{'вариант':<32} {'Σ p50, мс':>10} {'изменение':>10} {'SQL':>6} {'ответы, КБ':>11}")
+        current = benchmark.summarize(report['variants']['current'])
+        for label, variant in report['variants'].items():
+            total = benchmark.summarize(variant)
+            change = f"{(total['p50_ms'] - current['p50_ms']) / current['p50_ms']:+.0%}" if current['p50_ms'] else '—'
+            self.stdout.write(f"{label:<32} {total['p50_ms']:>10.1f} {change:>10} {total['queries']:>6} "
+                              f"{total['response_kb']:>11.1f}")
+
+    def print_variant_result(self, label, name, result):
+        if label != getattr(self, 'variant', None):
+            self.variant = label
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{label}'))
+            self.print_header()
+        self.print_result(name, result)
+
+    def print_header(self):
+        self.stdout.write(f"{'сценарий':<24} {'код':>4} {'p50, мс':>9} {'p95, мс':>9} {'SQL':>5} {'SQL, мс':>9} "
+                          f"{'память, КБ':>11} {'ответ, КБ':>10}")
+
+    def print_result(self, name, result):
+        memory = result.get('peak_memory_kb', '—')
+        line = (f"{name:<24} {result['status']:>4} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                f"{result['queries']:>5} {result['db_ms']:>9.2f} {memory:>11} {result['response_kb']:>10}")
+        self.stdout.write(line if result['ok'] else self.style.ERROR(line))
+
+    def print_comparison(self, rows):
+        self.stdout.write(self.style.MIGRATE_HEADING('\nСравнение с эталоном'))
+        regressions = 0
+        for name, metric, before, after, regression in rows:
+            if before == after:
+                continue
+            change = f'{(after - before) / before:+.0%}' if before else 'новое'
+            line = f'  {name:<24} {metric:<15} {before:>10} → {after:<10} {change}'
+            if regression:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line + '  регрессия'))
+            else:
+                self.stdout.write(line)
+        self.stdout.write(f'Регрессий: {regressions}')
+        return regressions
@@ -0,0 +1,53 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ads.tasks import Worker, queue_metrics
+
+
+class Command(BaseCommand):
+    help = ('Выполняет фоновые задачи из очереди (поисковый индекс, миниатюры) '
+            'в пуле потоков или процессов до SIGTERM/SIGINT.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='Размер пула')
+        parser.add_argument('--processes', action='store_true', help='Пул процессов вместо потоков')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Пауза при пустой очереди, секунды')
+        parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и выйти')
+        parser.add_argument('--stats', action='store_true', help='Только метрики очереди')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.print_metrics()
+            return
+        if options['concurrency'] < 1:
+            raise CommandError('Размер пула должен быть положительным')
+
+        if options['verbosity'] > 1:
+            logging.getLogger('ads.tasks').setLevel(logging.INFO)
+        worker = Worker(
+            concurrency=options['concurrency'],
+            processes=options['processes'],
+            poll_interval=options['poll_interval'],
+        )
+        if not options['once']:
+            worker.install_signal_handlers()
+            pool = 'процессов' if options['processes'] else 'потоков'
+            self.stdout.write(f'Воркер {worker.worker_id}: пул из {options["concurrency"]} {pool}')
+        processed = worker.run(once=options['once'])
+        self.stdout.write(f'Выполнено задач: {processed}')
+
+    def print_metrics(self):
+        metrics = queue_metrics()
+        depth = metrics['depth']
+        self.stdout.write(
+            f"В очереди: {depth['queued']} (готовы: {metrics['ready']}), "
+            f"выполняются: {depth['running']}, с ошибкой: {depth['failed']}"
+        )
+        self.stdout.write(f"Старейшая готовая задача ждёт {metrics['oldest_ready_age']:.1f} с")
+        if metrics['done']:
+            self.stdout.write(
+                f"За 15 минут выполнено {metrics['done']}, задержка p50/p95: "
+                f"{metrics['latency_p50']:.2f}/{metrics['latency_p95']:.2f} с, "
+                f"выполнение p50/p95: {metrics['runtime_p50']:.2f}/{metrics['runtime_p95']:.2f} с"
+            )
@@ -0,0 +1,52 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ads.models import Ad
+from ads.search import get_search_backend
+from ads.seeding import seed_dataset
+
+
+class Command(BaseCommand):
+    help = ('Заполняет базу синтетическими пользователями, объявлениями и предложениями для run_benchmark. '
+            'Данные детерминированы зерном, вставка пакетами; по умолчанию распределение активности по Ципфу.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--ads', type=int, default=1000000)
+        parser.add_argument('--proposals', type=int, default=2000000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skew', type=float, default=1.0, help='Показатель Ципфа, 0 — равномерно')
+        parser.add_argument('--days', type=int, default=365, help='За сколько дней раскидать даты')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='bench', help='Префикс имён пользователей')
+        parser.add_argument('--no-index', action='store_true', help='Не строить поисковый индекс')
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}_').exists():
+            raise CommandError(f'Пользователи с префиксом {prefix!r} уже есть: укажите другой --prefix или чистую базу')
+
+        started = time.perf_counter()
+        counts = seed_dataset(
+            users=options['users'], ads=options['ads'], proposals=options['proposals'], seed=options['seed'],
+            batch_size=options['batch_size'], prefix=prefix, days=options['days'], skew=options['skew'],
+        )
+        elapsed = time.perf_counter() - started
+        rows = sum(counts.values())
+        self.stdout.write(
+            f"Пользователей: {counts['users']}, объявлений: {counts['ads']}, предложений: {counts['proposals']} "
+            f"за {elapsed:.1f} с ({rows / elapsed:.0f} строк/с)"
+        )
+
+        if not options['no_index']:
+            started = time.perf_counter()
+            total = get_search_backend().rebuild(Ad.objects.all(), batch_size=options['batch_size'])
+            self.stdout.write(f'Поисковый индекс: {total} объявлений за {time.perf_counter() - started:.1f} с')
+
+        # Свежая статистика планировщика, иначе первые замеры идут по старым оценкам
+        with connection.cursor() as cursor:
+            if connection.vendor in ('postgresql', 'sqlite'):
+                cursor.execute('ANALYZE')
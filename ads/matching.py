@@ -0,0 +1,491 @@
+"""Поиск цепочек обмена между несколькими участниками.
+
+Граф «хочу/отдаю» строится по ожидающим предложениям: вершина — объявление,
+ребро ``ad_sender → ad_receiver`` означает, что владелец ``ad_sender`` готов
+отдать его за ``ad_receiver``. Любой простой цикл с разными владельцами —
+выполнимый обмен: каждый участник получает то, что хотел, и отдаёт то, что
+предлагал (A→B — двусторонний обмен, A→B→C→A — трёхсторонний и т.д.).
+
+Граф хранится в компактных массивах (``array``, формат CSR), поэтому сотни
+тысяч предложений занимают единицы мегабайт. Полную перестройку выполняет
+фоновая задача ``build_trade_graph`` (или ``find_trade_cycles``): граф
+пишется в ``ADS_MATCHING_DIR``, процессы сайта открывают готовые массивы
+и догружают предложения новее снимка. Запрос пользователя граф не строит:
+пока снимка нет, цепочек нет, а устаревший снимок служит, пока задача
+строит новый (раз в ``ADS_MATCHING_REBUILD_INTERVAL`` секунд). Новые
+предложения добавляются инкрементально через сигналы и догрузку по
+возрастанию id. Найденные цепочки перед показом проверяются по базе (см.
+``load_cycles``), так что устаревший граф — например, с предложениями,
+решёнными после снимка, — не приводит к неверным предложениям.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from pathlib import Path
+
+from django.conf import settings
+
+from .models import Ad, ExchangeProposal
+
+EDGE_FIELDS = ('id', 'ad_sender_id', 'ad_receiver_id', 'ad_sender__user_id', 'ad_receiver__user_id')
+
+
+def get_max_length():
+    return getattr(settings, 'ADS_MATCHING_MAX_LENGTH', 4)
+
+
+def get_root():
+    return Path(getattr(settings, 'ADS_MATCHING_DIR', os.path.join(tempfile.gettempdir(), 'bartersystem-matching')))
+
+
+class TradeGraph:
+    """Ориентированный граф объявлений в массивах смежности (CSR)"""
+
+    # Доля изменений, после которой дельта сливается в основные массивы
+    COMPACT_RATIO = 0.25
+
+    def __init__(self):
+        self.index = {}                 # id объявления → номер вершины
+        self.ad_ids = array('q')        # номер вершины → id объявления
+        self.owners = array('q')        # номер вершины → id владельца
+        self.offsets = array('q', [0])  # рёбра вершины v: targets[offsets[v]:offsets[v + 1]]
+        self.targets = array('q')
+        self.proposals = array('q')     # id предложения для каждого ребра
+        self.added = {}                 # вершина → [(цель, id предложения)], ещё не в CSR
+        self.added_count = 0
+        self.removed = set()            # id предложений, исключённых из графа
+        self.closed = set()             # вершины, все рёбра которых исключены
+
+    @classmethod
+    def build(cls, edges):
+        """Строит граф из кортежей EDGE_FIELDS сортировкой подсчётом"""
+        graph = cls()
+        sources, targets, proposals = array('q'), array('q'), array('q')
+        for proposal_id, sender, receiver, sender_owner, receiver_owner in edges:
+            sources.append(graph._node(sender, sender_owner))
+            targets.append(graph._node(receiver, receiver_owner))
+            proposals.append(proposal_id)
+        graph._fill(sources, targets, proposals)
+        return graph
+
+    ARRAYS = ('ad_ids', 'owners', 'offsets', 'targets', 'proposals')
+
+    def save(self, path):
+        """Пишет массивы CSR; дельта сначала сливается в них"""
+        self.compact()
+        for name in self.ARRAYS:
+            with open(path / f'{name}.bin', 'wb') as handle:
+                getattr(self, name).tofile(handle)
+
+    @classmethod
+    def load(cls, path):
+        graph = cls()
+        for name in cls.ARRAYS:
+            values = array('q')
+            with open(path / f'{name}.bin', 'rb') as handle:
+                values.fromfile(handle, os.fstat(handle.fileno()).st_size // values.itemsize)
+            setattr(graph, name, values)
+        graph.index = {ad_id: node for node, ad_id in enumerate(graph.ad_ids)}
+        return graph
+
+    def _node(self, ad_id, owner_id):
+        node = self.index.get(ad_id)
+        if node is None:
+            node = self.index[ad_id] = len(self.ad_ids)
+            self.ad_ids.append(ad_id)
+            self.owners.append(owner_id)
+        return node
+
+    def _fill(self, sources, targets, proposals):
+        size = len(self.ad_ids)
+        offsets = array('q', bytes(8 * (size + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for node in range(size):
+            offsets[node + 1] += offsets[node]
+        position = array('q', offsets[:size])
+        self.targets = array('q', bytes(8 * len(sources)))
+        self.proposals = array('q', bytes(8 * len(sources)))
+        for source, target, proposal_id in zip(sources, targets, proposals):
+            slot = position[source]
+            self.targets[slot] = target
+            self.proposals[slot] = proposal_id
+            position[source] += 1
+        self.offsets = offsets
+
+    def add_edge(self, proposal_id, sender, receiver, sender_owner, receiver_owner):
+        if self.index.get(sender) in self.closed or self.index.get(receiver) in self.closed:
+            # Закрытая вершина снова получает рёбра: старые сначала удаляются слиянием
+            self.compact()
+        source = self._node(sender, sender_owner)
+        target = self._node(receiver, receiver_owner)
+        self.added.setdefault(source, []).append((target, proposal_id))
+        self.added_count += 1
+        self._maybe_compact()
+
+    def remove_proposal(self, proposal_id):
+        self.removed.add(proposal_id)
+        self._maybe_compact()
+
+    def close_ad(self, ad_id):
+        """Исключает все рёбра объявления, например после принятого обмена"""
+        node = self.index.get(ad_id)
+        if node is not None:
+            self.closed.add(node)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        changes = self.added_count + len(self.removed) + len(self.closed)
+        if changes > max(1024, self.COMPACT_RATIO * len(self.targets)):
+            self.compact()
+
+    def compact(self):
+        """Сливает добавленные и удалённые рёбра в массивы CSR"""
+        sources, targets, proposals = array('q'), array('q'), array('q')
+        for node in range(len(self.ad_ids)):
+            for target, proposal_id in self.successors(node):
+                sources.append(node)
+                targets.append(target)
+                proposals.append(proposal_id)
+        self.added, self.added_count, self.removed, self.closed = {}, 0, set(), set()
+        self._fill(sources, targets, proposals)
+
+    @property
+    def edge_count(self):
+        if not (self.added or self.removed or self.closed):
+            return len(self.targets)
+        return sum(len(self.successors(node)) for node in range(len(self.ad_ids)))
+
+    def successors(self, node):
+        """Исходящие рёбра вершины: список пар (цель, id предложения)"""
+        edges = []
+        if node in self.closed:
+            return edges
+        if node + 1 < len(self.offsets):
+            start, end = self.offsets[node], self.offsets[node + 1]
+            if start != end:
+                edges = list(zip(self.targets[start:end], self.proposals[start:end]))
+        if node in self.added:
+            edges += self.added[node]
+        if self.removed:
+            edges = [edge for edge in edges if edge[1] not in self.removed]
+        if self.closed:
+            edges = [edge for edge in edges if edge[0] not in self.closed]
+        return edges
+
+    def cycles_through_ad(self, ad_id, max_length=None, limit=None):
+        """Цепочки, в которых участвует объявление"""
+        node = self.index.get(ad_id)
+        if node is None:
+            return []
+        return self._search(node, self.successors(node), max_length or get_max_length(), limit)
+
+    def cycles_through_proposal(self, proposal_id, sender, receiver, max_length=None, limit=None):
+        """Цепочки, которые замыкает предложение sender → receiver"""
+        source, target = self.index.get(sender), self.index.get(receiver)
+        if (source is None or target is None or proposal_id in self.removed
+                or source in self.closed or target in self.closed):
+            return []
+        return self._search(source, [(target, proposal_id)], max_length or get_max_length(), limit)
+
+    def all_cycles(self, max_length=None, limit=None):
+        """Все цепочки длины до max_length, каждая ровно один раз.
+
+        Сначала отбрасываются вершины без входящих или исходящих рёбер (в цикл
+        они попасть не могут), затем цикл ищется от своей наименьшей вершины.
+        Последний шаг проверяется по обратным рёбрам, а не обходом соседей.
+        """
+        max_length = max_length or get_max_length()
+        alive, predecessors = self._cyclic_nodes()
+        found = []
+        for node in range(len(self.ad_ids)):
+            if not alive[node]:
+                continue
+            closing = {}
+            for source, proposal_id in predecessors.get(node, ()):
+                if source > node:
+                    closing.setdefault(source, []).append(proposal_id)
+            cycles = self._search(node, self.successors(node), max_length,
+                                  None if limit is None else limit - len(found),
+                                  min_node=node, alive=alive, closing=closing)
+            found.extend(cycles)
+            if limit is not None and len(found) >= limit:
+                break
+        return found
+
+    def _cyclic_nodes(self):
+        """Вершины, которые могут лежать на цикле, и обратные рёбра графа"""
+        size = len(self.ad_ids)
+        in_degree, out_degree = array('q', bytes(8 * size)), array('q', bytes(8 * size))
+        predecessors = {}
+        for node in range(size):
+            for target, proposal_id in self.successors(node):
+                out_degree[node] += 1
+                in_degree[target] += 1
+                predecessors.setdefault(target, []).append((node, proposal_id))
+        alive = bytearray(b'\x01') * size
+        stack = [node for node in range(size) if not in_degree[node] or not out_degree[node]]
+        while stack:
+            node = stack.pop()
+            if not alive[node]:
+                continue
+            alive[node] = 0
+            for target, _ in self.successors(node):
+                in_degree[target] -= 1
+                if alive[target] and not in_degree[target]:
+                    stack.append(target)
+            for source, _ in predecessors.get(node, ()):
+                out_degree[source] -= 1
+                if alive[source] and not out_degree[source]:
+                    stack.append(source)
+        return alive, predecessors
+
+    def _search(self, start, first_edges, max_length, limit, min_node=None, alive=None, closing=None):
+        """Обход в глубину от start с ограничением длины; владельцы в цепочке различны.
+
+        ``closing`` — рёбра в start по вершинам-источникам: если задан,
+        предпоследняя вершина цепочки замыкается по нему без обхода соседей.
+        """
+        found = []
+        owners = self.owners
+        path_nodes = {start}
+        path_owners = {owners[start]}
+        path = []
+
+        def visit(node):
+            for target, proposal_id in (first_edges if not path else self.successors(node)):
+                if limit is not None and len(found) >= limit:
+                    return
+                if target == start:
+                    if path:
+                        found.append(tuple(path) + (proposal_id,))
+                    continue
+                if (len(path) + 1 >= max_length or target in path_nodes
+                        or owners[target] in path_owners
+                        or (min_node is not None and target < min_node)
+                        or (alive is not None and not alive[target])):
+                    continue
+                path.append(proposal_id)
+                if closing is not None and len(path) + 1 == max_length:
+                    for closing_id in closing.get(target, ()):
+                        found.append(tuple(path) + (closing_id,))
+                else:
+                    path_nodes.add(target)
+                    path_owners.add(owners[target])
+                    visit(target)
+                    path_nodes.discard(target)
+                    path_owners.discard(owners[target])
+                path.pop()
+
+        visit(start)
+        return found[:limit] if limit is not None else found
+
+
+class MatchingEngine:
+    """Граф процесса: загрузка снимка с диска, догрузка новых предложений, перестройка фоновой задачей"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.graph = None
+            self.watermark = 0
+            self.local = set()  # предложения, добавленные сигналами после последней догрузки
+            self.built_at = 0.0
+            self.refreshed_at = self.requested_at = 0.0
+
+    def _expired(self):
+        return time.time() - self.built_at >= getattr(settings, 'ADS_MATCHING_REBUILD_INTERVAL', 600)
+
+    def get_graph(self):
+        """Граф процесса или None, пока фоновая задача не построила первый снимок"""
+        with self.lock:
+            if self.graph is None or self._expired():
+                self.load()
+            if self.graph is not None and (
+                    time.monotonic() - self.refreshed_at >= getattr(settings, 'ADS_MATCHING_REFRESH_INTERVAL', 5)):
+                self.refresh()
+            stale = self.graph is None or self._expired()
+        if stale and self.request_rebuild():
+            # ADS_TASKS_EAGER: задача уже выполнена, снимок на диске
+            with self.lock:
+                self.load()
+        return self.graph
+
+    def request_rebuild(self):
+        """Ставит перестройку в очередь (не чаще раза в ``ADS_MATCHING_REFRESH_INTERVAL``); True — уже выполнена"""
+        from .tasks import build_trade_graph, enqueue, is_eager
+
+        now = time.monotonic()
+        with self.lock:
+            if self.requested_at and now - self.requested_at < getattr(settings, 'ADS_MATCHING_REFRESH_INTERVAL', 5):
+                return False
+            self.requested_at = now
+        # Ключ не даёт процессам сайта поставить больше одной перестройки
+        enqueue(build_trade_graph, key='matching:rebuild')
+        return is_eager()
+
+    def load(self):
+        """Открывает снимок на диске, если он новее графа процесса"""
+        try:
+            path = get_root() / (get_root() / 'CURRENT').read_text()
+            meta = json.loads((path / 'meta.json').read_text())
+            if meta['built_at'] <= self.built_at:
+                return False
+            graph = TradeGraph.load(path)
+        except (OSError, ValueError, KeyError):
+            return False
+        with self.lock:
+            self.graph = graph
+            self.watermark = meta['watermark']
+            self.local = set()
+            self.built_at = meta['built_at']
+            self.refresh()
+        return True
+
+    def rebuild(self):
+        """Загружает все ожидающие предложения одним потоковым запросом и сохраняет снимок на диск.
+
+        Выполняется задачей ``build_trade_graph`` и командой ``find_trade_cycles``,
+        не в запросе пользователя; блокировка берётся только на подмену графа.
+        """
+        watermark = 0
+        edges = _pending().values_list(*EDGE_FIELDS).order_by().iterator(chunk_size=5000)
+
+        def tracked():
+            nonlocal watermark
+            for edge in edges:
+                watermark = max(watermark, edge[0])
+                yield edge
+        graph = TradeGraph.build(tracked())
+        built_at = time.time()
+        self.save(graph, watermark, built_at)
+        with self.lock:
+            self.graph, self.watermark, self.local = graph, watermark, set()
+            self.built_at, self.refreshed_at = built_at, time.monotonic()
+        return graph
+
+    @staticmethod
+    def save(graph, watermark, built_at):
+        """Пишет снимок в новый каталог и атомарно переключает на него ``CURRENT``"""
+        root = get_root()
+        root.mkdir(parents=True, exist_ok=True)
+        path = Path(tempfile.mkdtemp(prefix='graph-', dir=root))
+        graph.save(path)
+        (path / 'meta.json').write_text(json.dumps({'built_at': built_at, 'watermark': watermark}))
+        pointer = root / f'CURRENT.{os.getpid()}'
+        pointer.write_text(path.name)
+        os.replace(pointer, root / 'CURRENT')
+        # Старые снимки удаляются; минута запаса — процессу, который как раз читает один из них
+        for old in root.glob('graph-*'):
+            if old != path and time.time() - old.stat().st_mtime > 60:
+                shutil.rmtree(old, ignore_errors=True)
+
+    def refresh(self):
+        """Догружает предложения, созданные другими процессами"""
+        with self.lock:
+            edges = _pending().filter(pk__gt=self.watermark).values_list(*EDGE_FIELDS).order_by('pk')
+            for edge in self._track(edges):
+                if edge[0] not in self.local:
+                    self.graph.add_edge(*edge)
+            self.local = {proposal_id for proposal_id in self.local if proposal_id > self.watermark}
+            self.refreshed_at = time.monotonic()
+
+    def _track(self, edges):
+        for edge in edges:
+            self.watermark = max(self.watermark, edge[0])
+            yield edge
+
+    def proposal_saved(self, proposal):
+        with self.lock:
+            if self.graph is None:
+                return
+            if proposal.status == ExchangeProposal.PENDING:
+                if proposal.pk > self.watermark and proposal.pk not in self.local:
+                    self.local.add(proposal.pk)
+                    sender, receiver = proposal.ad_sender, proposal.ad_receiver
+                    self.graph.add_edge(proposal.pk, sender.pk, receiver.pk, sender.user_id, receiver.user_id)
+            else:
+                self.graph.remove_proposal(proposal.pk)
+
+    def proposals_answered(self, proposal_ids, ad_ids):
+        with self.lock:
+            if self.graph is not None:
+                for proposal_id in proposal_ids:
+                    self.graph.remove_proposal(proposal_id)
+                for ad_id in ad_ids:
+                    self.graph.close_ad(ad_id)
+
+    def ads_deleted(self, ad_ids):
+        """Удалённые объявления выходят из графа вместе со всеми рёбрами"""
+        with self.lock:
+            if self.graph is not None:
+                for ad_id in ad_ids:
+                    self.graph.close_ad(ad_id)
+
+    def proposal_deleted(self, proposal_id):
+        with self.lock:
+            if self.graph is not None:
+                self.graph.remove_proposal(proposal_id)
+
+    def cycles_for_user(self, user, max_length=None, limit=20):
+        """Цепочки с участием объявлений пользователя, без повторов"""
+        graph = self.get_graph()
+        if graph is None:
+            return []
+        seen, found = set(), []
+        for ad_id in Ad.objects.visible().filter(user=user).values_list('pk', flat=True):
+            for cycle in graph.cycles_through_ad(ad_id, max_length, limit):
+                key = frozenset(cycle)
+                if key not in seen:
+                    seen.add(key)
+                    found.append(cycle)
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    def cycles_for_proposal(self, proposal, max_length=None, limit=20):
+        """Цепочки, которые замыкает новое предложение"""
+        graph = self.get_graph()
+        if graph is None:
+            return []
+        return graph.cycles_through_proposal(
+            proposal.pk, proposal.ad_sender_id, proposal.ad_receiver_id, max_length, limit
+        )
+
+
+def _pending():
+    return ExchangeProposal.objects.pending().visible()
+
+
+_engine = MatchingEngine()
+
+
+def get_engine():
+    return _engine
+
+
+def load_cycles(cycles, user=None):
+    """Загружает предложения цепочек одним запросом и отбрасывает устаревшие.
+
+    Возвращает списки предложений; если задан пользователь, каждая цепочка
+    начинается с шага, где он получает объявление.
+    """
+    ids = {proposal_id for cycle in cycles for proposal_id in cycle}
+    proposals = _pending().for_list().in_bulk(ids) if ids else {}
+    loaded = []
+    for cycle in cycles:
+        steps = [proposals.get(proposal_id) for proposal_id in cycle]
+        if None in steps:
+            continue
+        if user is not None:
+            first = next((i for i, step in enumerate(steps) if step.ad_sender.user_id == user.pk), 0)
+            steps = steps[first:] + steps[:first]
+        loaded.append(steps)
+    return loaded
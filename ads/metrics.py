@@ -0,0 +1,206 @@
+"""Метрики запросов: время, SQL, шаблоны и память по имени маршрута.
+
+``RequestMetricsMiddleware`` (ads/middleware.py) заполняет ``RequestSample``
+на каждый запрос, здесь значения складываются в гистограммы процесса и
+отдаются в текстовом формате Prometheus. Гистограммы живут в памяти
+процесса: у каждого воркера gunicorn/uvicorn свои, Prometheus
+опрашивает их по отдельности.
+
+SQL считается обёрткой ``execute_wrapper``, которая ставится на каждое
+соединение при его открытии и смотрит на контекстную переменную текущего
+запроса, — поэтому учитываются и запросы асинхронных представлений,
+выполняемые через ``sync_to_async`` в другом потоке.
+"""
+import contextvars
+import math
+import resource
+import threading
+import time
+from bisect import bisect_left
+
+_current = contextvars.ContextVar('ads_request_sample', default=None)
+
+
+class Histogram:
+    """Гистограмма с логарифмическими корзинами.
+
+    Границы растут в ``growth`` раз, поэтому квантиль оценивается с
+    относительной ошибкой не больше ``growth - 1`` при фиксированной памяти.
+    """
+
+    def __init__(self, low, high, growth=2 ** 0.25):
+        count = math.ceil(math.log(high / low, growth)) + 1
+        self.bounds = [low * growth ** i for i in range(count)]
+        self.counts = [0] * (count + 1)  # последняя корзина — всё, что больше high
+        self.zeros = 0  # точные нули (например, страница из кэша без SQL) отдельно от первой корзины
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        if value <= 0:
+            self.zeros += 1
+        else:
+            self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        if rank <= self.zeros:
+            return 0.0
+        seen = self.zeros
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+# Метрика → (описание, нижняя и верхняя граница гистограммы)
+REQUEST_METRICS = {
+    'duration_seconds': ('Время обработки запроса', 1e-4, 120),
+    'db_queries': ('SQL-запросов за запрос', 1, 10000),
+    'db_seconds': ('Время SQL за запрос', 1e-5, 120),
+    'template_seconds': ('Время отрисовки шаблона', 1e-5, 60),
+    'memory_bytes': ('Пик выделенной памяти за запрос (ADS_METRICS_TRACE_MEMORY)', 1024, 2 ** 34),
+}
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RequestSample:
+    """Измерения одного запроса"""
+    __slots__ = ('started', 'queries', 'db_time', 'template_started', 'template_time', 'memory')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_started = None
+        self.template_time = None
+        self.memory = None
+
+
+class Registry:
+    """Гистограммы по (метрика, маршрут) и счётчик ответов по статусам"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.responses = {}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.responses.clear()
+
+    def record(self, view, status, sample, duration):
+        values = {'duration_seconds': duration, 'db_queries': sample.queries, 'db_seconds': sample.db_time}
+        if sample.template_time is not None:
+            values['template_seconds'] = sample.template_time
+        if sample.memory is not None:
+            values['memory_bytes'] = sample.memory
+        with self.lock:
+            for name, value in values.items():
+                histogram = self.histograms.get((name, view))
+                if histogram is None:
+                    _, low, high = REQUEST_METRICS[name]
+                    histogram = self.histograms[(name, view)] = Histogram(low, high)
+                histogram.observe(value)
+            key = (view, str(status))
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def snapshot(self, view, name):
+        with self.lock:
+            return self.histograms.get((name, view))
+
+    def render(self):
+        """Метрики запросов в текстовом формате Prometheus"""
+        lines = []
+        with self.lock:
+            for name, (description, _, _) in REQUEST_METRICS.items():
+                series = sorted((view, h) for (metric, view), h in self.histograms.items() if metric == name)
+                if not series:
+                    continue
+                lines += [f'# HELP ads_request_{name} {description}', f'# TYPE ads_request_{name} summary']
+                for view, histogram in series:
+                    for q in QUANTILES:
+                        lines.append(f'ads_request_{name}{{view="{view}",quantile="{q}"}} {histogram.quantile(q):.6g}')
+                    lines.append(f'ads_request_{name}_sum{{view="{view}"}} {histogram.sum:.6g}')
+                    lines.append(f'ads_request_{name}_count{{view="{view}"}} {histogram.count}')
+            if self.responses:
+                lines += ['# HELP ads_requests_total Ответов по маршрутам и кодам', '# TYPE ads_requests_total counter']
+                for (view, status), count in sorted(self.responses.items()):
+                    lines.append(f'ads_requests_total{{view="{view}",status="{status}"}} {count}')
+        return lines
+
+
+registry = Registry()
+
+
+def sql_wrapper(execute, sql, params, many, context):
+    """Обёртка execute_wrapper: считает запросы и их время для текущего запроса"""
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.db_time += time.perf_counter() - started
+
+
+def install_sql_wrapper(connection):
+    if sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_wrapper)
+
+
+def start_sample():
+    sample = RequestSample()
+    return sample, _current.set(sample)
+
+
+def finish_sample(token):
+    _current.reset(token)
+
+
+def render_queue_metrics():
+    """Глубина и задержки очереди фоновых задач (см. ads/tasks.py)"""
+    from .tasks import queue_metrics
+
+    metrics = queue_metrics()
+    lines = ['# HELP ads_task_queue_depth Задач по статусам', '# TYPE ads_task_queue_depth gauge']
+    lines += [f'ads_task_queue_depth{{status="{status}"}} {count}' for status, count in sorted(metrics['depth'].items())]
+    lines += [
+        '# HELP ads_task_ready Готовых к выполнению задач', '# TYPE ads_task_ready gauge',
+        f"ads_task_ready {metrics['ready']}",
+        '# HELP ads_task_oldest_ready_seconds Сколько ждёт старейшая готовая задача',
+        '# TYPE ads_task_oldest_ready_seconds gauge',
+        f"ads_task_oldest_ready_seconds {metrics['oldest_ready_age']:.3f}",
+    ]
+    for name, description in (('latency', 'От постановки до завершения'), ('runtime', 'Время выполнения')):
+        lines += [f'# HELP ads_task_{name}_seconds {description} (задачи за 15 минут)',
+                  f'# TYPE ads_task_{name}_seconds summary']
+        for q in (0.5, 0.95):
+            value = metrics[f'{name}_p{int(q * 100)}']
+            lines.append(f'ads_task_{name}_seconds{{quantile="{q}"}} {value or 0:.6g}')
+        lines.append(f"ads_task_{name}_seconds_count {metrics['done']}")
+    return lines
+
+
+def render():
+    """Полный текст для эндпоинта метрик"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    lines = registry.render() + render_queue_metrics() + [
+        '# HELP ads_process_max_rss_bytes Пиковый RSS процесса', '# TYPE ads_process_max_rss_bytes gauge',
+        f'ads_process_max_rss_bytes {usage.ru_maxrss * 1024}',
+    ]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,221 @@
+"""Middleware замеров запросов, профилирования по заголовку, маршрутизации чтений на реплики и ограничения частоты"""
+import cProfile
+import io
+import pstats
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+
+from . import metrics, ratelimit, routers
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_TOKEN_HEADER = 'HTTP_X_PROFILE_TOKEN'
+
+
+class RequestMetricsMiddleware:
+    """Пишет в ``ads.metrics.registry`` время, SQL, отрисовку шаблона и память запроса.
+
+    Ставится после ``AuthenticationMiddleware``: пользователь и сессия
+    загружаются лениво, так что их запросы всё равно попадают в замер.
+    Для потоковых ответов (выгрузки, изображения) время считается до
+    начала отдачи тела.
+
+    Заголовок ``X-Profile`` включает cProfile для одного запроса — у
+    сотрудников или при ``X-Profile-Token``, равном ``ADS_PROFILE_TOKEN``. Значение
+    ``text`` заменяет ответ таблицей функций по суммарному времени,
+    любое другое сохраняет ``.prof`` в ``ADS_PROFILE_DIR`` и возвращает
+    имя файла в заголовке ``X-Profile-File``.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.trace_memory = getattr(settings, 'ADS_METRICS_TRACE_MEMORY', False)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        profiler = None
+        if PROFILE_HEADER in request.META and self._may_profile(request, getattr(request, 'user', None)):
+            profiler = cProfile.Profile()
+        sample, token = self._start(request)
+        try:
+            if profiler is None:
+                response = self.get_response(request)
+            else:
+                response = profiler.runcall(self.get_response, request)
+        finally:
+            metrics.finish_sample(token)
+        return self._finish(request, response, sample, profiler)
+
+    async def __acall__(self, request):
+        profiler = None
+        if PROFILE_HEADER in request.META:
+            user = await request.auser() if hasattr(request, 'auser') else None
+            if self._may_profile(request, user):
+                # В асинхронном режиме профилируется только поток цикла событий
+                profiler = cProfile.Profile()
+        sample, token = self._start(request)
+        if profiler is not None:
+            profiler.enable()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            metrics.finish_sample(token)
+        return self._finish(request, response, sample, profiler)
+
+    def process_template_response(self, request, response):
+        # Вызывается прямо перед render(); конец отрисовки отмечает колбэк
+        sample = getattr(request, '_metrics_sample', None)
+        if sample is not None:
+            sample.template_started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: self._template_done(sample))
+        return response
+
+    @staticmethod
+    def _template_done(sample):
+        sample.template_time = time.perf_counter() - sample.template_started
+
+    def _start(self, request):
+        sample, token = metrics.start_sample()
+        request._metrics_sample = sample
+        if self.trace_memory:
+            # Пик общий для процесса: при параллельных запросах в потоках он завышается
+            tracemalloc.reset_peak()
+            sample.memory = tracemalloc.get_traced_memory()[0]
+        return sample, token
+
+    def _finish(self, request, response, sample, profiler):
+        duration = time.perf_counter() - sample.started
+        if self.trace_memory:
+            sample.memory = max(0, tracemalloc.get_traced_memory()[1] - sample.memory)
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else 'unresolved'
+        metrics.registry.record(view, response.status_code, sample, duration)
+        if profiler is not None:
+            return self._profile_response(request, response, profiler, view)
+        return response
+
+    def _may_profile(self, request, user):
+        token = getattr(settings, 'ADS_PROFILE_TOKEN', '')
+        if token and constant_time_compare(request.META.get(PROFILE_TOKEN_HEADER, ''), token):
+            return True
+        return bool(user is not None and user.is_staff)
+
+    def _profile_response(self, request, response, profiler, view):
+        if request.META[PROFILE_HEADER] == 'text':
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(
+                getattr(settings, 'ADS_PROFILE_TOP', 50))
+            return HttpResponse(output.getvalue(), content_type='text/plain; charset=utf-8')
+        directory = Path(getattr(settings, 'ADS_PROFILE_DIR', Path(tempfile.gettempdir()) / 'bartersystem-profiles'))
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f'{view}-{time.strftime("%Y%m%d-%H%M%S")}-{time.time_ns() % 10 ** 6:06d}.prof'
+        profiler.dump_stats(directory / name)
+        response['X-Profile-File'] = name
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """Заводит состояние ``ads.routers`` на запрос; после записи в базу ставит cookie основной базы.
+
+    Пока cookie жива (``ADS_DB_STICKY_SECONDS``), списки пользователя
+    читаются с основной базы, а не с отстающей реплики.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state, token = routers.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.finish_request(token)
+        return self._finish(response, state)
+
+    async def __acall__(self, request):
+        state, token = routers.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            routers.finish_request(token)
+        return self._finish(response, state)
+
+    def _finish(self, response, state):
+        sticky = getattr(settings, 'ADS_DB_STICKY_SECONDS', 10)
+        if state.wrote and sticky and routers.get_replicas():
+            response.set_cookie(routers.STICKY_COOKIE, '1', max_age=sticky, httponly=True, samesite='Lax')
+        return response
+
+
+class RateLimitMiddleware:
+    """Отвечает 429 с ``Retry-After`` на запись сверх лимитов ``ADS_RATE_LIMITS`` (см. ads/ratelimit.py).
+
+    Ставится после ``AuthenticationMiddleware``. Проверка — в
+    ``process_view``: маршрут уже определён обработчиком Django, второго
+    разбора URL нет, а чтение проходит без обращения к счётчикам.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Обработчик Django ждёт корутину process_view в асинхронном режиме
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = self._limited_route(request)
+        if url_name is not None:
+            decision = ratelimit.check(request, url_name, getattr(request, 'user', None))
+            if not decision.allowed:
+                return ratelimit.too_many_requests(url_name, decision.retry_after)
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        url_name = self._limited_route(request)
+        if url_name is not None:
+            user = await request.auser() if hasattr(request, 'auser') else None
+            decision = await ratelimit.acheck(request, url_name, user)
+            if not decision.allowed:
+                return ratelimit.too_many_requests(url_name, decision.retry_after)
+        return None
+
+    @staticmethod
+    def _limited_route(request):
+        if request.method not in ratelimit.UNSAFE_METHODS or request.resolver_match is None:
+            return None
+        url_name = request.resolver_match.url_name
+        return url_name if url_name in getattr(settings, 'ADS_RATE_LIMITS', {}) else None
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Полнотекстовый поиск на PostgreSQL: генерируемая колонка tsvector и триграммный индекс.
+# На остальных базах используется инвертированный индекс AdSearchTerm.
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    ALTER TABLE ads_ad ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('russian', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(description, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX ads_ad_search_vector_idx ON ads_ad USING gin (search_vector)",
+    "CREATE INDEX ads_ad_title_trgm_idx ON ads_ad USING gin (title gin_trgm_ops)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS ads_ad_title_trgm_idx",
+    "DROP INDEX IF EXISTS ads_ad_search_vector_idx",
+    "ALTER TABLE ads_ad DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def _run_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for sql in statements:
+                schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0002_alter_ad_category'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ad',
+            name='condition',
+            field=models.CharField(choices=[('Новый', 'Новый'), ('Б/у', 'Б/у')], max_length=20, verbose_name='Состояние'),
+        ),
+        migrations.AlterField(
+            model_name='ad',
+            name='image_url',
+            field=models.URLField(blank=True, null=True, verbose_name='Ссылка на изображение (URL из интернета)'),
+        ),
+        migrations.CreateModel(
+            name='AdSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64, verbose_name='Термин')),
+                ('weight', models.PositiveIntegerField(default=1, verbose_name='Вес')),
+                ('ad', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='ads.ad', verbose_name='Объявление')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('term', 'ad'), name='ads_searchterm_term_ad_uniq')],
+            },
+        ),
+        migrations.RunPython(_run_postgres(POSTGRES_FORWARD), _run_postgres(POSTGRES_BACKWARD)),
+    ]
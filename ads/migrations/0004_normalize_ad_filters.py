@@ -0,0 +1,31 @@
+from django.db import migrations
+
+# Значения состояния из первой версии модели
+LEGACY_CONDITIONS = {'new': 'Новый', 'used': 'Б/у'}
+
+
+def normalize_ad_filters(apps, schema_editor):
+    """Приводит категории и состояния к каноничным значениям из choices,
+    чтобы фильтры могли использовать точное сравнение по индексу"""
+    Ad = apps.get_model('ads', 'Ad')
+    categories = {value.lower(): value for value, _ in Ad._meta.get_field('category').choices}
+    conditions = {value.lower(): value for value, _ in Ad._meta.get_field('condition').choices}
+    conditions.update(LEGACY_CONDITIONS)
+
+    for field, canonical in (('category', categories), ('condition', conditions)):
+        stored = Ad.objects.values_list(field, flat=True).distinct()
+        for value in list(stored):
+            target = canonical.get(value.strip().lower())
+            if target and target != value:
+                Ad.objects.filter(**{field: value}).update(**{field: target})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0003_adsearchterm_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_ad_filters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+# Подписи статусов, которые представления сохраняли вместо ключей
+LEGACY_STATUSES = {'Ожидает': 'pending', 'Принята': 'accepted', 'Отклонена': 'rejected'}
+
+
+def normalize_proposal_status(apps, schema_editor):
+    """Переводит статусы предложений в ключи из STATUS_CHOICES"""
+    ExchangeProposal = apps.get_model('ads', 'ExchangeProposal')
+    for label, key in LEGACY_STATUSES.items():
+        ExchangeProposal.objects.filter(status=label).update(status=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0005_ad_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_proposal_status, migrations.RunPython.noop),
+    ]
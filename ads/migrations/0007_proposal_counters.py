@@ -0,0 +1,58 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    """Заполняет счётчики по уже существующим предложениям"""
+    Ad = apps.get_model('ads', 'Ad')
+    ExchangeProposal = apps.get_model('ads', 'ExchangeProposal')
+    UserStats = apps.get_model('ads', 'UserStats')
+
+    received = (
+        ExchangeProposal.objects.filter(ad_receiver=OuterRef('pk'))
+        .order_by().values('ad_receiver').annotate(n=Count('pk')).values('n')
+    )
+    Ad.objects.update(proposals_count=Coalesce(Subquery(received), Value(0)))
+
+    stats = {}
+    pending = Count('pk', filter=Q(status='pending'))
+    for side in ('received', 'sent'):
+        owner = 'ad_receiver__user_id' if side == 'received' else 'ad_sender__user_id'
+        rows = ExchangeProposal.objects.order_by().values_list(owner).annotate(total=Count('pk'), pending=pending)
+        for user_id, total, pending_count in rows:
+            row = stats.setdefault(user_id, UserStats(user_id=user_id))
+            setattr(row, f'proposals_{side}', total)
+            setattr(row, f'pending_{side}', pending_count)
+    UserStats.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0006_normalize_proposal_status'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ad_stats', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('pending_received', models.IntegerField(default=0, verbose_name='Ожидают ответа')),
+                ('pending_sent', models.IntegerField(default=0, verbose_name='Ожидают ответа от других')),
+                ('proposals_received', models.IntegerField(default=0, verbose_name='Получено предложений')),
+                ('proposals_sent', models.IntegerField(default=0, verbose_name='Отправлено предложений')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='proposals_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Предложений получено'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
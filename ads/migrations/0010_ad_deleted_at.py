@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0009_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Дата удаления'),
+        ),
+    ]
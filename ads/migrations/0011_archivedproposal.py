@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:38
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0010_ad_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedProposal',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('comment', models.TextField(blank=True, verbose_name='Комментарий')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('accepted', 'Принята'), ('rejected', 'Отклонена')], max_length=20, verbose_name='Статус')),
+                ('created_at', models.DateTimeField(verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(verbose_name='Дата изменения')),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата переноса в архив')),
+                ('ad_receiver', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_received_proposals', to='ads.ad', verbose_name='Полученные предложения')),
+                ('ad_sender', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_sent_proposals', to='ads.ad', verbose_name='Отправленные предложения')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ad_sender', '-created_at', '-id'], name='ads_archive_sender_idx'), models.Index(fields=['ad_receiver', '-created_at', '-id'], name='ads_archive_receiver_idx'), models.Index(fields=['-created_at', '-id'], name='ads_archive_created_idx'), models.Index(fields=['updated_at', 'id'], name='ads_archive_updated_idx')],
+            },
+        ),
+    ]
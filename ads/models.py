@@ -1,6 +1,39 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .images import url_version
+
+# Условный UPDATE не вызывает post_save, поэтому после фиксации транзакции
+# отправляется этот сигнал: proposal_ids — предложения со сменённым статусом,
+# ad_ids — объявления, все ожидающие предложения которых закрыты
+proposals_answered = Signal()
+
+# Объявления помечены удалёнными (см. ads/deletion.py) и сразу скрываются:
+# ad_ids — их id; отправляется после фиксации транзакции
+ads_deleted = Signal()
+
+class AdQuerySet(models.QuerySet):
+    """Запросы объявлений с заранее выбранными связанными данными"""
+
+    # Поля, которые выводят списки объявлений
+    LIST_FIELDS = ('title', 'description', 'image_url', 'category', 'condition', 'created_at', 'user_id',
+                   'proposals_count')
+
+    def visible(self):
+        """Без объявлений, помеченных удалёнными и ещё не очищенных"""
+        return self.filter(deleted_at__isnull=True)
+
+    def for_list(self):
+        """Только нужные спискам колонки, без автора"""
+        return self.only(*self.LIST_FIELDS)
+
+    def for_feed(self):
+        """Колонки для ленты вместе с именем автора одним JOIN"""
+        return self.select_related('user').only(*self.LIST_FIELDS, 'user__username')
+
 class Ad(models.Model):
     """Модель для объявлений"""
     
@@ -16,31 +49,334 @@ class Ad(models.Model):
         ('Электроника', 'Электроника'),
     ]
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='Пользователь')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False, verbose_name='Пользователь')
     title = models.CharField(max_length=255, verbose_name='Заголовок')
     description = models.TextField(verbose_name='Описание')
     image_url = models.URLField(blank=True, null=True, verbose_name='Ссылка на изображение (URL из интернета)')
     category = models.CharField(max_length=100, choices=CATEGORIES, verbose_name='Категория')
     condition = models.CharField(max_length=20, choices=CONDITION_CHOICES, verbose_name='Состояние')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата публикации')
+    # Меняется при любом изменении строки, включая счётчик предложений: Last-Modified и синхронизация в API
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
+    # Денормализованный счётчик полученных предложений, см. ExchangeProposal.save
+    proposals_count = models.IntegerField(default=0, editable=False, verbose_name='Предложений получено')
+    # Надгробие: объявление удалено, строка и её предложения ждут очистки (ads/deletion.py)
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name='Дата удаления')
+
+    objects = AdQuerySet.as_manager()
+
+    class Meta:
+        # Индексы повторяют реальные пути доступа: лента, «мои объявления» и фильтры
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='ads_ad_feed_idx'),
+            models.Index(fields=['user', '-created_at', '-id'], name='ads_ad_user_created_idx'),
+            models.Index(fields=['category', 'condition', '-created_at', '-id'], name='ads_ad_cat_cond_created_idx'),
+            models.Index(fields=['updated_at', 'id'], name='ads_ad_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.user.username})"
 
+    @property
+    def image_version(self):
+        """Версия ссылки на изображение для адреса прокси миниатюр"""
+        return url_version(self.image_url) if self.image_url else ''
+
+class ProposalQuerySet(models.QuerySet):
+    """Запросы, общие для действующих и архивных предложений"""
+
+    def for_list(self):
+        """Предложения вместе с объявлениями и их авторами за один запрос"""
+        return self.select_related('ad_sender__user', 'ad_receiver__user').only(
+            'comment', 'status', 'created_at',
+            'ad_sender__title', 'ad_sender__user__username',
+            'ad_receiver__title', 'ad_receiver__user__username',
+        )
+
+    def visible(self):
+        """Без предложений с объявлениями, помеченными удалёнными"""
+        return self.filter(ad_sender__deleted_at__isnull=True, ad_receiver__deleted_at__isnull=True)
+
+class ExchangeProposalQuerySet(ProposalQuerySet):
+    """Запросы предложений обмена"""
+
+    def pending(self):
+        return self.filter(status=ExchangeProposal.PENDING)
+
+    def pending_by_owner(self):
+        """Число предложений по владельцам: ({получатель: n}, {отправитель: n})"""
+        received, sent = {}, {}
+        rows = self.order_by().values_list('ad_receiver__user_id', 'ad_sender__user_id').annotate(n=Count('pk'))
+        for receiver, sender, count in rows:
+            received[receiver] = received.get(receiver, 0) + count
+            sent[sender] = sent.get(sender, 0) + count
+        return received, sent
+
+    def accept(self):
+        """Принимает ожидающие предложения и отклоняет конкурирующие.
+
+        Каждое предложение обрабатывается в своей транзакции: строки обоих
+        объявлений блокируются в порядке id (параллельные принятия одного
+        объявления выполняются по очереди, без взаимоблокировок), статус
+        меняется условным UPDATE ... WHERE status='pending', а все остальные
+        ожидающие предложения с этими объявлениями отклоняются одним запросом.
+        Возвращает словарь: принятые id, число автоматически отклонённых и
+        id предложений, которые к моменту обработки уже не ожидали ответа.
+        """
+        result = {'accepted': [], 'rejected': 0, 'skipped': []}
+        for pk, sender_id, receiver_id in self.pending().values_list('pk', 'ad_sender_id', 'ad_receiver_id'):
+            ad_ids = sorted({sender_id, receiver_id})
+            with transaction.atomic():
+                list(Ad.objects.select_for_update().filter(pk__in=ad_ids).order_by('pk').values_list('pk'))
+                closing = ExchangeProposal.objects.pending().filter(
+                    Q(ad_sender__in=ad_ids) | Q(ad_receiver__in=ad_ids)
+                )
+                owners = closing.pending_by_owner()
+                now = timezone.now()
+                if not ExchangeProposal.objects.filter(pk=pk).pending().update(status=ExchangeProposal.ACCEPTED,
+                                                                              updated_at=now):
+                    result['skipped'].append(pk)
+                    continue
+                closed = [pk, *closing.values_list('pk', flat=True)]
+                result['rejected'] += closing.update(status=ExchangeProposal.REJECTED, updated_at=now)
+                UserStats.objects.add_pending(*owners, sign=-1)
+                transaction.on_commit(lambda closed=closed, ad_ids=ad_ids: proposals_answered.send(
+                    sender=ExchangeProposal, proposal_ids=closed, ad_ids=ad_ids
+                ))
+            result['accepted'].append(pk)
+        return result
+
+    def reject(self, batch_size=1000):
+        """Отклоняет ожидающие предложения условным UPDATE, возвращает их число"""
+        ids = list(self.pending().values_list('pk', flat=True))
+        rejected = 0
+        with transaction.atomic():
+            for start in range(0, len(ids), batch_size):
+                batch = ExchangeProposal.objects.filter(pk__in=ids[start:start + batch_size]).pending()
+                owners = batch.pending_by_owner()
+                rejected += batch.update(status=ExchangeProposal.REJECTED, updated_at=timezone.now())
+                UserStats.objects.add_pending(*owners, sign=-1)
+            if ids:
+                transaction.on_commit(lambda: proposals_answered.send(
+                    sender=ExchangeProposal, proposal_ids=ids, ad_ids=[]
+                ))
+        return rejected
+
 class ExchangeProposal(models.Model):
     """Модель для предложения обмена"""
-    
+
+    PENDING, ACCEPTED, REJECTED = 'pending', 'accepted', 'rejected'
     STATUS_CHOICES = [
-        ('pending', 'Ожидает'),
-        ('accepted', 'Принята'),
-        ('rejected', 'Отклонена'),
+        (PENDING, 'Ожидает'),
+        (ACCEPTED, 'Принята'),
+        (REJECTED, 'Отклонена'),
     ]
 
-    ad_sender = models.ForeignKey(Ad, related_name='sent_proposals', on_delete=models.CASCADE, verbose_name='Отправленные предложения')
-    ad_receiver = models.ForeignKey(Ad, related_name='received_proposals', on_delete=models.CASCADE, verbose_name='Полученные предложения')
+    ad_sender = models.ForeignKey(Ad, related_name='sent_proposals', on_delete=models.CASCADE, db_index=False, verbose_name='Отправленные предложения')
+    ad_receiver = models.ForeignKey(Ad, related_name='received_proposals', on_delete=models.CASCADE, db_index=False, verbose_name='Полученные предложения')
     comment = models.TextField(blank=True, verbose_name='Комментарий')
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name='Статус')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, verbose_name='Статус')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    # Условные UPDATE в accept/reject выставляют его явно: auto_now срабатывает только в save()
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
+
+    objects = ExchangeProposalQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ad_sender', 'status', '-created_at'], name='ads_proposal_sender_status_idx'),
+            models.Index(fields=['ad_receiver', 'status', '-created_at'], name='ads_proposal_recv_status_idx'),
+            models.Index(fields=['status', '-created_at'], name='ads_proposal_status_idx'),
+            models.Index(fields=['updated_at', 'id'], name='ads_proposal_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"Обмен от {self.ad_sender} к {self.ad_receiver} — {self.get_status_display()}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Статус при загрузке нужен, чтобы save() знал, изменился ли он
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_status = self.__dict__.get('status')
+
+    def save(self, *args, **kwargs):
+        """Сохраняет предложение и обновляет счётчики в той же транзакции"""
+        adding = self._state.adding
+        previous = None if adding else getattr(self, '_loaded_status', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                self._update_counters(total=1, pending=int(self.status == self.PENDING))
+            elif previous is not None and (previous == self.PENDING) != (self.status == self.PENDING):
+                self._update_counters(pending=1 if self.status == self.PENDING else -1)
+        self._loaded_status = self.status
+
+    def _update_counters(self, total=0, pending=0, create=True):
+        """Сдвигает счётчики объявления-получателя и владельцев обоих объявлений"""
+        if type(self).ad_sender.is_cached(self) and type(self).ad_receiver.is_cached(self):
+            sender, receiver = self.ad_sender.user_id, self.ad_receiver.user_id
+        else:
+            owners = dict(Ad.objects.filter(pk__in=[self.ad_sender_id, self.ad_receiver_id]).values_list('pk', 'user_id'))
+            sender, receiver = owners.get(self.ad_sender_id), owners.get(self.ad_receiver_id)
+        if total:
+            Ad.objects.filter(pk=self.ad_receiver_id).update(
+                proposals_count=F('proposals_count') + total, updated_at=timezone.now(),
+            )
+        deltas = {}
+        if total and receiver is not None and sender is not None:
+            deltas['proposals_received'] = {receiver: total}
+            deltas['proposals_sent'] = {sender: total}
+        if pending and receiver is not None and sender is not None:
+            deltas['pending_received'] = {receiver: pending}
+            deltas['pending_sent'] = {sender: pending}
+        UserStats.objects.add(deltas, create=create)
+
+class ArchivedProposal(models.Model):
+    """Решённое предложение обмена, перенесённое из ExchangeProposal (см. ads/archive.py).
+
+    Строка сохраняет id и все поля исходного предложения, поэтому ссылки и
+    курсоры страниц остаются прежними. Архивные предложения входят в общие
+    счётчики ``proposals_count``/``proposals_*`` и никогда не ожидают ответа.
+    """
+
+    id = models.BigIntegerField(primary_key=True, verbose_name='ID')
+    ad_sender = models.ForeignKey(Ad, related_name='archived_sent_proposals', on_delete=models.CASCADE, db_index=False, verbose_name='Отправленные предложения')
+    ad_receiver = models.ForeignKey(Ad, related_name='archived_received_proposals', on_delete=models.CASCADE, db_index=False, verbose_name='Полученные предложения')
+    comment = models.TextField(blank=True, verbose_name='Комментарий')
+    status = models.CharField(max_length=20, choices=ExchangeProposal.STATUS_CHOICES, verbose_name='Статус')
+    created_at = models.DateTimeField(verbose_name='Дата создания')
+    updated_at = models.DateTimeField(verbose_name='Дата изменения')
+    archived_at = models.DateTimeField(default=timezone.now, verbose_name='Дата переноса в архив')
+
+    objects = ProposalQuerySet.as_manager()
+
+    # Удаление архивного предложения сдвигает те же счётчики, что и удаление действующего
+    _update_counters = ExchangeProposal._update_counters
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ad_sender', '-created_at', '-id'], name='ads_archive_sender_idx'),
+            models.Index(fields=['ad_receiver', '-created_at', '-id'], name='ads_archive_receiver_idx'),
+            models.Index(fields=['-created_at', '-id'], name='ads_archive_created_idx'),
+            models.Index(fields=['updated_at', 'id'], name='ads_archive_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"Обмен от {self.ad_sender} к {self.ad_receiver} — {self.get_status_display()} (архив)"
+
+class UserStatsQuerySet(models.QuerySet):
+    """Атомарные сдвиги счётчиков пользователей"""
+
+    # Сколько пользователей обновляется одним UPDATE ... CASE
+    BATCH_SIZE = 500
+
+    def add(self, deltas, create=True):
+        """Прибавляет к счётчикам значения вида {поле: {id пользователя: n}}.
+
+        Недостающие строки создаются (если ``create``), сами сдвиги
+        выполняются через F-выражения, поэтому параллельные изменения
+        не теряются.
+        """
+        user_ids = sorted({user_id for values in deltas.values() for user_id, n in values.items() if n})
+        for start in range(0, len(user_ids), self.BATCH_SIZE):
+            batch = user_ids[start:start + self.BATCH_SIZE]
+            if create:
+                self.bulk_create([UserStats(user_id=user_id) for user_id in batch], ignore_conflicts=True)
+            self.filter(user_id__in=batch).update(**{
+                field: F(field) + Case(
+                    *[When(user_id=user_id, then=Value(values[user_id])) for user_id in batch if values.get(user_id)],
+                    default=Value(0),
+                )
+                for field, values in deltas.items() if any(values.get(user_id) for user_id in batch)
+            })
+
+    def add_pending(self, received, sent, sign=1):
+        """Сдвигает счётчики ожидающих предложений, см. pending_by_owner"""
+        self.add({
+            'pending_received': {user_id: sign * n for user_id, n in received.items()},
+            'pending_sent': {user_id: sign * n for user_id, n in sent.items()},
+        })
+
+    def for_user(self, user):
+        """Счётчики пользователя; если строки ещё нет — нулевые"""
+        return self.filter(user=user).first() or UserStats(user=user)
+
+    async def afor_user(self, user):
+        return await self.filter(user=user).afirst() or UserStats(user=user)
+
+class UserStats(models.Model):
+    """Денормализованные счётчики предложений пользователя для бейджей и пагинации"""
+    COUNTERS = ('pending_received', 'pending_sent', 'proposals_received', 'proposals_sent')
+
+    user = models.OneToOneField(User, primary_key=True, related_name='ad_stats', on_delete=models.CASCADE, verbose_name='Пользователь')
+    pending_received = models.IntegerField(default=0, verbose_name='Ожидают ответа')
+    pending_sent = models.IntegerField(default=0, verbose_name='Ожидают ответа от других')
+    proposals_received = models.IntegerField(default=0, verbose_name='Получено предложений')
+    proposals_sent = models.IntegerField(default=0, verbose_name='Отправлено предложений')
+
+    objects = UserStatsQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.user_id}: входящих {self.pending_received}, исходящих {self.pending_sent}"
+
+class Task(models.Model):
+    """Фоновая задача, см. ads/tasks.py"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнена'),
+        (FAILED, 'Ошибка'),
+    ]
+
+    name = models.CharField(max_length=200, verbose_name='Задача')
+    args = models.JSONField(default=list, blank=True, verbose_name='Аргументы')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, verbose_name='Статус')
+    idempotency_key = models.CharField(max_length=200, null=True, blank=True, verbose_name='Ключ идемпотентности')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток')
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name='Максимум попыток')
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='Выполнить после')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Поставлена')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Начата')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Завершена')
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name='Воркер')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+
+    class Meta:
+        indexes = [
+            # Выборка готовых задач воркером и очистка выполненных
+            models.Index(fields=['status', 'run_at'], name='ads_task_status_run_idx'),
+            models.Index(fields=['status', 'finished_at'], name='ads_task_status_finished_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['idempotency_key'], condition=Q(status='queued'), name='ads_task_queued_key_uniq',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+class AdSearchTerm(models.Model):
+    """Элемент инвертированного индекса для поиска без PostgreSQL"""
+    TERM_MAX_LENGTH = 64
+
+    ad = models.ForeignKey(Ad, related_name='search_terms', on_delete=models.CASCADE, verbose_name='Объявление')
+    term = models.CharField(max_length=TERM_MAX_LENGTH, verbose_name='Термин')
+    weight = models.PositiveIntegerField(default=1, verbose_name='Вес')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'ad'], name='ads_searchterm_term_ad_uniq'),
+        ]
 
     def __str__(self):
-        return f"Обмен от {self.ad_sender} к {self.ad_receiver} — {self.status}"
\ No newline at end of file
+        return f"{self.term} → {self.ad_id} ({self.weight})"
@@ -0,0 +1,175 @@
+"""Уведомления о предложениях обмена: публикация и раздача подписчикам.
+
+Обработчики сигналов (ads/signals.py) после фиксации транзакции публикуют
+событие для владельцев объявлений, а SSE-поток ``ads.events`` подписывает
+каждое открытое соединение на события его пользователя.
+
+Брокер задаётся ``ADS_NOTIFICATIONS_BROKER``. ``LocalBroker`` раздаёт
+события внутри процесса без внешних сервисов, но видит только записи,
+сделанные в этом же процессе. При нескольких воркерах ASGI (или если
+предложения меняют ``run_worker`` и команды) нужен общий брокер —
+``RedisBroker``. Свой брокер — класс с ``publish(user_ids, event, data)``
+и ``subscribe(user_id)``, возвращающим ``Subscription``.
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def format_event(event, data):
+    """Событие в формате text/event-stream; сериализуется один раз на всех подписчиков"""
+    payload = json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':'))
+    return f'event: {event}\ndata: {payload}\n\n'.encode()
+
+
+# Очередь переполнилась: клиент пропустил события и должен перечитать список
+RESYNC = format_event('resync', {})
+
+
+class Subscription:
+    """Очередь событий одного соединения; все методы, кроме ``push``, — в цикле событий подписчика"""
+
+    def __init__(self, broker, user_id, maxsize):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def push(self, message):
+        """Передаёт событие из любого потока"""
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # Цикл подписчика уже закрыт — соединение умерло вместе с ним
+            self.close()
+
+    def _put(self, message):
+        if self.queue.full():
+            # Медленный клиент не копит бесконечную очередь: вместо пропущенных событий — одно resync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            message = RESYNC
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Раздача событий подписчикам внутри процесса"""
+
+    def __init__(self, queue_size=None):
+        self.queue_size = queue_size or getattr(settings, 'ADS_EVENTS_QUEUE_SIZE', 100)
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id, self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscribers[subscription.user_id]
+
+    def connection_count(self):
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscribers.values())
+
+    def publish(self, user_ids, event, data):
+        self.deliver(user_ids, event, data)
+
+    def deliver(self, user_ids, event, data):
+        """Кладёт событие в очереди подписчиков этого процесса"""
+        with self.lock:
+            targets = [s for user_id in set(user_ids) for s in self.subscribers.get(user_id, ())]
+        if targets:
+            message = format_event(event, data)
+            for subscription in targets:
+                subscription.push(message)
+
+
+class RedisBroker(LocalBroker):
+    """Брокер для нескольких процессов: события идут через канал Redis, раздача — локальная.
+
+    Каждый процесс подписывается на канал один раз, при первом
+    SSE-соединении, и сам отбирает события своих подписчиков.
+    """
+    channel = 'ads:events'
+    reconnect_delay = 1.0
+
+    def __init__(self, url=None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url or getattr(settings, 'ADS_NOTIFICATIONS_REDIS_URL', '')
+        self.client = None
+        self.listener = None
+
+    def publish(self, user_ids, event, data):
+        import redis
+
+        if self.client is None:
+            self.client = redis.Redis.from_url(self.url)
+        message = {'users': list(user_ids), 'event': event, 'data': data}
+        self.client.publish(self.channel, json.dumps(message, cls=DjangoJSONEncoder))
+
+    def subscribe(self, user_id):
+        subscription = super().subscribe(user_id)
+        if self.listener is None or self.listener.done():
+            self.listener = subscription.loop.create_task(self.listen())
+        return subscription
+
+    async def listen(self):
+        import redis.asyncio
+
+        while True:
+            try:
+                client = redis.asyncio.Redis.from_url(self.url)
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            payload = json.loads(message['data'])
+                            self.deliver(payload['users'], payload['event'], payload['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Подписка на канал %s прервалась', self.channel)
+                await asyncio.sleep(self.reconnect_delay)
+
+
+def get_broker():
+    """Брокер процесса, заданный настройкой ``ADS_NOTIFICATIONS_BROKER``"""
+    name = getattr(settings, 'ADS_NOTIFICATIONS_BROKER', 'ads.notifications.LocalBroker')
+    with _brokers_lock:
+        if name not in _brokers:
+            _brokers[name] = import_string(name)()
+        return _brokers[name]
+
+
+def notify(user_ids, event, data):
+    """Публикует событие; сбой брокера не должен ломать запись, вызвавшую уведомление"""
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    if not user_ids:
+        return
+    try:
+        get_broker().publish(user_ids, event, data)
+    except Exception:
+        logger.exception('Не удалось опубликовать событие %s', event)
@@ -0,0 +1,314 @@
+"""Keyset-пагинация (по курсору) для списков объявлений.
+
+Вместо OFFSET/LIMIT страница выбирается условием по ключу сортировки
+(по умолчанию ``(created_at, id)``), поэтому стоимость запроса не зависит
+от глубины страницы. Курсоры непрозрачны для клиента: это base64 от JSON
+с направлением и значениями ключа граничной записи.
+"""
+import base64
+import binascii
+import json
+import math
+from datetime import date, datetime
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import BooleanField, Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class InvalidCursor(Exception):
+    """Курсор повреждён или не соответствует сортировке"""
+
+
+def encode_cursor(direction, values):
+    """Кодирует направление и значения ключа в непрозрачный токен"""
+    payload = [direction, [_dump_value(v) for v in values]]
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Разбирает токен курсора, возвращает (направление, значения)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, values = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidCursor(token)
+    if direction not in (NEXT, PREVIOUS) or not isinstance(values, list):
+        raise InvalidCursor(token)
+    return direction, values
+
+
+def _dump_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def estimate_count(queryset):
+    """Оценка количества строк без полного COUNT(*).
+
+    На PostgreSQL берётся оценка планировщика из EXPLAIN, на остальных
+    базах выполняется обычный COUNT. У составного списка (``parts``, см.
+    ads/archive.py) складываются оценки частей.
+    """
+    parts = getattr(queryset, 'parts', None)
+    if parts is not None:
+        return sum(estimate_count(part) for part in parts)
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPage:
+    """Страница keyset-пагинации, совместимая с шаблонами ListView"""
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f'<KeysetPage {len(self.object_list)} объектов>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Пагинатор, выбирающий страницы условием по ключу сортировки.
+
+    ``ordering`` — кортеж полей (с ``-`` для убывания); последним должно
+    идти уникальное поле, чтобы порядок был строгим. ``count_mode``:
+    ``None`` — без подсчёта, ``'exact'`` — COUNT(*), ``'estimate'`` —
+    оценка планировщика. ``count_func`` — готовый точный счётчик (например,
+    денормализованный), он заменяет подсчёт по queryset.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-created_at', '-id'), count_mode=None, count_func=None):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.count_mode = count_mode
+        self.count_func = count_func
+        self.fields = [(f.lstrip('-'), f.startswith('-')) for f in self.ordering]
+
+    @cached_property
+    def count(self):
+        """Общее количество объектов или None, если подсчёт отключён"""
+        if self.count_func is not None:
+            return self.count_func()
+        if self.count_mode == 'exact':
+            return self.queryset.order_by().count()
+        if self.count_mode == 'estimate':
+            return estimate_count(self.queryset)
+        return None
+
+    @property
+    def count_is_estimate(self):
+        return self.count_func is None and self.count_mode == 'estimate'
+
+    async def acount(self):
+        """Асинхронный вариант count; результат запоминается в count"""
+        if 'count' not in self.__dict__:
+            queryset = self.queryset.order_by()
+            if self.count_func is not None:
+                value = await sync_to_async(self.count_func)()
+            elif self.count_mode == 'estimate' and connections[queryset.db].vendor == 'postgresql':
+                value = await sync_to_async(estimate_count)(queryset)
+            elif self.count_mode in ('exact', 'estimate'):
+                value = await queryset.acount()
+            else:
+                value = None
+            self.__dict__['count'] = value
+        return self.count
+
+    def page(self, cursor=None):
+        """Возвращает страницу после (или до) позиции, заданной курсором"""
+        qs, reverse = self._page_queryset(cursor)
+        rows = list(qs[:self.per_page + 1])
+        return self._build_page(rows, cursor, reverse)
+
+    async def apage(self, cursor=None):
+        """Асинхронный вариант page() для ASGI-представлений"""
+        qs, reverse = self._page_queryset(cursor)
+        rows = [obj async for obj in qs[:self.per_page + 1].aiterator()]
+        return self._build_page(rows, cursor, reverse)
+
+    def _page_queryset(self, cursor):
+        direction, values = NEXT, None
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            values = self._parse_values(values)
+
+        reverse = direction == PREVIOUS
+        qs = self.queryset.order_by(*self._order_by(reverse))
+        if values is not None:
+            qs = qs.filter(self._seek(values, reverse))
+        return qs, reverse
+
+    def _build_page(self, rows, cursor, reverse):
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = encode_cursor(NEXT, self._key(rows[-1]))
+        if rows and has_previous:
+            previous_cursor = encode_cursor(PREVIOUS, self._key(rows[0]))
+        return KeysetPage(rows, self, next_cursor, previous_cursor)
+
+    def _order_by(self, reverse):
+        return [
+            ('-' if desc != reverse else '') + name
+            for name, desc in self.fields
+        ]
+
+    def _seek(self, values, reverse):
+        """Строит условие «строго после ключа» в лексикографическом порядке"""
+        condition = Q()
+        for i, (name, desc) in enumerate(self.fields):
+            lookup = 'lt' if desc != reverse else 'gt'
+            term = Q(**{f'{name}__{lookup}': values[i]})
+            for j, (prev_name, _) in enumerate(self.fields[:i]):
+                term &= Q(**{prev_name: values[j]})
+            condition |= term
+        return condition
+
+    def _key(self, obj):
+        return [getattr(obj, 'pk' if name == 'id' else name) for name, _ in self.fields]
+
+    def _parse_values(self, values):
+        if len(values) != len(self.fields):
+            raise InvalidCursor(values)
+        parsed = []
+        for (name, _), value in zip(self.fields, values):
+            # В курсоре только скаляры: список или объект — подделанный токен
+            if isinstance(value, (list, dict)):
+                raise InvalidCursor(values)
+            try:
+                field = self.queryset.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                # Не поле модели — числовая аннотация (ранг поиска)
+                parsed.append(self._parse_number(value, values))
+                continue
+            # to_python пропускает None и превращает True в 1 — для ключа это подделка
+            if value is None or (isinstance(value, bool) and not isinstance(field, BooleanField)):
+                raise InvalidCursor(values)
+            try:
+                parsed.append(field.to_python(value))
+            except (ValidationError, TypeError, ValueError):
+                # Значение не того типа (например, число вместо даты) — тоже подделка
+                raise InvalidCursor(values)
+        return parsed
+
+    @staticmethod
+    def _parse_number(value, values):
+        # bool — подкласс int, но в ранге ему не место; строку float() разберёт сам
+        if value is None or isinstance(value, bool):
+            raise InvalidCursor(values)
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise InvalidCursor(values)
+        if not math.isfinite(number):
+            raise InvalidCursor(values)
+        return number
+
+
+class KeysetPaginationMixin:
+    """Подключает keyset-пагинацию к ListView.
+
+    Режим выбирается настройкой ``ADS_PAGINATION_MODE`` (``'keyset'`` или
+    ``'offset'``), подсчёт — ``ADS_PAGINATION_COUNT_MODE``. В обоих режимах
+    у страницы есть ``next_querystring``/``previous_querystring`` с
+    сохранёнными фильтрами.
+    """
+    keyset_ordering = ('-created_at', '-id')
+    cursor_kwarg = 'cursor'
+
+    def get_pagination_mode(self):
+        return getattr(settings, 'ADS_PAGINATION_MODE', 'keyset')
+
+    def get_count_mode(self):
+        return getattr(settings, 'ADS_PAGINATION_COUNT_MODE', 'estimate')
+
+    def get_keyset_ordering(self):
+        return self.keyset_ordering
+
+    def get_count_func(self):
+        """Готовый счётчик объектов списка или None, чтобы считать по queryset"""
+        return None
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return KeysetPaginator(
+            queryset, page_size,
+            ordering=self.get_keyset_ordering(),
+            count_mode=self.get_count_mode(),
+            count_func=self.get_count_func(),
+        )
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.get_pagination_mode() != 'keyset':
+            paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+            page.next_querystring = page.has_next() and self._querystring('page', page.next_page_number())
+            page.previous_querystring = page.has_previous() and self._querystring('page', page.previous_page_number())
+            return paginator, page, object_list, is_paginated
+
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404('Неверный курсор страницы')
+        self._annotate_page(page)
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def _annotate_page(self, page):
+        page.next_querystring = page.has_next() and self._querystring(self.cursor_kwarg, page.next_cursor)
+        page.previous_querystring = page.has_previous() and self._querystring(self.cursor_kwarg, page.previous_cursor)
+
+    def _querystring(self, key, value):
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        params.pop(self.cursor_kwarg, None)
+        params[key] = value
+        return params.urlencode()
@@ -0,0 +1,220 @@
+"""Ограничение частоты записей: новых предложений и объявлений.
+
+Правила задаются по имени маршрута в ``ADS_RATE_LIMITS``: для каждого
+маршрута — лимиты на пользователя и на IP в виде ``'30/h'`` (30 запросов
+в час; периоды ``s``, ``m``, ``h``, ``d``, можно с множителем: ``'5/10m'``).
+Ограничиваются только пишущие запросы (POST, PUT, PATCH, DELETE), чтение
+не проверяется вовсе. Проверку выполняет ``RateLimitMiddleware``
+(ads/middleware.py): превышение — ответ 429 с заголовком ``Retry-After``.
+
+Алгоритм — скользящее окно из двух счётчиков: текущего окна и
+предыдущего, взвешенного долей периода, которая ещё в окне. Это O(1) на
+проверку и две величины на ключ, без списка меток времени, а всплеск на
+границе окон сглажен. Отклонённые запросы не считаются, поэтому клиент,
+который продолжает стучаться, всё равно получит доступ после ожидания.
+
+Хранилище задаётся ``ADS_RATE_LIMIT_STORE``. ``MemoryStore`` считает в
+памяти процесса и держит не больше ``ADS_RATE_LIMIT_MAX_KEYS`` ключей
+(давно не встречавшиеся вытесняются), но у каждого воркера свои счётчики.
+``CacheStore`` считает в общем кэше Django (Redis) атомарным ``incr`` —
+лимит общий для всех воркеров ценой обращения к кэшу на каждую запись.
+"""
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+from django.utils.module_loading import import_string
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+UNSAFE_METHODS = frozenset({'POST', 'PUT', 'PATCH', 'DELETE'})
+
+Rate = namedtuple('Rate', 'limit period')
+# allowed — пропустить запрос; retry_after — через сколько секунд повторить, если нет
+Decision = namedtuple('Decision', 'allowed retry_after')
+ALLOWED = Decision(True, 0)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def parse_rate(value):
+    """``'30/h'`` → Rate(30, 3600), ``'5/10m'`` → Rate(5, 600)"""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d*)\s*([smhd])\s*', value)
+    # Нулевой лимит или период делил бы на ноль в sliding_window
+    if not match or int(match[1]) == 0 or match[2] and int(match[2]) == 0:
+        raise ValueError(f'Лимит {value!r}: ожидается «число/период», например 30/h')
+    count, multiplier, unit = match.groups()
+    return Rate(int(count), int(multiplier or 1) * PERIODS[unit])
+
+
+def sliding_window(previous, current, elapsed, rate):
+    """Решение по счётчикам предыдущего и текущего окна; ``elapsed`` — секунд от начала текущего окна"""
+    weight = 1 - elapsed / rate.period
+    if previous * weight + current + 1 <= rate.limit:
+        return ALLOWED
+    if current + 1 <= rate.limit:
+        # Место освободится, когда вклад предыдущего окна затухнет: previous * (1 - x) + current + 1 <= limit
+        wait = (1 - (rate.limit - 1 - current) / previous) * rate.period - elapsed
+    else:
+        # Текущее окно заполнено: ждать следующего и затухания этого в нём
+        wait = rate.period - elapsed + (1 - (rate.limit - 1) / current) * rate.period
+    return Decision(False, max(1, math.ceil(wait)))
+
+
+class MemoryStore:
+    """Счётчики в памяти процесса: O(1) на проверку, не больше ``max_keys`` ключей (LRU)"""
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys or getattr(settings, 'ADS_RATE_LIMIT_MAX_KEYS', 100_000)
+        self.lock = threading.Lock()
+        # ключ → [номер окна, счётчик предыдущего окна, счётчик текущего]
+        self.windows = OrderedDict()
+
+    def __len__(self):
+        return len(self.windows)
+
+    def hit(self, key, rate, now=None):
+        now = time.time() if now is None else now
+        window, elapsed = divmod(now, rate.period)
+        with self.lock:
+            entry = self.windows.get(key)
+            if entry is None:
+                entry = self.windows[key] = [window, 0, 0]
+                if len(self.windows) > self.max_keys:
+                    self.windows.popitem(last=False)
+            else:
+                self.windows.move_to_end(key)
+                if entry[0] != window:
+                    entry[1] = entry[2] if entry[0] == window - 1 else 0
+                    entry[0], entry[2] = window, 0
+            decision = sliding_window(entry[1], entry[2], elapsed, rate)
+            if decision.allowed:
+                entry[2] += 1
+        return decision
+
+    async def ahit(self, key, rate, now=None):
+        # Блокировка держится микросекунды, ввода-вывода нет
+        return self.hit(key, rate, now)
+
+
+class CacheStore:
+    """Счётчики в общем кэше Django: ключ на окно, атомарный ``incr``, срок жизни — два периода"""
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or getattr(settings, 'ADS_RATE_LIMIT_CACHE_ALIAS', 'default')]
+
+    def _keys(self, key, rate, now):
+        window, elapsed = divmod(now, rate.period)
+        return f'{key}:{int(window)}', f'{key}:{int(window) - 1}', elapsed
+
+    def hit(self, key, rate, now=None):
+        current_key, previous_key, elapsed = self._keys(key, rate, time.time() if now is None else now)
+        previous = self.cache.get(previous_key, 0)
+        try:
+            current = self.cache.incr(current_key)
+        except ValueError:
+            # Первый запрос окна; если параллельный запрос успел создать ключ — обычный incr
+            current = 1 if self.cache.add(current_key, 1, rate.period * 2) else self.cache.incr(current_key)
+        decision = sliding_window(previous, current - 1, elapsed, rate)
+        if not decision.allowed:
+            # Отклонённые запросы не считаются
+            self.cache.decr(current_key)
+        return decision
+
+    async def ahit(self, key, rate, now=None):
+        current_key, previous_key, elapsed = self._keys(key, rate, time.time() if now is None else now)
+        previous = await self.cache.aget(previous_key, 0)
+        try:
+            current = await self.cache.aincr(current_key)
+        except ValueError:
+            added = await self.cache.aadd(current_key, 1, rate.period * 2)
+            current = 1 if added else await self.cache.aincr(current_key)
+        decision = sliding_window(previous, current - 1, elapsed, rate)
+        if not decision.allowed:
+            await self.cache.adecr(current_key)
+        return decision
+
+
+def get_store():
+    """Хранилище процесса, заданное настройкой ``ADS_RATE_LIMIT_STORE``"""
+    name = getattr(settings, 'ADS_RATE_LIMIT_STORE', 'ads.ratelimit.MemoryStore')
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = import_string(name)()
+        return _stores[name]
+
+
+def get_rules(url_name):
+    """Лимиты маршрута: [(область, Rate)], область — 'user' или 'ip'"""
+    rules = getattr(settings, 'ADS_RATE_LIMITS', {}).get(url_name)
+    if not rules:
+        return []
+    return [(scope, parse_rate(value)) for scope, value in rules.items()]
+
+
+def client_ip(request):
+    """Адрес клиента: из заголовка прокси, если он задан, иначе адрес соединения.
+
+    Левые записи цепочки присылает сам клиент и может подделать, поэтому
+    берётся запись, добавленная нашим внешним прокси: ``ADS_RATE_LIMIT_TRUSTED_PROXIES``
+    (число своих прокси) позиций от правого края.
+    """
+    header = getattr(settings, 'ADS_RATE_LIMIT_IP_HEADER', '')
+    value = request.META.get(header, '') if header else ''
+    chain = [entry.strip() for entry in value.split(',') if entry.strip()]
+    if not chain:
+        return request.META.get('REMOTE_ADDR', '')
+    hops = max(getattr(settings, 'ADS_RATE_LIMIT_TRUSTED_PROXIES', 1), 1)
+    # Цепочка короче числа прокси — все записи от своих, крайняя левая и есть клиент
+    return chain[max(len(chain) - hops, 0)]
+
+
+def limited_keys(request, url_name, user):
+    """Ключи счётчиков запроса с их лимитами; анонимный пользователь ограничивается только по IP"""
+    keys = []
+    for scope, rate in get_rules(url_name):
+        if scope == 'user':
+            if user is None or not user.is_authenticated:
+                continue
+            ident = user.pk
+        else:
+            ident = client_ip(request)
+        keys.append((f'ratelimit:{url_name}:{scope}:{ident}', rate))
+    return keys
+
+
+def _strictest(decisions):
+    rejected = [decision.retry_after for decision in decisions if not decision.allowed]
+    return Decision(False, max(rejected)) if rejected else ALLOWED
+
+
+def check(request, url_name, user):
+    """Проверяет и учитывает запрос; Decision с наибольшим ожиданием из нарушенных лимитов"""
+    store = get_store()
+    return _strictest([store.hit(key, rate) for key, rate in limited_keys(request, url_name, user)])
+
+
+async def acheck(request, url_name, user):
+    """Асинхронный вариант check()"""
+    store = get_store()
+    return _strictest([await store.ahit(key, rate) for key, rate in limited_keys(request, url_name, user)])
+
+
+def too_many_requests(url_name, retry_after):
+    """Ответ 429: JSON для API, текст для страниц"""
+    message = 'Слишком много запросов'
+    if url_name.startswith('api_'):
+        response = JsonResponse({'error': message, 'retry_after': retry_after}, status=429,
+                                json_dumps_params={'ensure_ascii': False})
+    else:
+        response = HttpResponse(f'{message}, повторите через {retry_after} с', status=429,
+                                content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(retry_after)
+    return response
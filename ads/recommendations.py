@@ -0,0 +1,394 @@
+"""Рекомендации для обмена: «что можно выменять на свои объявления».
+
+Каждое объявление — TF-IDF-вектор по терминам заголовка и описания
+(те же ``tokenize`` и веса полей, что и в поиске, ads/search.py). Термины
+хэшируются в ``DIMENSIONS`` корзин, поэтому словарь не хранится и новые
+слова не требуют перестройки. Векторы нормированы и лежат на диске
+массивами NumPy в формате COO (строка, корзина, вес); процессы открывают
+их через ``mmap`` и делят страницы файлов в кэше ОС.
+
+Запрос пользователя — сумма векторов его объявлений и объявлений из
+принятых обменов, кандидаты ранжируются одним векторным скалярным
+произведением по всем объявлениям. Отклонённые предложения понижают
+объявления того же владельца, объявления, которым пользователь уже
+предлагал обмен, исключаются.
+
+Изменения объявлений попадают в индекс инкрементально: сигналы этого
+процесса и догрузка по ``updated_at`` раз в
+``ADS_RECOMMENDATIONS_REFRESH_INTERVAL`` секунд кладут новые векторы в
+дельту поверх файлов. Полную перестройку (она же пересчитывает IDF)
+выполняют команда ``build_recommendations`` и фоновая задача с тем же
+именем, не запрос пользователя: раз в ``ADS_RECOMMENDATIONS_REBUILD_INTERVAL``
+секунд или при разросшейся дельте процесс сайта открывает более новый
+индекс с диска, если его уже построили, а иначе ставит перестройку в
+очередь и продолжает отвечать по текущему индексу с дельтой. Пока индекса
+нет, или без NumPy, форма предложения показывает последние объявления.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Ad, ArchivedProposal, ExchangeProposal
+from .search import DESCRIPTION_WEIGHT, TITLE_WEIGHT, tokenize
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy необязателен
+    np = None
+
+DIMENSIONS = 1 << 18
+
+# Вклад объявлений из принятых обменов в запрос и штраф владельцу, отклонившему предложение
+ACCEPTED_WEIGHT = 0.5
+REJECTED_OWNER_PENALTY = 0.5
+
+# Сколько последних предложений пользователя учитывается
+HISTORY_SIZE = 500
+
+AD_FIELDS = ('pk', 'user_id', 'title', 'description')
+
+
+def get_limit():
+    return getattr(settings, 'ADS_RECOMMENDATIONS_LIMIT', 50)
+
+
+def vectorize(title, description):
+    """Корзины терминов объявления и их логарифмические частоты"""
+    counts = {}
+    for weight, text in ((TITLE_WEIGHT, title), (DESCRIPTION_WEIGHT, description)):
+        for term in tokenize(text):
+            bucket = zlib.crc32(term.encode()) & (DIMENSIONS - 1)
+            counts[bucket] = counts.get(bucket, 0) + weight
+    cols = np.fromiter(counts, np.int32, len(counts))
+    tf = np.fromiter(counts.values(), np.float32, len(counts))
+    return cols, 1 + np.log(tf)
+
+
+def _idf(df, documents):
+    return (np.log((1 + documents) / (1 + df)) + 1).astype(np.float32)
+
+
+def _normalize(data, rows, size):
+    norms = np.sqrt(np.bincount(rows, weights=data * data, minlength=size)).astype(np.float32)
+    norms[norms == 0] = 1
+    return data / norms[rows]
+
+
+class TermIndex:
+    """Нормированные векторы объявлений: основа из файлов и дельта в памяти.
+
+    Основа — массивы одинаковой длины ``rows``/``cols``/``data`` (COO,
+    отсортированы по строке) и ``ad_ids``/``owners`` по строкам (``ad_ids``
+    по возрастанию, строка ищется двоичным поиском). Изменённые после
+    построения объявления лежат в ``delta``, их строки основы — в ``removed``.
+    """
+    ARRAYS = ('ad_ids', 'owners', 'rows', 'cols', 'data', 'df')
+
+    def __init__(self, ad_ids, owners, rows, cols, data, df):
+        self.ad_ids, self.owners = ad_ids, owners
+        self.rows, self.cols, self.data, self.df = rows, cols, data, df
+        self.offsets = np.searchsorted(rows, np.arange(len(ad_ids) + 1))
+        self.idf = _idf(df, len(ad_ids))
+        self.delta = {}       # id объявления → (владелец, корзины, веса)
+        self.removed = set()  # строки основы, заменённые дельтой или удалённые
+
+    @classmethod
+    def build(cls, ads):
+        """Строит индекс по кортежам AD_FIELDS, отсортированным по id"""
+        ad_ids, owners, rows, cols, data = [], [], [], [], []
+        for row, (ad_id, owner_id, title, description) in enumerate(ads):
+            ad_cols, tf = vectorize(title, description)
+            ad_ids.append(ad_id)
+            owners.append(owner_id)
+            rows.append(np.full(len(ad_cols), row, np.int32))
+            cols.append(ad_cols)
+            data.append(tf)
+        rows = np.concatenate(rows) if rows else np.zeros(0, np.int32)
+        cols = np.concatenate(cols) if cols else np.zeros(0, np.int32)
+        data = np.concatenate(data) if data else np.zeros(0, np.float32)
+        df = np.bincount(cols, minlength=DIMENSIONS).astype(np.int32)
+        data = _normalize(data * _idf(df, len(ad_ids))[cols], rows, len(ad_ids))
+        return cls(np.array(ad_ids, np.int64), np.array(owners, np.int64), rows, cols, data, df)
+
+    def save(self, path):
+        for name in self.ARRAYS:
+            np.save(path / f'{name}.npy', getattr(self, name))
+
+    @classmethod
+    def load(cls, path):
+        return cls(*(np.load(path / f'{name}.npy', mmap_mode='r') for name in cls.ARRAYS))
+
+    def _row(self, ad_id):
+        row = int(np.searchsorted(self.ad_ids, ad_id))
+        if row < len(self.ad_ids) and self.ad_ids[row] == ad_id and row not in self.removed:
+            return row
+        return None
+
+    def vector(self, ad_id):
+        """(корзины, веса) объявления или None, если его нет в индексе"""
+        if ad_id in self.delta:
+            return self.delta[ad_id][1:]
+        row = self._row(ad_id)
+        if row is None:
+            return None
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.cols[start:end], self.data[start:end]
+
+    def owned_by(self, user_id):
+        """id объявлений владельца"""
+        rows = np.flatnonzero(self.owners == user_id)
+        ids = [int(self.ad_ids[row]) for row in rows if row not in self.removed]
+        return ids + [ad_id for ad_id, (owner, _, _) in self.delta.items() if owner == user_id]
+
+    def add(self, ad_id, owner_id, title, description):
+        cols, tf = vectorize(title, description)
+        data = tf * self.idf[cols]
+        norm = np.sqrt(np.dot(data, data))
+        self.remove(ad_id)
+        self.delta[ad_id] = (owner_id, cols, data / norm if norm else data)
+
+    def remove(self, ad_id):
+        self.delta.pop(ad_id, None)
+        row = self._row(ad_id)
+        if row is not None:
+            self.removed.add(row)
+
+    @property
+    def size(self):
+        return len(self.ad_ids) - len(self.removed) + len(self.delta)
+
+    def scores(self, query):
+        """Скалярные произведения запроса со всеми объявлениями: (id, владельцы, оценки)"""
+        scores = np.bincount(self.rows, weights=self.data * query[self.cols], minlength=len(self.ad_ids))
+        ad_ids, owners = self.ad_ids, self.owners
+        if self.removed:
+            keep = np.ones(len(ad_ids), bool)
+            keep[list(self.removed)] = False
+            ad_ids, owners, scores = ad_ids[keep], owners[keep], scores[keep]
+        if self.delta:
+            ad_ids = np.concatenate([ad_ids, np.fromiter(self.delta, np.int64, len(self.delta))])
+            owners = np.concatenate([owners, [owner for owner, _, _ in self.delta.values()]])
+            scores = np.concatenate([scores, [np.dot(data, query[cols]) for _, cols, data in self.delta.values()]])
+        return ad_ids, owners, scores
+
+
+def _history(user):
+    """Обмены пользователя: предложенные объявления, понравившиеся объявления и отказавшие владельцы"""
+    proposed, liked, refused = set(), set(), set()
+    rows = []
+    # Недостающее до HISTORY_SIZE добирается из архива (ads/archive.py): там более старые обмены
+    for model in (ExchangeProposal, ArchivedProposal):
+        rows += model.objects.filter(Q(ad_sender__user=user) | Q(ad_receiver__user=user)).order_by('-id').values_list(
+            'status', 'ad_sender_id', 'ad_receiver_id', 'ad_sender__user_id', 'ad_receiver__user_id',
+        )[:HISTORY_SIZE - len(rows)]
+        if len(rows) >= HISTORY_SIZE:
+            break
+    for status, sender, receiver, sender_owner, receiver_owner in rows:
+        if sender_owner == user.pk:
+            proposed.add(receiver)
+            if status == ExchangeProposal.ACCEPTED:
+                liked.add(receiver)
+            elif status == ExchangeProposal.REJECTED:
+                refused.add(receiver_owner)
+        elif status == ExchangeProposal.ACCEPTED:
+            liked.add(sender)
+    return proposed, liked, refused
+
+
+class RecommendationEngine:
+    """Индекс процесса: загрузка с диска, догрузка изменений, перестройка фоновой задачей"""
+
+    # Доля изменённых объявлений, после которой индекс перестраивается
+    COMPACT_RATIO = 0.1
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.index = None
+            self.watermark = None
+            self.built_at = 0.0
+            self.refreshed_at = self.requested_at = 0.0
+
+    def max_delta(self):
+        """Дельта считается поштучно: когда она разрастается, индекс дешевле перестроить"""
+        return max(1024, self.COMPACT_RATIO * len(self.index.ad_ids))
+
+    @property
+    def available(self):
+        return np is not None
+
+    @property
+    def root(self):
+        return Path(getattr(settings, 'ADS_RECOMMENDATIONS_DIR',
+                            os.path.join(tempfile.gettempdir(), 'bartersystem-recommendations')))
+
+    def _stale(self):
+        interval = getattr(settings, 'ADS_RECOMMENDATIONS_REBUILD_INTERVAL', 3600)
+        return time.time() - self.built_at >= interval or len(self.index.delta) > self.max_delta()
+
+    def get_index(self):
+        """Индекс процесса или None, пока фоновая задача не построила первый"""
+        with self.lock:
+            if self.index is None or self._stale():
+                # Более новый индекс мог построить другой процесс или воркер
+                self.load()
+            if self.index is not None and (time.monotonic() - self.refreshed_at
+                                           >= getattr(settings, 'ADS_RECOMMENDATIONS_REFRESH_INTERVAL', 30)):
+                self.refresh()
+            stale = self.index is None or self._stale()
+        if stale and self.request_rebuild():
+            # ADS_TASKS_EAGER: задача уже выполнена, индекс на диске
+            with self.lock:
+                self.load()
+        return self.index
+
+    def request_rebuild(self):
+        """Ставит перестройку в очередь (не чаще раза в интервал догрузки); True — уже выполнена"""
+        from .tasks import build_recommendations, enqueue, is_eager
+
+        now = time.monotonic()
+        with self.lock:
+            interval = getattr(settings, 'ADS_RECOMMENDATIONS_REFRESH_INTERVAL', 30)
+            if self.requested_at and now - self.requested_at < interval:
+                return False
+            self.requested_at = now
+        # Ключ не даёт процессам сайта поставить больше одной перестройки
+        enqueue(build_recommendations, key='recommendations:rebuild')
+        return is_eager()
+
+    def load(self):
+        """Открывает последний построенный на диске индекс, если он новее индекса процесса"""
+        try:
+            path = self.root / (self.root / 'CURRENT').read_text()
+            meta = json.loads((path / 'meta.json').read_text())
+            if meta['built_at'] <= self.built_at:
+                return False
+            index = TermIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            return False
+        with self.lock:
+            self.index = index
+            self.built_at = meta['built_at']
+            self.watermark = datetime.fromisoformat(meta['watermark'])
+            self.refreshed_at = 0.0
+            self.refresh()
+        return True
+
+    def rebuild(self):
+        """Строит индекс по всем объявлениям одним потоковым запросом и сохраняет его на диск.
+
+        Выполняется командой и задачей ``build_recommendations``, не в запросе
+        пользователя; блокировка берётся только на подмену индекса.
+        """
+        watermark = timezone.now()
+        ads = Ad.objects.visible().order_by('pk').values_list(*AD_FIELDS).iterator(chunk_size=2000)
+        index = TermIndex.build(ads)
+        with self.lock:
+            self.index = index
+            self.watermark = watermark
+            self.built_at = time.time()
+            self.refreshed_at = time.monotonic()
+            self.save()
+            return self.index
+
+    def save(self):
+        """Пишет индекс в новый каталог и атомарно переключает на него ``CURRENT``"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = Path(tempfile.mkdtemp(prefix='index-', dir=self.root))
+        self.index.save(path)
+        meta = {'built_at': self.built_at, 'watermark': self.watermark.isoformat()}
+        (path / 'meta.json').write_text(json.dumps(meta))
+        pointer = self.root / f'CURRENT.{os.getpid()}'
+        pointer.write_text(path.name)
+        os.replace(pointer, self.root / 'CURRENT')
+        # Старые каталоги удаляются; процессы, открывшие их файлы, дочитывают по уже открытым mmap
+        for old in self.root.glob('index-*'):
+            if old != path and time.time() - old.stat().st_mtime > 60:
+                shutil.rmtree(old, ignore_errors=True)
+
+    def refresh(self):
+        """Догружает объявления, изменённые после последней загрузки (в том числе другими процессами)"""
+        with self.lock:
+            watermark = timezone.now()
+            changed = Ad.objects.filter(updated_at__gte=self.watermark).values_list(*AD_FIELDS, 'deleted_at')
+            for *ad, deleted_at in changed:
+                if deleted_at is None:
+                    self.index.add(*ad)
+                else:
+                    self.index.remove(ad[0])
+            self.watermark = watermark
+            self.refreshed_at = time.monotonic()
+
+    def ad_saved(self, ad):
+        with self.lock:
+            if self.index is not None:
+                self.index.add(ad.pk, ad.user_id, ad.title, ad.description)
+
+    def ad_deleted(self, ad_id):
+        with self.lock:
+            if self.index is not None:
+                self.index.remove(ad_id)
+
+    def recommend(self, user, ad_ids=None, limit=None):
+        """id объявлений других пользователей, по убыванию сходства с объявлениями ``user``"""
+        if not self.available:
+            return []
+        limit = limit or get_limit()
+        if self.get_index() is None:
+            return []
+        with self.lock:
+            index = self.index
+            proposed, liked, refused = _history(user)
+            query = np.zeros(DIMENSIONS, np.float32)
+            sources = [(ad_id, 1.0) for ad_id in (ad_ids or index.owned_by(user.pk))]
+            for ad_id, weight in sources + [(ad_id, ACCEPTED_WEIGHT) for ad_id in liked]:
+                vector = index.vector(ad_id)
+                if vector is not None:
+                    np.add.at(query, vector[0], vector[1] * weight)
+            if not query.any():
+                return []
+            candidates, owners, scores = index.scores(query)
+
+        scores[owners == user.pk] = 0
+        if proposed:
+            scores[np.isin(candidates, list(proposed))] = 0
+        if refused:
+            scores[np.isin(owners, list(refused))] *= REJECTED_OWNER_PENALTY
+        count = min(limit, int(np.count_nonzero(scores > 0)))
+        if not count:
+            return []
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [int(ad_id) for ad_id in candidates[top]]
+
+
+_engine = RecommendationEngine()
+
+
+def get_engine():
+    return _engine
+
+
+def recommended_ads(user, limit=None):
+    """Объявления для обмена по убыванию сходства; без NumPy или истории — последние объявления"""
+    limit = limit or get_limit()
+    queryset = Ad.objects.visible().exclude(user=user).select_related('user').only('title', 'user__username')
+    # Запас на объявления, удалённые другими процессами после построения индекса
+    ids = get_engine().recommend(user, limit=limit * 2)
+    if not ids:
+        return list(queryset.order_by('-created_at', '-id')[:limit])
+    ads = queryset.in_bulk(ids)
+    return [ads[ad_id] for ad_id in ids if ad_id in ads][:limit]
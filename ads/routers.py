@@ -0,0 +1,100 @@
+"""Чтение списков с реплик PostgreSQL с «прилипанием» после записи.
+
+По умолчанию и чтение, и запись идут в ``default``. Представления со
+списками (``ReplicaReadMixin``) на время GET-запроса разрешают читать
+модели приложения ``ads`` с реплики из ``ADS_DB_REPLICAS``; сессии и
+пользователи всегда читаются с основной базы — реплика отстаёт, а только
+что созданная сессия на ней могла ещё не появиться.
+
+Запись замечается самим роутером (``db_for_write``), после такого запроса
+``ReplicaRoutingMiddleware`` (ads/middleware.py) ставит cookie на
+``ADS_DB_STICKY_SECONDS`` секунд, и пока она жива, все чтения пользователя
+идут в основную базу — своё новое объявление или предложение он увидит
+сразу, не дожидаясь репликации.
+Cookie, а не сессия, — чтобы проверка не требовала запроса к базе и
+работала в асинхронных представлениях.
+"""
+import contextvars
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_COOKIE = 'ads_db_primary'
+
+# Приложения, чьи таблицы можно читать с реплики
+REPLICA_APPS = frozenset({'ads'})
+
+_state = contextvars.ContextVar('ads_db_routing', default=None)
+
+
+class RoutingState:
+    """Маршрутизация текущего запроса: разрешена ли реплика и была ли запись"""
+    __slots__ = ('use_replica', 'wrote')
+
+    def __init__(self):
+        self.use_replica = False
+        self.wrote = False
+
+
+def start_request():
+    state = RoutingState()
+    return state, _state.set(state)
+
+
+def finish_request(token):
+    _state.reset(token)
+
+
+def get_replicas():
+    return getattr(settings, 'ADS_DB_REPLICAS', [])
+
+
+def read_db(model):
+    """Псевдоним базы для чтения ``model`` в текущем запросе.
+
+    Нужен там, где запрос выполняется уже после выхода из представления
+    (потоковые ответы): база фиксируется через ``.using()`` заранее.
+    """
+    state = _state.get()
+    replicas = get_replicas()
+    if (state is None or not state.use_replica or state.wrote or not replicas
+            or model._meta.app_label not in REPLICA_APPS):
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+class ReplicaRouter:
+    """Роутер: запись — в ``default``, чтение списков — с реплики"""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Связанные объекты читаются из той же базы, что и исходный
+            return instance._state.db
+        return read_db(model)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+class ReplicaReadMixin:
+    """Разрешает GET-запросу представления читать с реплики, если пользователь недавно ничего не записывал"""
+
+    def dispatch(self, request, *args, **kwargs):
+        state = _state.get()
+        if state is not None and request.method in ('GET', 'HEAD') and STICKY_COOKIE not in request.COOKIES:
+            state.use_replica = True
+        return super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,176 @@
+"""Полнотекстовый поиск по заголовкам и описаниям объявлений.
+
+Бэкенд выбирается настройкой ``ADS_SEARCH_BACKEND``: ``'auto'`` (по типу
+базы данных), ``'postgres'``, ``'python'`` или путь к собственному классу.
+Любой бэкенд возвращает отфильтрованный queryset с аннотацией ``rank``.
+"""
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+WORD_RE = re.compile(r'\w+')
+
+# Окончания, отбрасываемые упрощённым стеммером (от длинных к коротким)
+RUSSIAN_SUFFIXES = sorted([
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой', 'ей', 'ий', 'ый', 'ая', 'яя',
+    'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ом', 'ем', 'ах', 'ях', 'ов', 'ев', 'ам', 'ям',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+TITLE_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+
+
+def normalize(word):
+    """Приводит слово к упрощённой основе"""
+    word = word.lower().replace('ё', 'е')
+    if len(word) > 4:
+        for suffix in RUSSIAN_SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text):
+    """Разбивает текст на нормализованные термины"""
+    return [normalize(w) for w in WORD_RE.findall(text or '') if len(w) > 1]
+
+
+class BaseSearchBackend:
+    """Интерфейс бэкенда поиска"""
+
+    # Нужно ли обновлять индекс после сохранения объявления (задача sync_search_index)
+    indexes_on_save = True
+
+    def search(self, queryset, query):
+        """Фильтрует queryset по запросу и добавляет аннотацию rank"""
+        raise NotImplementedError
+
+    def index(self, ad):
+        """Обновляет индекс для одного объявления"""
+
+    def index_many(self, ads):
+        """Индексирует новые объявления, созданные в обход сигналов (bulk_create)"""
+        for ad in ads:
+            self.index(ad)
+
+    def remove(self, ad_id):
+        """Удаляет объявление из индекса"""
+
+    def rebuild(self, queryset, batch_size=1000):
+        """Полностью перестраивает индекс, возвращает число объявлений"""
+        return 0
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """Поиск через tsvector (конфигурация russian) и триграммы pg_trgm.
+
+    Колонка ``search_vector`` генерируется самой базой (см. миграцию
+    0003), поэтому синхронизация при сохранении не нужна.
+    """
+    config = 'russian'
+    indexes_on_save = False
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField, TrigramSimilarity
+
+        vector = RawSQL(f'{queryset.model._meta.db_table}.search_vector', [], output_field=SearchVectorField())
+        search_query = SearchQuery(query, config=self.config, search_type='websearch')
+        return queryset.alias(search_vector=vector).annotate(
+            rank=SearchRank(vector, search_query) + TrigramSimilarity('title', query),
+        ).filter(
+            Q(search_vector=search_query) | Q(title__trigram_similar=query)
+        )
+
+    def rebuild(self, queryset, batch_size=1000):
+        with connection.cursor() as cursor:
+            cursor.execute('REINDEX INDEX ads_ad_search_vector_idx')
+            cursor.execute('REINDEX INDEX ads_ad_title_trgm_idx')
+            cursor.execute('ANALYZE ads_ad')
+        return queryset.count()
+
+
+class InvertedIndexBackend(BaseSearchBackend):
+    """Инвертированный индекс на чистом Python поверх таблицы AdSearchTerm.
+
+    Подходит для SQLite и тестов. Ранг — сумма весов совпавших терминов,
+    заголовок весит больше описания. Все термины запроса обязательны.
+    """
+
+    def search(self, queryset, query):
+        terms = set(tokenize(query))
+        if not terms:
+            return queryset.none()
+        return queryset.filter(search_terms__term__in=terms).annotate(
+            rank=Sum('search_terms__weight'),
+            matched_terms=Count('search_terms__term', distinct=True),
+        ).filter(matched_terms=len(terms))
+
+    def index(self, ad):
+        from .models import AdSearchTerm
+
+        with transaction.atomic():
+            AdSearchTerm.objects.filter(ad_id=ad.pk).delete()
+            AdSearchTerm.objects.bulk_create(self._terms_for(ad))
+
+    def index_many(self, ads):
+        from .models import AdSearchTerm
+
+        AdSearchTerm.objects.bulk_create([term for ad in ads for term in self._terms_for(ad)])
+
+    def remove(self, ad_id):
+        from .models import AdSearchTerm
+
+        AdSearchTerm.objects.filter(ad_id=ad_id).delete()
+
+    def rebuild(self, queryset, batch_size=1000):
+        from .models import AdSearchTerm
+
+        total, batch = 0, []
+        with transaction.atomic():
+            AdSearchTerm.objects.all().delete()
+            for ad in queryset.only('pk', 'title', 'description').iterator(chunk_size=batch_size):
+                batch.extend(self._terms_for(ad))
+                total += 1
+                if len(batch) >= batch_size:
+                    AdSearchTerm.objects.bulk_create(batch, batch_size=batch_size)
+                    batch = []
+            AdSearchTerm.objects.bulk_create(batch, batch_size=batch_size)
+        return total
+
+    def _terms_for(self, ad):
+        from .models import AdSearchTerm
+
+        weights = Counter()
+        for term in tokenize(ad.title):
+            weights[term[:AdSearchTerm.TERM_MAX_LENGTH]] += TITLE_WEIGHT
+        for term in tokenize(ad.description):
+            weights[term[:AdSearchTerm.TERM_MAX_LENGTH]] += DESCRIPTION_WEIGHT
+        return [
+            AdSearchTerm(ad_id=ad.pk, term=term, weight=weight)
+            for term, weight in weights.items()
+        ]
+
+
+BACKENDS = {
+    'postgres': PostgresSearchBackend,
+    'python': InvertedIndexBackend,
+}
+
+_backends = {}
+
+
+def get_search_backend():
+    """Возвращает экземпляр бэкенда, заданного настройкой ADS_SEARCH_BACKEND"""
+    name = getattr(settings, 'ADS_SEARCH_BACKEND', 'auto')
+    if name == 'auto':
+        name = 'postgres' if connection.vendor == 'postgresql' else 'python'
+    if name not in _backends:
+        backend_class = BACKENDS[name] if name in BACKENDS else import_string(name)
+        _backends[name] = backend_class()
+    return _backends[name]
@@ -0,0 +1,127 @@
+"""Генерация синтетических данных для бенчмарков.
+
+Данные детерминированы зерном ``seed`` и записываются пакетами через
+``bulk_create``, поэтому подходят для наборов в миллионы строк. Сигналы
+при этом не отправляются: поисковый индекс не строится, счётчики
+предложений пересчитываются в конце.
+
+``skew`` приближает данные к реальным: при ``skew > 0`` число объявлений
+у пользователя и популярность объявлений среди получателей предложений
+распределены по Ципфу (вес ``1 / rank ** skew``) — немного активных
+пользователей и много почти пустых профилей.
+"""
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .counters import reconcile_counters
+from .models import Ad, ExchangeProposal
+
+WORDS = [
+    'телефон', 'ноутбук', 'велосипед', 'диван', 'квартира', 'гараж', 'куртка', 'часы', 'книга',
+    'планшет', 'наушники', 'стол', 'стул', 'автомобиль', 'мотоцикл', 'самокат', 'холодильник',
+    'кроссовки', 'рюкзак', 'фотоаппарат', 'гитара', 'коляска', 'палатка', 'монитор', 'лампа',
+]
+ADJECTIVES = ['новый', 'старый', 'рабочий', 'красивый', 'удобный', 'мощный', 'лёгкий', 'редкий']
+STATUSES = [key for key, _ in ExchangeProposal.STATUS_CHOICES]
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Временно отключает auto_now_add, чтобы записать заданные даты"""
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now_add', False)
+    ]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _chooser(rng, items, skew):
+    """Равномерный выбор или выбор по Ципфу с накопленными весами (O(log n) на выбор)"""
+    if not skew:
+        return lambda: rng.choice(items)
+    cum_weights = list(accumulate(1 / rank ** skew for rank in range(1, len(items) + 1)))
+    return lambda: rng.choices(items, cum_weights=cum_weights)[0]
+
+
+def seed_dataset(users=100, ads=10000, proposals=5000, seed=0, batch_size=5000, prefix='bench', days=365, skew=0.0):
+    """Создаёт пользователей, объявления и граф предложений обмена.
+
+    Возвращает словарь с количеством созданных строк по типам.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    span = days * 24 * 3600
+
+    with transaction.atomic(), explicit_timestamps(Ad, ExchangeProposal):
+        User.objects.bulk_create(
+            (User(username=f'{prefix}_{i}', password='!') for i in range(users)),
+            batch_size=batch_size,
+        )
+        user_ids = list(
+            User.objects.filter(username__startswith=f'{prefix}_').order_by('pk').values_list('pk', flat=True)
+        )
+        choose_owner = _chooser(rng, user_ids, skew)
+
+        def make_ad(i):
+            word = rng.choice(WORDS)
+            return Ad(
+                user_id=choose_owner(),
+                title=f'{rng.choice(ADJECTIVES).capitalize()} {word} №{i}',
+                description=' '.join(rng.choice(ADJECTIVES + WORDS) for _ in range(12)),
+                category=rng.choice(Ad.CATEGORIES)[0],
+                condition=rng.choice(Ad.CONDITION_CHOICES)[0],
+                created_at=now - timedelta(seconds=rng.randrange(span)),
+            )
+
+        for batch in _batches((make_ad(i) for i in range(ads)), batch_size):
+            Ad.objects.bulk_create(batch)
+
+        # Порядок задан явно: иначе он зависит от плана запроса, и одно зерно даёт разные графы
+        ad_owners = list(Ad.objects.filter(user_id__in=user_ids).order_by('pk').values_list('pk', 'user_id'))
+        choose_receiver = _chooser(rng, ad_owners, skew)
+
+        def make_proposal():
+            while True:
+                sender, receiver = rng.choice(ad_owners), choose_receiver()
+                if sender[1] != receiver[1] or len(user_ids) == 1:
+                    break
+            return ExchangeProposal(
+                ad_sender_id=sender[0],
+                ad_receiver_id=receiver[0],
+                comment='',
+                status=rng.choices(STATUSES, weights=[6, 2, 2])[0],
+                created_at=now - timedelta(seconds=rng.randrange(span)),
+            )
+
+        created_proposals = 0
+        if ad_owners:
+            for batch in _batches((make_proposal() for _ in range(proposals)), batch_size):
+                ExchangeProposal.objects.bulk_create(batch)
+                created_proposals += len(batch)
+            # bulk_create обходит ExchangeProposal.save, счётчики пересчитываются разом
+            reconcile_counters(batch_size=batch_size)
+
+    return {'users': len(user_ids), 'ads': len(ad_owners), 'proposals': created_proposals}
@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate_ad, invalidate_feed
+from .images import url_version
+from .matching import get_engine
+from .metrics import install_sql_wrapper
+from .models import Ad, ArchivedProposal, ExchangeProposal, ads_deleted, proposals_answered
+from .notifications import notify
+from .recommendations import get_engine as get_recommendations
+from .search import get_search_backend
+from .tasks import enqueue, prefetch_image, sync_search_index
+
+
+@receiver(post_save, sender=Ad)
+@receiver(post_delete, sender=Ad)
+def index_ad(sender, instance, **kwargs):
+    """Ставит переиндексацию объявления в фоновую очередь"""
+    if get_search_backend().indexes_on_save:
+        enqueue(sync_search_index, instance.pk, key=f'search:{instance.pk}')
+
+
+@receiver(post_save, sender=Ad)
+def prefetch_ad_image(sender, instance, **kwargs):
+    """Строит миниатюры в фоне, чтобы первый показ в ленте не ждал скачивания"""
+    if instance.image_url and getattr(settings, 'ADS_IMAGE_PREFETCH', True):
+        enqueue(prefetch_image, instance.image_url, key=f'image:{url_version(instance.image_url)}')
+
+
+@receiver(post_save, sender=Ad)
+@receiver(post_delete, sender=Ad)
+def invalidate_ad_cache(sender, instance, **kwargs):
+    """Сбрасывает кэш ленты и карточки изменённого объявления после фиксации транзакции"""
+    # До фиксации параллельный запрос закэшировал бы старую ленту уже под новой версией
+    pk = instance.pk
+    transaction.on_commit(lambda: invalidate_ad(pk))
+
+
+@receiver(post_save, sender=Ad)
+def update_recommendations(sender, instance, **kwargs):
+    """Пересчитывает вектор объявления в индексе рекомендаций этого процесса"""
+    transaction.on_commit(lambda: get_recommendations().ad_saved(instance))
+
+
+@receiver(post_delete, sender=Ad)
+def remove_from_recommendations(sender, instance, **kwargs):
+    ad_id = instance.pk
+    transaction.on_commit(lambda: get_recommendations().ad_deleted(ad_id))
+
+
+@receiver(ads_deleted)
+def invalidate_deleted_ads(sender, ad_ids, **kwargs):
+    """Надгробия ставит UPDATE без сигналов модели: кэш ленты и карточек сбрасывается здесь"""
+    for ad_id in ad_ids:
+        invalidate_ad(ad_id)
+
+
+@receiver(ads_deleted)
+def forget_deleted_ads(sender, ad_ids, **kwargs):
+    """Удалённые объявления выходят из графа обменов и индекса рекомендаций"""
+    get_engine().ads_deleted(ad_ids)
+    for ad_id in ad_ids:
+        get_recommendations().ad_deleted(ad_id)
+
+
+@receiver(post_save, sender=User)
+def invalidate_feed_on_rename(sender, instance, update_fields=None, **kwargs):
+    """Имя автора выводится в ленте; вход пользователя (last_login) кэш не трогает"""
+    if update_fields is None or 'username' in update_fields:
+        invalidate_feed()
+
+
+@receiver(post_save, sender=ExchangeProposal)
+def update_trade_graph(sender, instance, **kwargs):
+    """Добавляет предложение в граф обменов или убирает его после ответа"""
+    transaction.on_commit(lambda: get_engine().proposal_saved(instance))
+
+
+@receiver(post_save, sender=ExchangeProposal)
+def notify_proposal_saved(sender, instance, created, **kwargs):
+    """Новое предложение — владельцу объявления-получателя, смена статуса — обеим сторонам.
+
+    post_save приходит до того, как ``save()`` запомнит новый статус, поэтому
+    в ``_loaded_status`` ещё прежнее значение.
+    """
+    if created:
+        change = 'created'
+    elif getattr(instance, '_loaded_status', None) not in (None, instance.status):
+        change = 'status'
+    else:
+        return
+    if ExchangeProposal.ad_sender.is_cached(instance) and ExchangeProposal.ad_receiver.is_cached(instance):
+        sender_id, receiver_id = instance.ad_sender.user_id, instance.ad_receiver.user_id
+    else:
+        owners = dict(Ad.objects.filter(pk__in=[instance.ad_sender_id, instance.ad_receiver_id]).values_list('pk', 'user_id'))
+        sender_id, receiver_id = owners.get(instance.ad_sender_id), owners.get(instance.ad_receiver_id)
+    data = {
+        'id': instance.pk, 'status': instance.status, 'change': change,
+        'ad_sender': instance.ad_sender_id, 'ad_receiver': instance.ad_receiver_id,
+    }
+    users = [receiver_id] if created else [receiver_id, sender_id]
+    transaction.on_commit(lambda: notify(users, 'proposal', data))
+
+
+@receiver(post_delete, sender=ExchangeProposal)
+def update_counters_on_delete(sender, instance, **kwargs):
+    """Удаление (в том числе каскадное) уменьшает счётчики.
+
+    Строки счётчиков не создаются: при удалении пользователя его строка
+    может быть уже удалена каскадом раньше предложений.
+    """
+    instance._update_counters(total=-1, pending=-int(instance.status == ExchangeProposal.PENDING), create=False)
+
+
+@receiver(post_delete, sender=ArchivedProposal)
+def update_counters_on_archive_delete(sender, instance, **kwargs):
+    """Архивные предложения входят в общие счётчики: их удаление (каскадом с объявлением) тоже уменьшает"""
+    instance._update_counters(total=-1, create=False)
+
+
+@receiver(post_delete, sender=ExchangeProposal)
+def remove_from_trade_graph(sender, instance, **kwargs):
+    """Удалённое предложение (в том числе каскадом вместе с объявлением) выходит из графа"""
+    transaction.on_commit(lambda: get_engine().proposal_deleted(instance.pk))
+
+
+@receiver(proposals_answered)
+def close_answered_proposals(sender, proposal_ids, ad_ids, **kwargs):
+    """Ответ условным UPDATE: предложения и обменянные объявления выходят из графа"""
+    get_engine().proposals_answered(proposal_ids, ad_ids)
+
+
+@receiver(proposals_answered)
+def notify_proposals_answered(sender, proposal_ids, **kwargs):
+    """Ответ условным UPDATE: событие каждой стороне каждого предложения"""
+    rows = ExchangeProposal.objects.filter(pk__in=proposal_ids).values_list(
+        'pk', 'status', 'ad_sender_id', 'ad_receiver_id', 'ad_sender__user_id', 'ad_receiver__user_id',
+    )
+    for pk, status, ad_sender, ad_receiver, sender_id, receiver_id in rows.iterator():
+        data = {'id': pk, 'status': status, 'change': 'status', 'ad_sender': ad_sender, 'ad_receiver': ad_receiver}
+        notify([receiver_id, sender_id], 'proposal', data)
+
+
+@receiver(connection_created)
+def count_request_queries(sender, connection, **kwargs):
+    """Подключает к новому соединению счётчик SQL-запросов для метрик"""
+    install_sql_wrapper(connection)
@@ -0,0 +1,53 @@
+"""Хранилище статики для боевого профиля (bartersystem/production_settings.py).
+
+``ManifestStaticFilesStorage`` добавляет в имена файлов хеш содержимого:
+ссылки из ``{% static %}`` меняются при каждом изменении файла, поэтому
+веб-сервер может отдавать статику с заголовком «хранить год». Поверх этого
+рядом с каждым текстовым файлом с хешем кладётся его сжатая копия (``.gz``,
+и ``.br``, если установлен пакет brotli) — веб-сервер отдаёт её как есть,
+не сжимая файл на каждом запросе.
+"""
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.txt', '.html', '.json', '.xml', '.ico')
+
+
+def compress(content):
+    """Сжатые варианты содержимого: {расширение: байты}"""
+    # mtime=0 — одинаковый файл даёт одинаковый архив, повторный collectstatic ничего не меняет
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content)
+    return variants
+
+
+class PrecompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Статика с хешами в именах и заранее сжатыми копиями"""
+
+    # Копия, сэкономившая меньше этой доли, не нужна: проще отдать исходный файл
+    min_saving = 0.05
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if not dry_run:
+            for name in set(self.hashed_files.values()):
+                if name.endswith(COMPRESSIBLE):
+                    self.save_compressed(name)
+
+    def save_compressed(self, name):
+        with self.open(name) as handle:
+            content = handle.read()
+        for extension, data in compress(content).items():
+            path = name + extension
+            if self.exists(path):
+                self.delete(path)
+            if len(data) < len(content) * (1 - self.min_saving):
+                self._save(path, ContentFile(data))
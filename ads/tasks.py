@@ -0,0 +1,346 @@
+"""Фоновая очередь задач поверх таблицы ``Task``.
+
+Обработчики сигналов не выполняют тяжёлую работу (поисковый индекс,
+миниатюры) в запросе пользователя, а ставят задачу: строка вставляется
+в той же транзакции, что и изменение объявления, поэтому задача видна
+воркеру только после фиксации и не теряется при падении процесса.
+Выполняет задачи ``manage.py run_worker``.
+
+Ключ идемпотентности (``key``) допускает не больше одной ожидающей задачи
+с таким ключом: десять сохранений объявления подряд дадут одну
+переиндексацию. Упавшая задача повторяется с экспоненциальной задержкой
+до ``max_attempts`` раз, затем остаётся в статусе ``failed``.
+
+При ``ADS_TASKS_EAGER`` задачи выполняются сразу при постановке, без
+воркера — так работают тесты и локальная разработка.
+"""
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, connections, transaction
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from .models import Ad, Task
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+
+
+def task(name=None, max_attempts=5):
+    """Регистрирует функцию как фоновую задачу; аргументы должны сериализоваться в JSON"""
+    def decorator(func):
+        func.task_name = name or f'{func.__module__}.{func.__name__}'
+        func.max_attempts = max_attempts
+        _registry[func.task_name] = func
+        return func
+    return decorator
+
+
+def get_task(name):
+    try:
+        return _registry[name]
+    except KeyError:
+        raise LookupError(f'Неизвестная задача: {name}')
+
+
+def is_eager():
+    return getattr(settings, 'ADS_TASKS_EAGER', False)
+
+
+def enqueue(func, *args, key=None, delay=0):
+    """Ставит задачу в очередь; с тем же ``key`` ожидающая задача не дублируется.
+
+    Возвращает созданный ``Task`` или None, если задача уже стоит в очереди
+    (или выполнена сразу в режиме ``ADS_TASKS_EAGER``).
+    """
+    if is_eager():
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Задача %s завершилась ошибкой', func.task_name)
+        return None
+    item = Task(
+        name=func.task_name, args=list(args), idempotency_key=key, max_attempts=func.max_attempts,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+    if key is None:
+        item.save()
+        return item
+    # Дубликат отсекает частичный уникальный индекс по ключам ожидающих задач;
+    # точка сохранения не даёт ошибке прервать транзакцию вызывающего кода
+    try:
+        with transaction.atomic():
+            item.save()
+    except IntegrityError:
+        return None
+    return item
+
+
+def backoff_delay(attempts):
+    """Задержка перед повтором: база · 2^(попытка−1) с разбросом ±25%, не больше потолка"""
+    base = getattr(settings, 'ADS_TASKS_RETRY_DELAY', 5)
+    ceiling = getattr(settings, 'ADS_TASKS_RETRY_MAX_DELAY', 3600)
+    delay = min(ceiling, base * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.75, 1.25)
+
+
+def claim(worker_id, limit):
+    """Забирает до ``limit`` готовых задач в статус running, возвращает их id.
+
+    На PostgreSQL строки выбираются ``FOR UPDATE SKIP LOCKED`` — несколько
+    воркеров не ждут друг друга. На других базах пачка забирается одним
+    условным UPDATE по статусу (строку получит только один воркер), а затем
+    перечитывается по метке воркера и времени захвата.
+    """
+    now = timezone.now()
+    ready = Task.objects.filter(status=Task.QUEUED, run_at__lte=now).order_by('run_at', 'pk')
+    fields = {'status': Task.RUNNING, 'started_at': now, 'locked_by': worker_id, 'attempts': F('attempts') + 1}
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(ready.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            Task.objects.filter(pk__in=ids).update(**fields)
+        return ids
+    candidates = list(ready.values_list('pk', flat=True)[:limit])
+    if not candidates or not Task.objects.filter(pk__in=candidates, status=Task.QUEUED).update(**fields):
+        return []
+    return list(Task.objects.filter(
+        pk__in=candidates, status=Task.RUNNING, locked_by=worker_id, started_at=now,
+    ).order_by('run_at', 'pk').values_list('pk', flat=True))
+
+
+def execute(task_id):
+    """Выполняет забранную задачу и записывает результат; возвращает итоговый статус"""
+    item = Task.objects.get(pk=task_id)
+    try:
+        get_task(item.name)(*item.args)
+    except Exception as error:
+        logger.exception('Задача %s (#%s) завершилась ошибкой', item.name, item.pk)
+        return _fail(item, error)
+    Task.objects.filter(pk=item.pk).update(status=Task.DONE, finished_at=timezone.now(), last_error='')
+    return Task.DONE
+
+
+def _execute_in_pool(task_id):
+    # Поток или процесс пула держит своё соединение: как и после запроса, закрываем устаревшее
+    close_old_connections()
+    try:
+        return execute(task_id)
+    finally:
+        close_old_connections()
+
+
+def _fail(item, error):
+    message = f'{type(error).__name__}: {error}'
+    if item.attempts >= item.max_attempts:
+        Task.objects.filter(pk=item.pk).update(status=Task.FAILED, finished_at=timezone.now(), last_error=message)
+        return Task.FAILED
+    run_at = timezone.now() + timedelta(seconds=backoff_delay(item.attempts))
+    try:
+        with transaction.atomic():
+            Task.objects.filter(pk=item.pk).update(
+                status=Task.QUEUED, run_at=run_at, locked_by='', last_error=message,
+            )
+    except IntegrityError:
+        # Пока задача выполнялась, с тем же ключом поставили новую — повтор сделает она
+        Task.objects.filter(pk=item.pk).update(status=Task.DONE, finished_at=timezone.now(), last_error=message)
+        return Task.DONE
+    return Task.QUEUED
+
+
+def requeue_stale(timeout):
+    """Возвращает в очередь задачи, зависшие в running дольше ``timeout`` секунд (воркер упал)"""
+    stale = Task.objects.filter(status=Task.RUNNING, started_at__lt=timezone.now() - timedelta(seconds=timeout))
+    requeued = 0
+    for item in stale:
+        if item.attempts >= item.max_attempts:
+            requeued += Task.objects.filter(pk=item.pk, status=Task.RUNNING).update(
+                status=Task.FAILED, finished_at=timezone.now(), last_error='Превышено время выполнения',
+            )
+            continue
+        try:
+            with transaction.atomic():
+                requeued += Task.objects.filter(pk=item.pk, status=Task.RUNNING).update(
+                    status=Task.QUEUED, run_at=timezone.now(), locked_by='', last_error='Превышено время выполнения',
+                )
+        except IntegrityError:
+            Task.objects.filter(pk=item.pk).update(status=Task.DONE, finished_at=timezone.now())
+    return requeued
+
+
+def purge_finished(retention):
+    """Удаляет выполненные задачи старше ``retention`` секунд; упавшие хранятся для разбора"""
+    deleted, _ = Task.objects.filter(
+        status=Task.DONE, finished_at__lt=timezone.now() - timedelta(seconds=retention),
+    ).delete()
+    return deleted
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def queue_metrics(window=900):
+    """Метрики очереди: глубина по статусам, возраст старейшей готовой задачи,
+    пропускная способность и задержки (p50/p95, секунды) задач, завершённых
+    за последние ``window`` секунд.
+
+    ``latency`` — от постановки до завершения, ``runtime`` — само выполнение.
+    """
+    now = timezone.now()
+    depth = dict.fromkeys((Task.QUEUED, Task.RUNNING, Task.FAILED), 0)
+    counts = Task.objects.exclude(status=Task.DONE).values('status').annotate(n=Count('pk')).values_list('status', 'n')
+    for status, count in counts:
+        depth[status] = count
+    ready = Task.objects.filter(status=Task.QUEUED, run_at__lte=now)
+    oldest = ready.aggregate(oldest=Min('run_at'))['oldest']
+    finished = list(
+        Task.objects.filter(status=Task.DONE, finished_at__gte=now - timedelta(seconds=window))
+        .values_list('created_at', 'started_at', 'finished_at')[:10000]
+    )
+    latency = [(done - created).total_seconds() for created, _, done in finished]
+    runtime = [(done - started).total_seconds() for _, started, done in finished if started]
+    return {
+        'depth': depth,
+        'ready': ready.count(),
+        'oldest_ready_age': (now - oldest).total_seconds() if oldest else 0,
+        'done': len(finished),
+        'throughput': len(finished) / window,
+        'latency_p50': _percentile(latency, 0.5),
+        'latency_p95': _percentile(latency, 0.95),
+        'runtime_p50': _percentile(runtime, 0.5),
+        'runtime_p95': _percentile(runtime, 0.95),
+    }
+
+
+def _init_process():
+    """Инициализация процесса пула: соединения родителя нельзя использовать после fork"""
+    import django
+    django.setup()
+    for alias in connections:
+        connections[alias].close()
+
+
+class Worker:
+    """Цикл воркера: забирает готовые задачи и выполняет их в пуле потоков или процессов.
+
+    Потоки подходят для задач, ждущих сеть и базу (миниатюры, индекс), процессы —
+    для счётных задач, которым мешает GIL.
+    """
+
+    def __init__(self, concurrency=4, processes=False, poll_interval=1.0):
+        self.concurrency = max(1, concurrency)
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self.processed = 0
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def _executor(self):
+        if self.processes:
+            # Соединения закрываются до fork, иначе дочерние процессы унаследуют один сокет
+            connections.close_all()
+            return ProcessPoolExecutor(max_workers=self.concurrency, initializer=_init_process)
+        return ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ads-worker')
+
+    def run(self, once=False):
+        """Выполняет задачи до сигнала остановки; ``once`` — только то, что готово сейчас"""
+        timeout = getattr(settings, 'ADS_TASKS_TIMEOUT', 600)
+        retention = getattr(settings, 'ADS_TASKS_RETENTION', 24 * 3600)
+        maintenance_at = 0
+        running = set()
+        with self._executor() as executor:
+            while not self.stopping.is_set():
+                if time.monotonic() >= maintenance_at:
+                    requeue_stale(timeout)
+                    purge_finished(retention)
+                    maintenance_at = time.monotonic() + 60
+
+                free = self.concurrency * 2 - len(running)
+                ids = claim(self.worker_id, free) if free > 0 else []
+                running.update(executor.submit(_execute_in_pool, pk) for pk in ids)
+                if once and not ids and not running:
+                    break
+                if running:
+                    done, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    running = set(running)
+                    self.processed += len(done)
+                elif not ids:
+                    self.stopping.wait(self.poll_interval)
+            # Корректная остановка: новые задачи не берутся, начатые дорабатывают
+            self.processed += len(wait(running).done)
+        return self.processed
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+
+@task(max_attempts=5)
+def sync_search_index(ad_id):
+    """Приводит поисковый индекс объявления к текущему состоянию строки"""
+    from .search import get_search_backend
+
+    backend = get_search_backend()
+    ad = Ad.objects.filter(pk=ad_id).only('title', 'description').first()
+    if ad is None:
+        backend.remove(ad_id)
+    else:
+        backend.index(ad)
+
+
+@task(max_attempts=5)
+def purge_deleted_ads(ad_ids):
+    """Очищает объявления, помеченные удалёнными, вместе с их предложениями"""
+    from .deletion import purge_ads
+
+    purge_ads(ad_ids)
+
+
+@task(max_attempts=5)
+def purge_deleted_user(user_id):
+    """Завершает удаление пользователя: объявления, предложения и сама учётная запись"""
+    from .deletion import purge_user
+
+    purge_user(user_id)
+
+
+@task(max_attempts=3)
+def build_trade_graph():
+    """Перестраивает граф цепочек обмена и сохраняет снимок для процессов сайта"""
+    from .matching import MatchingEngine
+
+    MatchingEngine().rebuild()
+
+
+@task(max_attempts=3)
+def build_recommendations():
+    """Перестраивает индекс рекомендаций и сохраняет его для процессов сайта"""
+    from .recommendations import RecommendationEngine
+
+    engine = RecommendationEngine()
+    if engine.available:
+        engine.rebuild()
+
+
+@task(max_attempts=3)
+def prefetch_image(url):
+    """Строит миниатюры изображения объявления"""
+    from .images import prefetch
+
+    prefetch(url)
@@ -0,0 +1,32 @@
+"""Вспомогательные средства для тестов приложения ads"""
+from unittest import mock
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+
+
+class QueryBudgetMixin:
+    """Проверка бюджета SQL-запросов для представлений-списков.
+
+    Страница запрашивается с несколькими размерами: число запросов должно
+    укладываться в бюджет и не зависеть от размера страницы, поэтому
+    любой N+1 в представлении или шаблоне сразу роняет тест.
+    """
+    page_sizes = (2, 20)
+
+    def assertQueryBudget(self, url, budget, data=None, page_sizes=None):
+        view_class = resolve(url).func.view_class
+        counts, queries = {}, {}
+        for size in page_sizes or self.page_sizes:
+            with mock.patch.object(view_class, 'paginate_by', size):
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(url, data)
+            self.assertEqual(response.status_code, 200)
+            counts[size] = len(context.captured_queries)
+            queries[size] = [q['sql'] for q in context.captured_queries]
+
+        largest = max(counts)
+        message = f'{url}: запросов по размерам страниц {counts}, бюджет {budget}\n' + '\n'.join(queries[largest])
+        self.assertLessEqual(counts[largest], budget, message)
+        self.assertEqual(len(set(counts.values())), 1, message)
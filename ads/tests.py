@@ -1,6 +1,55 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.urls import include, path
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from .models import Ad, ExchangeProposal
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Count
+from django.db.models.signals import post_delete
+from django.utils import timezone
+from . import benchmark, metrics, ratelimit
+from .counters import reconcile_counters
+from .deletion import delete_ads, delete_user, fast_delete_allowed, purge_ads
+from .events import PING, EventStreamApp, load_user
+from .models import Ad, AdSearchTerm, ArchivedProposal, ExchangeProposal, Task, UserStats
+from .routers import STICKY_COOKIE, ReplicaRouter
+from .archive import ProposalHistory, archive_proposals
+from .async_views import AsyncAdListView, AsyncMyAdsView, AsyncReceivedProposalsView
+from .images import ImageCache, ImageError, fetch_image
+from .matching import EDGE_FIELDS, TradeGraph, get_engine, load_cycles
+from .notifications import RESYNC, LocalBroker, get_broker
+from .pagination import encode_cursor
+from .ratelimit import CacheStore, MemoryStore, parse_rate
+from .recommendations import RecommendationEngine, get_engine as get_recommendations, np
+from .search import normalize
+from .storage import PrecompressedManifestStaticFilesStorage
+from .seeding import seed_dataset
+from .tasks import claim, enqueue, execute, prefetch_image, queue_metrics, requeue_stale, sync_search_index, task
+from .testing import QueryBudgetMixin
+from .views import AdListView
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 class AdTests(TestCase):
     def setUp(self):
@@ -49,20 +98,20 @@ class ExchangeProposalTests(TestCase):
             ad_sender=self.ad_sender,
             ad_receiver=self.ad_receiver,
             comment='Обмен интересен?',
-            status='Ожидает'
+            status='pending'
         )
 
     def test_proposal_created(self):
         self.assertEqual(ExchangeProposal.objects.count(), 1)
-        self.assertEqual(self.proposal.status, 'Ожидает')
+        self.assertEqual(self.proposal.status, 'pending')
 
     def test_proposal_status_update(self):
-        self.proposal.status = 'Принята'
+        self.proposal.status = 'accepted'
         self.proposal.save()
-        self.assertEqual(ExchangeProposal.objects.first().status, 'Принята')
+        self.assertEqual(ExchangeProposal.objects.first().status, 'accepted')
 
     def test_filter_by_status(self):
-        results = ExchangeProposal.objects.filter(status='Ожидает')
+        results = ExchangeProposal.objects.filter(status='pending')
         self.assertIn(self.proposal, results)
 
     def test_filter_by_sender_user(self):
@@ -72,3 +121,1762 @@ class ExchangeProposalTests(TestCase):
     def test_filter_by_receiver_user(self):
         results = ExchangeProposal.objects.filter(ad_receiver__user__username='receiver')
         self.assertIn(self.proposal, results)
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='123')
+        self.ads = [
+            Ad.objects.create(
+                user=self.user,
+                title=f'Объявление {i}',
+                description='Описание',
+                category='Электроника' if i % 2 else 'Транспорт',
+                condition='Новый'
+            )
+            for i in range(5)
+        ]
+        # Одинаковое время публикации: порядок должен держаться на id
+        Ad.objects.update(created_at=self.ads[0].created_at)
+
+    def _walk(self, params):
+        titles, page = [], self.client.get('/', params)
+        while True:
+            titles += [ad.title for ad in page.context['ads']]
+            page_obj = page.context['page_obj']
+            if not page_obj.has_next():
+                return titles, page
+            page = self.client.get('/?' + page_obj.next_querystring)
+
+    def test_walks_all_pages_without_duplicates(self):
+        titles, _ = self._walk({})
+        self.assertEqual(titles, [f'Объявление {i}' for i in range(4, -1, -1)])
+
+    def test_previous_cursor_returns_previous_page(self):
+        first = self.client.get('/')
+        second = self.client.get('/?' + first.context['page_obj'].next_querystring)
+        back = self.client.get('/?' + second.context['page_obj'].previous_querystring)
+        self.assertEqual(list(back.context['ads']), list(first.context['ads']))
+        self.assertFalse(back.context['page_obj'].has_previous())
+
+    def test_filters_are_kept_between_pages(self):
+        titles, _ = self._walk({'category': 'Электроника'})
+        self.assertEqual(titles, ['Объявление 3', 'Объявление 1'])
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get('/', {'cursor': 'не-курсор'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_with_wrong_value_types_is_rejected(self):
+        for values in ([123, 1], [[1], 1], ['2024-01-01T00:00:00', {'id': 1}], [None, None],
+                       ['2024-01-01T00:00:00', None], ['2024-01-01T00:00:00', True]):
+            cursor = encode_cursor('n', values)
+            self.assertEqual(self.client.get('/', {'cursor': cursor}).status_code, 404)
+            self.assertEqual(self.client.get('/api/ads/', {'cursor': cursor}).status_code, 400)
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', password='123')
+        self.phone = Ad.objects.create(
+            user=self.user, title='Телефон Nokia', description='Кнопочный, с зарядкой',
+            category='Электроника', condition='Б/у'
+        )
+        self.charger = Ad.objects.create(
+            user=self.user, title='Зарядка', description='Подходит для телефонов Nokia',
+            category='Электроника', condition='Новый'
+        )
+        self.bike = Ad.objects.create(
+            user=self.user, title='Велосипед', description='Горный',
+            category='Транспорт', condition='Б/у'
+        )
+
+    def _search(self, query):
+        response = self.client.get('/', {'q': query})
+        return [ad.pk for ad in response.context['ads']]
+
+    def test_normalize_strips_endings(self):
+        self.assertEqual(normalize('телефонов'), normalize('Телефон'))
+        self.assertEqual(normalize('Ёлками'), 'елк')
+
+    def test_searches_description_and_ranks_title_higher(self):
+        self.assertEqual(self._search('телефон'), [self.phone.pk, self.charger.pk])
+
+    def test_all_terms_required(self):
+        self.assertEqual(self._search('nokia кнопочный'), [self.phone.pk])
+
+    def test_index_follows_save_and_delete(self):
+        self.bike.title = 'Велосипед с телефоном'
+        self.bike.save()
+        self.assertIn(self.bike.pk, self._search('телефон'))
+        self.bike.delete()
+        self.assertFalse(AdSearchTerm.objects.filter(ad_id=self.bike.pk).exists())
+
+    def test_rebuild_command(self):
+        AdSearchTerm.objects.all().delete()
+        call_command('rebuild_search_index', batch_size=2, stdout=StringIO())
+        self.assertEqual(self._search('горный'), [self.bike.pk])
+
+    def test_ranked_results_are_paginated_by_cursor(self):
+        first = self.client.get('/', {'q': 'nokia'})
+        self.assertEqual(len(first.context['ads']), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            Ad.objects.create(
+                user=self.user, title='Nokia 3310', description='Nokia',
+                category='Электроника', condition='Б/у'
+            )
+        page = self.client.get('/', {'q': 'nokia'})
+        second = self.client.get('/?' + page.context['page_obj'].next_querystring)
+        seen = [ad.pk for ad in page.context['ads']] + [ad.pk for ad in second.context['ads']]
+        self.assertEqual(len(set(seen)), 3)
+
+    def test_cursor_with_invalid_rank_is_rejected(self):
+        created = self.phone.created_at.isoformat()
+        for rank in ('abc', None, True, [1], 'nan'):
+            cursor = encode_cursor('n', [rank, created, self.phone.pk])
+            self.assertEqual(self.client.get('/', {'q': 'nokia', 'cursor': cursor}).status_code, 404)
+            self.assertEqual(self.client.get('/api/ads/', {'q': 'nokia', 'cursor': cursor}).status_code, 400)
+
+class AdFilterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='123')
+        self.ad = Ad.objects.create(
+            user=self.user, title='Самокат', description='Складной',
+            category='Транспорт', condition='Б/у'
+        )
+
+    def test_category_filter_is_exact(self):
+        response = self.client.get('/', {'category': 'Транспорт'})
+        self.assertEqual(list(response.context['ads']), [self.ad])
+        response = self.client.get('/', {'category': 'Транс'})
+        self.assertEqual(list(response.context['ads']), [])
+
+@override_settings(ADS_FEED_CACHE_TIMEOUT=0, ADS_FACETS_CACHE_TIMEOUT=0)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='viewer', password='123')
+        own_ad = Ad.objects.create(
+            user=self.user, title='Моё', description='Своё', category='Транспорт', condition='Б/у'
+        )
+        for i in range(25):
+            other = User.objects.create(username=f'user{i}')
+            ad = Ad.objects.create(
+                user=other, title=f'Чужое {i}', description='Описание',
+                category='Электроника', condition='Новый'
+            )
+            Ad.objects.create(
+                user=self.user, title=f'Моё {i}', description='Описание',
+                category='Электроника', condition='Новый'
+            )
+            ExchangeProposal.objects.create(ad_sender=own_ad, ad_receiver=ad, comment='Меняемся?')
+            ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=own_ad, comment='Меняемся!')
+        self.client.login(username='viewer', password='123')
+
+    def test_ad_list(self):
+        # Включая один сгруппированный запрос счётчиков фильтра
+        self.assertQueryBudget('/', 5)
+
+    def test_ad_list_anonymous(self):
+        self.client.logout()
+        self.assertQueryBudget('/', 3)
+
+    def test_my_ads(self):
+        self.assertQueryBudget('/my-ads/', 4)
+
+    def test_exchange_list(self):
+        # Включая страницу и подсчёт архива предложений
+        self.assertQueryBudget('/exchange/', 6)
+
+    def test_sent_proposals(self):
+        # Включая запрос к архиву предложений
+        self.assertQueryBudget('/exchange/sent/', 5)
+
+    def test_received_proposals(self):
+        # Включая запрос к архиву предложений
+        self.assertQueryBudget('/exchange/received/', 5)
+
+class ExchangeProposalExportTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user(username='analyst', password='123', is_staff=True)
+        sender = User.objects.create(username='sender')
+        receiver = User.objects.create(username='receiver')
+        self.ad_sender = Ad.objects.create(
+            user=sender, title='Книга', description='', category='Личные вещи', condition='Б/у'
+        )
+        self.ad_receiver = Ad.objects.create(
+            user=receiver, title='Часы', description='', category='Личные вещи', condition='Новый'
+        )
+        for status in ('pending', 'accepted', 'pending'):
+            ExchangeProposal.objects.create(
+                ad_sender=self.ad_sender, ad_receiver=self.ad_receiver, comment='a,b "c"', status=status
+            )
+        self.client.login(username='analyst', password='123')
+
+    def _content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_list_is_paginated(self):
+        response = self.client.get('/exchange/')
+        self.assertEqual(len(response.context['proposals']), 2)
+        self.assertTrue(response.context['page_obj'].has_next())
+
+    def test_csv_export_streams_filtered_rows(self):
+        response = self.client.get('/exchange/export/', {'format': 'csv', 'status': 'pending'})
+        self.assertTrue(response.streaming)
+        lines = self._content(response).splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'created_at', 'status'])
+        self.assertEqual(len(lines), 3)
+        self.assertIn('"a,b ""c"""', lines[1])
+
+    def test_ndjson_export(self):
+        response = self.client.get('/exchange/export/', {'format': 'ndjson', 'sender': 'sender'})
+        rows = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertEqual([row['status'] for row in rows], ['pending', 'accepted', 'pending'])
+        self.assertEqual(rows[0]['ad_receiver__user__username'], 'receiver')
+
+    def test_export_requires_staff(self):
+        User.objects.create_user(username='plain', password='123')
+        self.client.login(username='plain', password='123')
+        self.assertEqual(self.client.get('/exchange/export/').status_code, 403)
+
+class FeedCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', password='123')
+        self.ad = Ad.objects.create(
+            user=self.user, title='Лампа', description='Настольная', category='Личные вещи', condition='Б/у'
+        )
+
+    def test_anonymous_page_is_served_from_cache(self):
+        first = self.client.get('/', {'category': 'Личные вещи'})
+        with self.assertNumQueries(0):
+            second = self.client.get('/', {'category': 'Личные вещи'})
+        self.assertEqual(first.content, second.content)
+
+    def test_parameter_order_does_not_matter(self):
+        self.client.get('/?condition=Б/у&category=Личные вещи')
+        with self.assertNumQueries(0):
+            self.client.get('/?category=Личные вещи&condition=Б/у')
+
+    def test_unknown_parameters_bypass_cache(self):
+        self.client.get('/', {'utm_source': 'x'})
+        with self.assertNumQueries(1):
+            self.client.get('/', {'utm_source': 'x'})
+
+    def test_ad_changes_invalidate_page_and_card(self):
+        self.client.get('/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad.title = 'Торшер'
+            self.ad.save()
+            # До фиксации кэш не сбрасывается: иначе чтение незафиксированного состояния закэшировало бы старую ленту
+            self.assertNotContains(self.client.get('/'), 'Торшер')
+        self.assertContains(self.client.get('/'), 'Торшер')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ad.objects.create(
+                user=self.user, title='Ковёр', description='', category='Личные вещи', condition='Новый'
+            )
+        self.assertContains(self.client.get('/'), 'Ковёр')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad.delete()
+        self.assertNotContains(self.client.get('/'), 'Торшер')
+
+    def test_authenticated_pages_are_not_cached(self):
+        User.objects.create_user(username='viewer', password='123')
+        self.client.login(username='viewer', password='123')
+        self.client.get('/')
+        response = self.client.get('/')
+        self.assertIsNotNone(response.context)
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        }):
+            self.client.get('/')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ad.title = 'Торшер'
+                self.ad.save()
+            self.assertContains(self.client.get('/'), 'Торшер')
+            with self.assertNumQueries(0):
+                self.client.get('/')
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='viewer', password='123')
+        other = User.objects.create(username='other')
+        for title, category, condition in [('Велосипед', 'Транспорт', 'Б/у'), ('Самокат', 'Транспорт', 'Новый'),
+                                           ('Велосипед детский', 'Транспорт', 'Новый'),
+                                           ('Телефон', 'Электроника', 'Б/у')]:
+            Ad.objects.create(user=other, title=title, description='-', category=category, condition=condition)
+        Ad.objects.create(user=self.user, title='Свой велосипед', description='-', category='Транспорт',
+                          condition='Б/у')
+
+    def _counts(self, response):
+        facets = response.context['facets']
+        return ({option.value: option.count for option in facets.categories}, facets.categories_total,
+                {option.value: option.count for option in facets.conditions}, facets.conditions_total)
+
+    def test_counts_follow_the_other_filter_and_search(self):
+        categories, total, conditions, _ = self._counts(self.client.get('/'))
+        self.assertEqual(total, 5)
+        self.assertEqual(categories, {'Недвижимость': 0, 'Транспорт': 4, 'Личные вещи': 0, 'Электроника': 1})
+        self.assertEqual(conditions, {'Новый': 2, 'Б/у': 3})
+
+        # Выбранное состояние сужает числа категорий, и наоборот
+        categories, total, conditions, conditions_total = self._counts(
+            self.client.get('/', {'category': 'Транспорт', 'condition': 'Новый'}))
+        self.assertEqual((categories['Транспорт'], categories['Электроника'], total), (2, 0, 2))
+        self.assertEqual((conditions['Новый'], conditions['Б/у'], conditions_total), (2, 2, 4))
+
+        categories, total, conditions, _ = self._counts(self.client.get('/', {'q': 'велосипед'}))
+        self.assertEqual((categories['Транспорт'], total, conditions['Б/у']), (3, 3, 2))
+
+        # Свои объявления в ленте не показываются и не считаются
+        self.client.login(username='viewer', password='123')
+        response = self.client.get('/', {'q': 'велосипед'})
+        self.assertEqual(self._counts(response)[1], 2)
+        self.assertContains(response, 'Транспорт (2)')
+
+    def test_counts_are_one_query_and_cached_until_ads_change(self):
+        view = AdListView()
+        view.setup(RequestFactory().get('/', {'q': 'велосипед'}))
+        view.request.user = self.user
+        with self.assertNumQueries(1):
+            self.assertEqual(view.get_facets().categories_total, 2)
+        with self.assertNumQueries(0):
+            view.get_facets()
+
+        Ad.objects.create(user=User.objects.create(username='new'), title='Велосипед', description='-',
+                          category='Транспорт', condition='Новый')
+        self.assertEqual(view.get_facets().categories_total, 3)
+
+# Маршруты режима ASGI для AsyncViewTests: асинхронные представления перекрывают синхронные
+urlpatterns = [
+    path('', AsyncAdListView.as_view(), name='ad_list'),
+    path('my-ads/', AsyncMyAdsView.as_view(), name='my_ads'),
+    path('exchange/received/', AsyncReceivedProposalsView.as_view(), name='exchange_received'),
+    path('', include('bartersystem.urls')),
+]
+
+@override_settings(ROOT_URLCONF='ads.tests', ADS_FEED_CACHE_TIMEOUT=0)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='123')
+        self.other = User.objects.create(username='other')
+        for i in range(3):
+            Ad.objects.create(
+                user=self.other, title=f'Чужое {i}', description='', category='Транспорт', condition='Б/у'
+            )
+        self.own = Ad.objects.create(
+            user=self.user, title='Своё', description='', category='Транспорт', condition='Новый'
+        )
+
+    async def test_feed_pages_through_cursor(self):
+        first = await self.async_client.get('/')
+        self.assertContains(first, 'Чужое 2')
+        second = await self.async_client.get('/?' + first.context['page_obj'].next_querystring)
+        self.assertContains(second, 'Чужое 0')
+        self.assertNotContains(second, 'Чужое 2')
+
+    async def test_feed_excludes_own_ads(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/', {'category': 'Транспорт'})
+        self.assertNotContains(response, 'Своё')
+        self.assertContains(response, 'Транспорт (3)')
+
+    async def test_my_ads_requires_login(self):
+        response = await self.async_client.get('/my-ads/')
+        self.assertEqual(response.status_code, 302)
+        await self.async_client.aforce_login(self.user)
+        self.assertContains(await self.async_client.get('/my-ads/'), 'Своё')
+
+    async def test_received_post_is_delegated(self):
+        ad = await Ad.objects.filter(user=self.other).afirst()
+        proposal = await ExchangeProposal.objects.acreate(ad_sender=ad, ad_receiver=self.own)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(
+            '/exchange/received/', {'proposal_id': proposal.pk, 'action': 'accept'}
+        )
+        self.assertEqual(response.status_code, 302)
+        await proposal.arefresh_from_db()
+        self.assertEqual(proposal.status, 'accepted')
+
+class ImportExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='partner')
+
+    def _write(self, suffix, content):
+        handle = tempfile.NamedTemporaryFile('w', suffix=suffix, encoding='utf-8', delete=False)
+        handle.write(content)
+        handle.close()
+        self.addCleanup(os.remove, handle.name)
+        return handle.name
+
+    def test_import_csv_validates_rows_and_resolves_users(self):
+        path = self._write('.csv', (
+            'username,title,description,image_url,category,condition\n'
+            'partner,Телефон,Рабочий,,Электроника,Новый\n'
+            'partner,Диван,Большой,,Мебель,Б/у\n'
+            'nobody,Стол,Дубовый,,Личные вещи,Б/у\n'
+            'partner,Велосипед,Горный,http://example.com/bike.jpg,Транспорт,Б/у\n'
+        ))
+        err = StringIO()
+        call_command('import_ads', path, batch_size=2, stdout=StringIO(), stderr=err)
+        self.assertEqual(
+            sorted(Ad.objects.values_list('title', flat=True)), ['Велосипед', 'Телефон']
+        )
+        self.assertIn('Строка 3', err.getvalue())
+        self.assertIn("'nobody'", err.getvalue())
+        self.assertTrue(AdSearchTerm.objects.filter(ad__title='Велосипед').exists())
+
+    @override_settings(ADS_TASKS_EAGER=False)
+    def test_import_queues_image_prefetch(self):
+        path = self._write('.csv', 'username,title,description,image_url,category,condition\n' + ''.join(
+            f'partner,Стол {i},Дубовый,http://example.com/{i % 2}.jpg,Личные вещи,Б/у\n' for i in range(3)
+        ) + 'partner,Лампа,Настольная,,Личные вещи,Б/у\n')
+        call_command('import_ads', path, batch_size=2, stdout=StringIO(), stderr=StringIO())
+        queued = Task.objects.filter(name=prefetch_image.task_name, status=Task.QUEUED)
+        self.assertEqual(sorted(args[0] for args in queued.values_list('args', flat=True)),
+                         ['http://example.com/0.jpg', 'http://example.com/1.jpg'])
+
+    def test_unknown_users_count_towards_max_errors(self):
+        path = self._write('.csv', 'username,title,description,image_url,category,condition\n' + ''.join(
+            f'nobody{i},Стол,Дубовый,,Личные вещи,Б/у\n' for i in range(3)
+        ) + 'partner,Телефон,Рабочий,,Электроника,Новый\n')
+        with self.assertRaisesMessage(CommandError, 'Превышено число ошибок (3)'):
+            call_command('import_ads', path, batch_size=3, max_errors=2, stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(Ad.objects.exists())
+
+    def test_malformed_ndjson_lines_are_row_errors(self):
+        good = json.dumps({'username': 'partner', 'title': 'Часы', 'description': 'Механические',
+                           'category': 'Личные вещи', 'condition': 'Б/у'}, ensure_ascii=False)
+        path = self._write('.ndjson', f'{good}\n[1, 2]\n"x"\n{{не json\n{good}\n')
+        err = StringIO()
+        call_command('import_ads', path, stdout=StringIO(), stderr=err)
+        self.assertEqual(Ad.objects.filter(title='Часы').count(), 2)
+        self.assertIn('Строка 2: ожидается объект JSON, получено list', err.getvalue())
+        self.assertIn('Строка 3: ожидается объект JSON, получено str', err.getvalue())
+        self.assertIn('Строка 4: некорректный JSON', err.getvalue())
+        with self.assertRaisesMessage(CommandError, 'Превышено число ошибок (2)'):
+            call_command('import_ads', path, max_errors=2, stdout=StringIO(), stderr=StringIO())
+
+    def test_export_import_roundtrip_ndjson(self):
+        Ad.objects.create(user=self.user, title='Часы', description='Механические',
+                          category='Личные вещи', condition='Б/у')
+        # Удалённое объявление, которое ещё ждёт фоновой очистки, не выгружается
+        Ad.objects.create(user=self.user, title='Лампа', description='-', category='Личные вещи',
+                          condition='Б/у', deleted_at=timezone.now())
+        out = StringIO()
+        call_command('export_ads', format='ndjson', chunk_size=1, stdout=out, stderr=StringIO())
+        self.assertNotIn('Лампа', out.getvalue())
+        path = self._write('.ndjson', out.getvalue())
+        call_command('import_ads', path, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Ad.objects.filter(title='Часы', description='Механические').count(), 2)
+
+@override_settings(ADS_MATCHING_REBUILD_INTERVAL=0)
+class TradeMatchingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(ADS_MATCHING_DIR=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_engine().reset()
+        self.addCleanup(get_engine().reset)
+        self.users = [User.objects.create(username=name) for name in ('anna', 'boris', 'vera', 'gleb')]
+        self.ads = [
+            Ad.objects.create(user=user, title=f'Вещь {user.username}', description='-',
+                              category='Личные вещи', condition='Б/у')
+            for user in self.users
+        ]
+        anna, boris, vera, gleb = self.ads
+        # Треугольник anna → boris → vera → anna и тупиковое предложение gleb → anna
+        self.proposals = [
+            self._propose(anna, boris), self._propose(boris, vera), self._propose(vera, anna),
+            self._propose(gleb, anna),
+        ]
+
+    def _propose(self, sender, receiver, status='pending'):
+        return ExchangeProposal.objects.create(ad_sender=sender, ad_receiver=receiver, status=status)
+
+    def _edges(self):
+        return ExchangeProposal.objects.values_list(*EDGE_FIELDS).order_by('pk')
+
+    def test_graph_finds_cycles_once(self):
+        graph = TradeGraph.build(self._edges())
+        cycles = graph.all_cycles(max_length=4)
+        self.assertEqual([sorted(cycle) for cycle in cycles], [sorted(p.pk for p in self.proposals[:3])])
+        self.assertEqual(graph.all_cycles(max_length=2), [])
+
+    def test_graph_updates_incrementally(self):
+        graph = TradeGraph.build(self._edges())
+        anna, boris, vera, gleb = self.ads
+        graph.add_edge(100, anna.pk, gleb.pk, anna.user_id, gleb.user_id)
+        self.assertEqual(graph.cycles_through_proposal(100, anna.pk, gleb.pk), [(100, self.proposals[3].pk)])
+
+        graph.remove_proposal(self.proposals[1].pk)
+        graph.compact()
+        self.assertEqual(len(graph.all_cycles()), 1)
+        self.assertEqual(graph.edge_count, 4)
+
+    def test_cycle_requires_distinct_owners(self):
+        anna, boris = self.ads[:2]
+        second = Ad.objects.create(user=anna.user, title='Ещё вещь', description='-',
+                                   category='Личные вещи', condition='Б/у')
+        graph = TradeGraph.build(self._edges())
+        graph.add_edge(100, boris.pk, second.pk, boris.user_id, anna.user_id)
+        graph.add_edge(101, second.pk, boris.pk, anna.user_id, boris.user_id)
+        # Цикл anna → boris → second → boris не простой, а second снова принадлежит anna
+        self.assertEqual(sorted(map(len, graph.cycles_through_ad(anna.pk))), [3])
+
+    def test_view_lists_user_cycles(self):
+        self.client.force_login(self.users[0])
+        response = self.client.get('/exchange/cycles/')
+        self.assertEqual(len(response.context['cycles']), 1)
+        self.assertContains(response, 'Вещь vera')
+        self.assertEqual(response.context['cycles'][0][0].ad_sender.user, self.users[0])
+
+    def test_answered_proposals_leave_suggestions(self):
+        ExchangeProposal.objects.filter(pk=self.proposals[1].pk).update(status='rejected')
+        self.client.force_login(self.users[0])
+        response = self.client.get('/exchange/cycles/')
+        self.assertEqual(response.context['cycles'], [])
+
+    def test_stale_graph_cycles_are_dropped(self):
+        cycles = get_engine().cycles_for_user(self.users[0])
+        ExchangeProposal.objects.filter(pk=self.proposals[2].pk).delete()
+        self.assertEqual(load_cycles(cycles), [])
+
+    def test_closing_proposal_redirects_to_cycles(self):
+        anna, gleb = self.ads[0], self.ads[3]
+        self.client.force_login(self.users[0])
+        response = self.client.post('/exchange/new/', {'ad_sender': anna.pk, 'ad_receiver': gleb.pk})
+        self.assertRedirects(response, '/exchange/cycles/')
+
+    @override_settings(ADS_TASKS_EAGER=False, ADS_MATCHING_REBUILD_INTERVAL=600)
+    def test_request_does_not_build_graph(self):
+        engine = get_engine()
+        self.assertEqual(engine.cycles_for_user(self.users[0]), [])
+        self.assertIsNone(engine.graph)
+        self.assertEqual(list(Task.objects.values_list('name', flat=True)), ['ads.tasks.build_trade_graph'])
+        # Повтор в пределах ADS_MATCHING_REFRESH_INTERVAL не ставит задачу снова
+        engine.cycles_for_user(self.users[0])
+        self.assertEqual(Task.objects.count(), 1)
+
+        # Воркер строит снимок, процесс сайта открывает его и догружает предложения новее снимка
+        execute(Task.objects.get().pk)
+        closing = self._propose(self.ads[0], self.ads[3])
+        self.assertEqual(len(engine.cycles_for_user(self.users[0])), 2)
+        self.assertEqual(engine.graph.cycles_through_ad(self.ads[3].pk), [(self.proposals[3].pk, closing.pk)])
+
+    def test_command_prints_cycles(self):
+        out = StringIO()
+        call_command('find_trade_cycles', stdout=out)
+        self.assertIn('Цепочек: 1 (по числу участников — 3: 1)', out.getvalue())
+        self.assertIn('anna «Вещь anna» → boris «Вещь boris» → vera «Вещь vera» → anna', out.getvalue())
+
+class ProposalTransitionTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='123')
+        self.others = [User.objects.create(username=f'buyer{i}') for i in range(3)]
+        self.own = Ad.objects.create(user=self.owner, title='Моё', description='-',
+                                     category='Личные вещи', condition='Б/у')
+        self.offers = [
+            Ad.objects.create(user=user, title=f'Вещь {user.username}', description='-',
+                              category='Личные вещи', condition='Б/у')
+            for user in self.others
+        ]
+        self.proposals = [
+            ExchangeProposal.objects.create(ad_sender=offer, ad_receiver=self.own) for offer in self.offers
+        ]
+
+    def _statuses(self):
+        return list(ExchangeProposal.objects.order_by('pk').values_list('status', flat=True))
+
+    def test_accept_rejects_competing_in_one_query(self):
+        elsewhere = Ad.objects.create(user=self.others[1], title='Другое', description='-',
+                                      category='Личные вещи', condition='Б/у')
+        # Отправитель принятого предложения предлагал свою вещь ещё и другому
+        ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=elsewhere)
+        unrelated = ExchangeProposal.objects.create(ad_sender=self.offers[2], ad_receiver=elsewhere)
+
+        with CaptureQueriesContext(connection) as queries:
+            result = ExchangeProposal.objects.filter(pk=self.proposals[0].pk).accept()
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "ads_exchangeproposal"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(result, {'accepted': [self.proposals[0].pk], 'rejected': 3, 'skipped': []})
+        self.assertEqual(self._statuses(), ['accepted', 'rejected', 'rejected', 'rejected', 'pending'])
+        unrelated.refresh_from_db()
+        self.assertEqual(unrelated.status, 'pending')
+
+    def test_only_pending_proposals_transition(self):
+        ExchangeProposal.objects.filter(pk=self.proposals[0].pk).reject()
+        result = ExchangeProposal.objects.filter(pk=self.proposals[0].pk).accept()
+        self.assertEqual(result['accepted'], [])
+        self.assertEqual(self._statuses()[0], 'rejected')
+
+    def test_bulk_accept_keeps_one_per_ad(self):
+        result = ExchangeProposal.objects.filter(pk__in=[p.pk for p in self.proposals]).accept()
+        self.assertEqual(len(result['accepted']), 1)
+        self.assertEqual(sorted(self._statuses()), ['accepted', 'rejected', 'rejected'])
+
+    def test_view_bulk_reject_and_reject_all(self):
+        self.client.login(username='owner', password='123')
+        self.client.post('/exchange/received/', {
+            'action': 'reject', 'proposal_ids': [self.proposals[0].pk, self.proposals[1].pk],
+        })
+        self.assertEqual(self._statuses(), ['rejected', 'rejected', 'pending'])
+        self.client.post('/exchange/received/', {'action': 'reject_all'})
+        self.assertEqual(self._statuses(), ['rejected', 'rejected', 'rejected'])
+
+    def test_view_ignores_foreign_proposals(self):
+        User.objects.create_user(username='stranger', password='123')
+        self.client.login(username='stranger', password='123')
+        self.client.post('/exchange/received/', {'action': 'accept', 'proposal_id': self.proposals[0].pk})
+        self.assertEqual(self._statuses(), ['pending', 'pending', 'pending'])
+
+    @override_settings(ADS_MATCHING_REBUILD_INTERVAL=600, ADS_MATCHING_REFRESH_INTERVAL=600)
+    def test_answered_proposals_leave_trade_graph(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        ExchangeProposal.objects.create(ad_sender=self.own, ad_receiver=self.offers[0])
+        engine = get_engine()
+        engine.reset()
+        self.addCleanup(engine.reset)
+        with self.settings(ADS_MATCHING_DIR=directory):
+            self.assertEqual(len(engine.cycles_for_user(self.owner)), 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                ExchangeProposal.objects.filter(pk=self.proposals[1].pk).accept()
+            self.assertEqual(engine.graph.edge_count, 0)
+            self.assertEqual(engine.cycles_for_user(self.owner), [])
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.alice_ad = Ad.objects.create(user=self.alice, title='Лампа', description='-',
+                                          category='Личные вещи', condition='Б/у')
+        self.bob_ads = [
+            Ad.objects.create(user=self.bob, title=f'Книга {i}', description='-',
+                              category='Личные вещи', condition='Б/у')
+            for i in range(3)
+        ]
+        self.proposals = [
+            ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=self.alice_ad) for ad in self.bob_ads
+        ]
+
+    def _stats(self, user):
+        stats = UserStats.objects.for_user(user)
+        return [getattr(stats, counter) for counter in UserStats.COUNTERS]
+
+    def test_create_and_status_change_update_counters(self):
+        self.alice_ad.refresh_from_db()
+        self.assertEqual(self.alice_ad.proposals_count, 3)
+        # pending_received, pending_sent, proposals_received, proposals_sent
+        self.assertEqual(self._stats(self.alice), [3, 0, 3, 0])
+        self.assertEqual(self._stats(self.bob), [0, 3, 0, 3])
+
+        proposal = self.proposals[0]
+        proposal.status = ExchangeProposal.REJECTED
+        proposal.save()
+        proposal.save()
+        self.assertEqual(self._stats(self.alice), [2, 0, 3, 0])
+
+        ExchangeProposal.objects.filter(pk=self.proposals[1].pk).accept()
+        self.assertEqual(self._stats(self.alice), [0, 0, 3, 0])
+        self.assertEqual(self._stats(self.bob), [0, 0, 0, 3])
+
+    def test_delete_updates_counters(self):
+        self.proposals[0].delete()
+        self.bob_ads[1].delete()
+        self.alice_ad.refresh_from_db()
+        self.assertEqual(self.alice_ad.proposals_count, 1)
+        self.assertEqual(self._stats(self.alice), [1, 0, 1, 0])
+        self.bob.delete()
+        self.assertEqual(self._stats(self.alice), [0, 0, 0, 0])
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        Ad.objects.filter(pk=self.alice_ad.pk).update(proposals_count=10)
+        UserStats.objects.filter(user=self.bob).delete()
+        out = StringIO()
+        call_command('reconcile_counters', '--dry-run', stdout=out)
+        self.assertIn('найдено расхождений: 3', out.getvalue())
+        report = reconcile_counters()
+        self.assertEqual(report['ad.proposals_count'], (1, 7))
+        self.assertEqual(report['user.pending_sent'], (1, 3))
+        self.assertEqual(reconcile_counters(fix=False)['user.pending_sent'], (0, 0))
+        self.assertEqual(self._stats(self.bob), [0, 3, 0, 3])
+
+    def test_inbox_badges_and_count_use_counters(self):
+        User.objects.filter(pk=self.alice.pk).update(password=make_password('123'))
+        self.client.login(username='alice', password='123')
+        response = self.client.get('/exchange/received/')
+        self.assertContains(response, 'Ожидают вашего ответа: 3 из 3')
+        self.assertEqual(response.context['paginator'].count, 3)
+        self.assertFalse(response.context['paginator'].count_is_estimate)
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    """Локальная замена внешнего сервера изображений"""
+    images = {}
+    hits = []
+    hosts = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        self.hosts.append(self.headers['Host'])
+        body, content_type = self.images.get(self.path, (b'', 'text/plain'))
+        self.send_response(200 if body else 404)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _png(width, height, color='red'):
+    buffer = BytesIO()
+    PILImage.new('RGB', (width, height), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@unittest.skipIf(PILImage is None, 'Pillow не установлен')
+class ImageProxyTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_port}'
+        _ImageHandler.images = {
+            '/big.png': (_png(2000, 1000), 'image/png'),
+            '/copy.png': (_png(2000, 1000), 'image/png'),
+            '/other.png': (_png(1200, 1200, 'blue'), 'image/png'),
+            '/page.html': (b'<html></html>', 'text/html'),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        overrides = override_settings(ADS_IMAGE_CACHE_DIR=cache_dir, ADS_IMAGE_ALLOW_PRIVATE=True,
+                                      ADS_TASKS_EAGER=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        _ImageHandler.hits.clear()
+        _ImageHandler.hosts.clear()
+        self.user = User.objects.create(username='photographer')
+
+    def _ad(self, path):
+        return Ad.objects.create(user=self.user, title='Фото', description='-', image_url=self.base + path,
+                                 category='Личные вещи', condition='Б/у')
+
+    def test_thumbnail_is_fetched_once_and_resized(self):
+        ad = self._ad('/big.png')
+        url = f'/ads/{ad.pk}/image/card/?v={ad.image_version}'
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        with PILImage.open(BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (480, 240))
+
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        self.assertEqual(_ImageHandler.hits, ['/big.png'])
+
+    def test_etag_revalidation(self):
+        ad = self._ad('/big.png')
+        response = self.client.get(f'/ads/{ad.pk}/image/card/')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+        response = self.client.get(f'/ads/{ad.pk}/image/card/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_same_content_shares_cache_entry(self):
+        first, second = self._ad('/big.png'), self._ad('/copy.png')
+        etags = [self.client.get(f'/ads/{ad.pk}/image/card/')['ETag'] for ad in (first, second)]
+        self.assertEqual(etags[0], etags[1])
+
+    def test_failed_fetch_redirects_to_original(self):
+        ad = self._ad('/page.html')
+        response = self.client.get(f'/ads/{ad.pk}/image/card/')
+        self.assertRedirects(response, ad.image_url, fetch_redirect_response=False)
+        self.assertEqual(self.client.get(f'/ads/{ad.pk}/image/huge/').status_code, 404)
+
+    def test_private_addresses_are_blocked_by_default(self):
+        with override_settings(ADS_IMAGE_ALLOW_PRIVATE=False):
+            with self.assertRaises(ImageError):
+                fetch_image(self.base + '/big.png')
+        self.assertEqual(_ImageHandler.hits, [])
+
+    @override_settings(ADS_IMAGE_ALLOW_PRIVATE=False)
+    def test_connects_to_checked_address(self):
+        # Имя не разрешается повторно: подключение идёт на адрес, который вернула проверка
+        host = f'rebind.invalid:{self.server.server_port}'
+        with mock.patch('ads.images._check_public_host', return_value='127.0.0.1') as check:
+            self.assertEqual(fetch_image(f'http://{host}/big.png'), _ImageHandler.images['/big.png'][0])
+        check.assert_called_once_with('rebind.invalid', self.server.server_port)
+        self.assertEqual(_ImageHandler.hosts, [host])
+
+    def test_lru_eviction_keeps_recent_files(self):
+        cache = ImageCache(tempfile.mkdtemp(), max_bytes=len(_ImageHandler.images['/big.png'][0]) * 2)
+        self.addCleanup(shutil.rmtree, cache.root, ignore_errors=True)
+        old, _, _ = cache.thumbnail(self.base + '/big.png', 'card', 'jpeg')
+        os.utime(old, (0, 0))
+        os.utime(cache._path('src', cache.source_digest(self.base + '/big.png')), (0, 0))
+        recent, _, _ = cache.thumbnail(self.base + '/other.png', 'card', 'jpeg')
+        self.assertTrue(recent.exists())
+        self.assertFalse(old.exists())
+        self.assertLessEqual(cache._scan_size(), cache.max_bytes)
+
+    @override_settings(ADS_TASKS_EAGER=True)
+    def test_thumbnails_are_prefetched_on_save(self):
+        ad = self._ad('/other.png')
+        self.assertEqual(_ImageHandler.hits, ['/other.png'])
+        self.client.get(f'/ads/{ad.pk}/image/large/', HTTP_ACCEPT='image/webp')
+        self.assertEqual(_ImageHandler.hits, ['/other.png'])
+
+
+_flaky_calls = []
+
+
+@task(name='ads.tests.flaky', max_attempts=2)
+def _flaky(fail_times):
+    _flaky_calls.append(fail_times)
+    if len(_flaky_calls) <= fail_times:
+        raise RuntimeError('сбой')
+
+
+@override_settings(ADS_TASKS_EAGER=False, ADS_SEARCH_BACKEND='python')
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        _flaky_calls.clear()
+        self.user = User.objects.create(username='queue')
+
+    def _run_ready(self):
+        return [execute(pk) for pk in claim('test', 100)]
+
+    def test_repeated_saves_enqueue_one_reindex(self):
+        ad = Ad.objects.create(user=self.user, title='Велосипед', description='-', category='Транспорт', condition='Б/у')
+        ad.title = 'Самокат'
+        ad.save()
+        ad.save()
+        self.assertEqual(Task.objects.filter(name=sync_search_index.task_name, status=Task.QUEUED).count(), 1)
+        self.assertFalse(AdSearchTerm.objects.exists())
+
+        self.assertEqual(self._run_ready(), [Task.DONE])
+        self.assertEqual(set(AdSearchTerm.objects.values_list('term', flat=True)), {'самокат'})
+        # После выполнения тот же ключ снова можно поставить
+        self.assertIsNotNone(enqueue(sync_search_index, ad.pk, key=f'search:{ad.pk}'))
+
+    def test_failed_task_is_retried_with_backoff(self):
+        item = enqueue(_flaky, 1)
+        self.assertEqual(self._run_ready(), [Task.QUEUED])
+        item.refresh_from_db()
+        self.assertEqual((item.attempts, item.last_error), (1, 'RuntimeError: сбой'))
+        self.assertGreater(item.run_at, item.started_at)
+        self.assertEqual(self._run_ready(), [])  # задержка ещё не прошла
+
+        Task.objects.filter(pk=item.pk).update(run_at=item.started_at)
+        self.assertEqual(self._run_ready(), [Task.DONE])
+        self.assertEqual(_flaky_calls, [1, 1])
+
+    def test_task_fails_after_max_attempts(self):
+        item = enqueue(_flaky, 5)
+        for expected in (Task.QUEUED, Task.FAILED):
+            Task.objects.filter(pk=item.pk).update(run_at=item.created_at)
+            self.assertEqual(self._run_ready(), [expected])
+        self.assertEqual(queue_metrics()['depth'][Task.FAILED], 1)
+
+    def test_stale_running_task_is_requeued(self):
+        item = enqueue(_flaky, 0)
+        claim('dead-worker', 1)
+        self.assertEqual(requeue_stale(timeout=3600), 0)
+        self.assertEqual(requeue_stale(timeout=-1), 1)
+        self.assertEqual(self._run_ready(), [Task.DONE])
+        item.refresh_from_db()
+        self.assertEqual(item.attempts, 2)
+
+    def test_metrics_report_depth_and_latency(self):
+        enqueue(_flaky, 0)
+        enqueue(_flaky, 0, delay=3600)
+        self._run_ready()
+        metrics = queue_metrics()
+        self.assertEqual((metrics['depth'][Task.QUEUED], metrics['ready'], metrics['done']), (1, 0, 1))
+        self.assertGreaterEqual(metrics['latency_p95'], metrics['runtime_p95'])
+
+        out = StringIO()
+        call_command('run_worker', '--stats', stdout=out)
+        self.assertIn('В очереди: 1 (готовы: 0)', out.getvalue())
+
+
+@override_settings(ADS_TASKS_EAGER=False, ADS_SEARCH_BACKEND='python')
+class TaskWorkerTests(TransactionTestCase):
+    # Потокам пула нужна общая база, которая умеет ждать блокировок (не SQLite в памяти)
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    def test_worker_pool_drains_queue(self):
+        user = User.objects.create(username='worker')
+        Ad.objects.bulk_create([
+            Ad(user=user, title=f'Книга {i}', description='-', category='Личные вещи', condition='Б/у')
+            for i in range(20)
+        ])
+        for ad_id in Ad.objects.values_list('pk', flat=True):
+            enqueue(sync_search_index, ad_id, key=f'search:{ad_id}')
+
+        out = StringIO()
+        call_command('run_worker', '--once', '--concurrency', '4', stdout=out)
+        self.assertIn('Выполнено задач: 20', out.getvalue())
+        self.assertEqual(Task.objects.filter(status=Task.DONE).count(), 20)
+        self.assertEqual(AdSearchTerm.objects.filter(term='книг').count(), 20)
+
+
+@override_settings(ADS_FEED_CACHE_TIMEOUT=0)
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.staff = User.objects.create(username='admin', is_staff=True)
+        self.user = User.objects.create(username='viewer')
+        Ad.objects.create(user=self.user, title='Лампа', description='-', category='Личные вещи', condition='Б/у')
+
+    def test_histogram_quantiles_are_within_bucket_error(self):
+        histogram = metrics.Histogram(1e-4, 120)
+        for ms in range(1, 1001):
+            histogram.observe(ms / 1000)
+        for q, expected in ((0.5, 0.5), (0.95, 0.95), (0.99, 0.99)):
+            self.assertAlmostEqual(histogram.quantile(q), expected, delta=expected * 0.19)
+        self.assertEqual(histogram.count, 1000)
+
+        queries = metrics.Histogram(1, 10000)
+        for value in (0, 0, 0, 7):
+            queries.observe(value)
+        self.assertEqual((queries.quantile(0.5), queries.quantile(0.99)), (0.0, 7))
+
+    def test_request_records_sql_and_template_time(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/')
+        queries = metrics.registry.snapshot('ad_list', 'db_queries')
+        self.assertEqual(queries.sum, len(context.captured_queries))
+        self.assertEqual(metrics.registry.snapshot('ad_list', 'template_seconds').count, 1)
+        self.assertLessEqual(
+            metrics.registry.snapshot('ad_list', 'db_seconds').sum,
+            metrics.registry.snapshot('ad_list', 'duration_seconds').sum,
+        )
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.client.get('/')
+        self.client.get('/no-such-page/')
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        with override_settings(ADS_METRICS_TOKEN='secret'):
+            response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+        self.client.force_login(self.staff)
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('ads_request_duration_seconds{view="ad_list",quantile="0.95"}', body)
+        self.assertIn('ads_request_db_queries_count{view="ad_list"} 1', body)
+        self.assertIn('ads_requests_total{view="unresolved",status="404"} 1', body)
+        self.assertIn('ads_task_queue_depth{status="queued"} 0', body)
+
+    def test_profile_header_is_honoured_only_for_staff(self):
+        response = self.client.get('/', HTTP_X_PROFILE='text')
+        self.assertContains(response, 'Лампа')
+
+        self.client.force_login(self.staff)
+        response = self.client.get('/', HTTP_X_PROFILE='text')
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertContains(response, 'function calls')
+
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir, ignore_errors=True)
+        with override_settings(ADS_PROFILE_DIR=profile_dir):
+            response = self.client.get('/', HTTP_X_PROFILE='1')
+        self.assertContains(response, 'Лампа')
+        self.assertTrue(os.path.exists(os.path.join(profile_dir, response['X-Profile-File'])))
+
+    @override_settings(ROOT_URLCONF='ads.tests')
+    async def test_async_views_count_queries(self):
+        response = await self.async_client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(metrics.registry.snapshot('ad_list', 'db_queries').sum, 0)
+
+
+class BenchmarkTests(TestCase):
+    def test_every_url_has_a_scenario(self):
+        self.assertEqual(benchmark.uncovered_url_names(), [])
+
+    def test_seed_is_deterministic_and_skewed(self):
+        seed_dataset(users=20, ads=400, proposals=0, seed=7, prefix='first', skew=1.2)
+        seed_dataset(users=20, ads=400, proposals=0, seed=7, prefix='second', skew=1.2)
+        titles = {
+            prefix: list(Ad.objects.filter(user__username__startswith=prefix).order_by('pk').values_list('title', flat=True))
+            for prefix in ('first', 'second')
+        }
+        self.assertEqual(titles['first'], titles['second'])
+        per_user = sorted(Ad.objects.filter(user__username__startswith='first').values('user')
+                          .annotate(n=Count('id')).values_list('n', flat=True))
+        self.assertGreater(per_user[-1], 5 * per_user[len(per_user) // 2])
+
+        with self.assertRaises(CommandError):
+            call_command('seed_benchmark', '--prefix', 'first', '--users', '1', '--ads', '1', stdout=StringIO())
+
+    def test_run_covers_all_scenarios_and_rolls_back(self):
+        seed_dataset(users=4, ads=30, proposals=40, seed=3, prefix='bench')
+        report = benchmark.run(repeat=2, warmup=0, trace_memory=False)
+        failed = {name: result['status'] for name, result in report['results'].items() if not result['ok']}
+        self.assertEqual(failed, {})
+        self.assertEqual(set(report['results']), {scenario.name for scenario in benchmark.SCENARIOS})
+        self.assertGreater(report['results']['exchange_received']['queries'], 0)
+        self.assertFalse(User.objects.filter(is_staff=True).exists())
+        json.dumps(report)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'results': {'ad_list': {'p50_ms': 10, 'p95_ms': 20, 'queries': 2}}}
+        report = {'results': {'ad_list': {'p50_ms': 11, 'p95_ms': 40, 'queries': 3}}}
+        flagged = {metric for _, metric, _, _, regression in benchmark.compare(report, baseline) if regression}
+        self.assertEqual(flagged, {'p95_ms', 'queries'})
+
+
+@override_settings(ADS_FEED_CACHE_TIMEOUT=0)
+class ApiTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='123')
+        self.buyer = User.objects.create_user(username='buyer', password='123')
+        self.ads = [
+            Ad.objects.create(user=self.owner, title=f'Телефон {i}', description='Длинное описание ' * 20,
+                              category='Электроника', condition='Новый')
+            for i in range(5)
+        ]
+        self.offer = Ad.objects.create(user=self.buyer, title='Часы', description='-',
+                                       category='Личные вещи', condition='Б/у')
+        self.proposal = ExchangeProposal.objects.create(ad_sender=self.offer, ad_receiver=self.ads[0])
+
+    def test_list_paginates_with_cursor_and_filters(self):
+        data = self.client.get('/api/ads/', {'limit': 2, 'category': 'Электроника'}).json()
+        self.assertEqual([ad['id'] for ad in data['results']], [self.ads[4].pk, self.ads[3].pk])
+        self.assertIsNone(data['previous'])
+        data = self.client.get('/api/ads/', {'limit': 2, 'category': 'Электроника', 'cursor': data['next']}).json()
+        self.assertEqual([ad['id'] for ad in data['results']], [self.ads[2].pk, self.ads[1].pk])
+        self.assertEqual(self.client.get('/api/ads/', {'cursor': 'мусор'}).status_code, 400)
+
+        # Как и на главной, свои объявления в ленте не показываются
+        self.client.login(username='owner', password='123')
+        self.assertEqual([ad['id'] for ad in self.client.get('/api/ads/').json()['results']], [self.offer.pk])
+
+    def test_sparse_fields_limit_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/ads/', {'fields': 'id,title', 'limit': 1})
+        self.assertEqual(response.json()['results'], [{'id': self.offer.pk, 'title': 'Часы'}])
+        sql = queries.captured_queries[-1]['sql']
+        self.assertNotIn('"description"', sql)
+        self.assertNotIn('auth_user', sql)
+
+        response = self.client.get('/api/ads/', {'fields': 'id,user', 'limit': 1, 'compact': '1'})
+        self.assertEqual(response.json()['rows'], [[self.offer.pk, 'buyer']])
+        self.assertEqual(self.client.get('/api/ads/', {'fields': 'id,password'}).json()['unknown'], ['password'])
+
+    def test_conditional_get(self):
+        response = self.client.get(f'/api/ads/{self.offer.pk}/')
+        self.assertEqual(response.json()['user'], 'buyer')
+        self.assertIn('Last-Modified', response)
+        again = self.client.get(f'/api/ads/{self.offer.pk}/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+        # Новое предложение меняет счётчик, а с ним ETag и updated_at
+        ExchangeProposal.objects.create(ad_sender=self.ads[1], ad_receiver=self.offer)
+        changed = self.client.get(f'/api/ads/{self.offer.pk}/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json()['proposals_count'], 1)
+
+        listing = self.client.get('/api/ads/')
+        self.assertEqual(self.client.get('/api/ads/', HTTP_IF_NONE_MATCH=listing['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/api/ads/999/').json(), {'error': 'Не найдено'})
+
+    def test_updated_since_returns_changes_in_update_order(self):
+        since = Ad.objects.get(pk=self.ads[4].pk).updated_at
+        Ad.objects.filter(pk=self.ads[0].pk).update(updated_at=since + timedelta(minutes=1))
+        data = self.client.get('/api/ads/', {'updated_since': since.isoformat(), 'fields': 'id'}).json()
+        self.assertEqual([ad['id'] for ad in data['results']], [self.offer.pk, self.ads[0].pk])
+        self.assertEqual(self.client.get('/api/ads/', {'updated_since': 'вчера'}).status_code, 400)
+
+    def test_create_requires_login_and_validates(self):
+        payload = {'title': 'Велосипед', 'description': 'Горный', 'category': 'Транспорт', 'condition': 'Б/у'}
+        self.assertEqual(self.client.post('/api/ads/', payload, content_type='application/json').status_code, 401)
+        self.client.login(username='owner', password='123')
+        response = self.client.post('/api/ads/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['user'], 'owner')
+        self.assertEqual(response['Location'], f"/api/ads/{response.json()['id']}/")
+        invalid = self.client.post('/api/ads/', {**payload, 'category': 'Космос'}, content_type='application/json')
+        self.assertIn('category', invalid.json()['errors'])
+
+        response = self.client.post('/api/proposals/', {'ad_sender': self.ads[2].pk, 'ad_receiver': self.offer.pk},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['status'], 'pending')
+        self.assertEqual(response.json()['receiver'], 'buyer')
+
+    def test_proposal_list_filters_and_accept(self):
+        data = self.client.get('/api/proposals/', {'receiver': 'owner', 'fields': 'id,sender,status'}).json()
+        self.assertEqual(data['results'], [{'id': self.proposal.pk, 'sender': 'buyer', 'status': 'pending'}])
+
+        url = f'/api/proposals/{self.proposal.pk}/accept/'
+        self.client.login(username='buyer', password='123')
+        self.assertEqual(self.client.post(url).status_code, 404)
+        self.client.login(username='owner', password='123')
+        before = ExchangeProposal.objects.get(pk=self.proposal.pk).updated_at
+        response = self.client.post(url)
+        self.assertEqual(response.json()['status'], 'accepted')
+        self.assertGreater(ExchangeProposal.objects.get(pk=self.proposal.pk).updated_at, before)
+        self.assertEqual(self.client.post(url).status_code, 409)
+
+    def test_large_responses_are_gzipped(self):
+        response = self.client.get('/api/ads/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+
+@unittest.skipUnless('replica' in settings.DATABASES and not settings.DATABASES['replica'].get('TEST', {}).get('MIRROR'),
+                     'нужна отдельная база replica, см. bartersystem/test_settings.py')
+@override_settings(ADS_DB_REPLICAS=['replica'], ADS_DB_STICKY_SECONDS=10, ADS_FEED_CACHE_TIMEOUT=0)
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        # Реплика — отдельная база: на ней видно только то, что записано туда явно
+        self.user = User.objects.create_user(username='owner', password='123')
+        User.objects.using('replica').create(pk=self.user.pk, username='owner')
+        Ad.objects.create(user=self.user, title='С основной', description='-', category='Транспорт', condition='Б/у')
+        Ad.objects.using('replica').create(user_id=self.user.pk, title='С реплики', description='-',
+                                           category='Транспорт', condition='Б/у')
+
+    def test_lists_read_from_replica(self):
+        self.assertContains(self.client.get('/'), 'С реплики')
+        self.assertNotContains(self.client.get('/'), 'С основной')
+        self.assertEqual([ad['title'] for ad in self.client.get('/api/ads/').json()['results']], ['С реплики'])
+
+    def test_session_and_user_stay_on_primary(self):
+        self.client.login(username='owner', password='123')
+        response = self.client.get('/my-ads/')
+        self.assertEqual(response.context['user'], self.user)
+        self.assertContains(response, 'С реплики')
+
+    def test_own_write_pins_reads_to_primary(self):
+        self.client.login(username='owner', password='123')
+        # Сам вход записал last_login — сбрасываем прилипание, чтобы проверить запись объявления
+        self.client.cookies.pop(STICKY_COOKIE, None)
+        response = self.client.post('/ads/new/', {
+            'title': 'Новое', 'description': '-', 'category': 'Транспорт', 'condition': 'Новый',
+        })
+        self.assertEqual(response.cookies[STICKY_COOKIE]['max-age'], 10)
+        self.assertContains(self.client.get('/my-ads/'), 'Новое')
+
+        self.client.cookies.pop(STICKY_COOKIE)
+        self.assertNotContains(self.client.get('/my-ads/'), 'Новое')
+
+    def test_writes_and_non_list_views_use_primary(self):
+        self.client.login(username='owner', password='123')
+        ad = Ad.objects.get(title='С основной')
+        self.assertEqual(self.client.get(f'/api/ads/{ad.pk}/').json()['title'], 'С основной')
+        self.assertIsNone(self.client.get('/').cookies.get(STICKY_COOKIE))
+        self.assertEqual(ReplicaRouter().db_for_write(Ad), 'default')
+
+
+class _RecordingBroker(LocalBroker):
+    """Брокер, запоминающий опубликованные события"""
+
+    def __init__(self):
+        super().__init__()
+        self.published = []
+
+    def publish(self, user_ids, event, data):
+        self.published.append((sorted(user_ids), event, data))
+        super().publish(user_ids, event, data)
+
+
+@override_settings(ADS_NOTIFICATIONS_BROKER='ads.tests._RecordingBroker', ADS_EVENTS_HEARTBEAT=0.05)
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.broker = get_broker()
+        self.broker.published.clear()
+        self.owner = User.objects.create_user(username='owner', password='123')
+        self.buyers = [User.objects.create(username=f'buyer{i}') for i in range(2)]
+        self.own = Ad.objects.create(user=self.owner, title='Моё', description='-',
+                                     category='Личные вещи', condition='Б/у')
+        self.offers = [Ad.objects.create(user=user, title='Вещь', description='-', category='Личные вещи',
+                                         condition='Б/у') for user in self.buyers]
+
+    def _events(self):
+        return [(users, data['id'], data['status'], data['change']) for users, _, data in self.broker.published]
+
+    def test_proposal_changes_notify_owners_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.own)
+            self.assertEqual(self.broker.published, [])
+        with self.captureOnCommitCallbacks(execute=True):
+            second = ExchangeProposal.objects.create(ad_sender=self.offers[1], ad_receiver=self.own)
+        owner, buyers = self.owner.pk, [user.pk for user in self.buyers]
+        self.assertEqual(self._events(), [([owner], first.pk, 'pending', 'created'),
+                                          ([owner], second.pk, 'pending', 'created')])
+
+        # Принятие отклоняет конкурирующее предложение: уведомлены обе стороны обоих
+        self.broker.published.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeProposal.objects.filter(pk=first.pk).accept()
+        self.assertEqual(sorted(self._events()), [
+            (sorted([owner, buyers[0]]), first.pk, 'accepted', 'status'),
+            (sorted([owner, buyers[1]]), second.pk, 'rejected', 'status'),
+        ])
+
+        self.broker.published.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            second.comment = 'Без смены статуса'
+            second.save()
+        self.assertEqual(self.broker.published, [])
+
+    def test_broker_fans_out_across_threads_and_collapses_overflow(self):
+        broker = LocalBroker(queue_size=2)
+
+        async def scenario():
+            mine, other = broker.subscribe(1), broker.subscribe(2)
+            publisher = threading.Thread(target=broker.publish, args=([1], 'proposal', {'id': 5}))
+            publisher.start()
+            publisher.join()
+            self.assertEqual(await asyncio.wait_for(mine.get(), 1), b'event: proposal\ndata: {"id":5}\n\n')
+            self.assertTrue(other.queue.empty())
+            for number in range(3):
+                broker.publish([1], 'proposal', {'id': number})
+            await asyncio.sleep(0.01)
+            self.assertEqual(mine.queue.qsize(), 1)
+            self.assertEqual(await mine.get(), RESYNC)
+            mine.close()
+            other.close()
+
+        async_to_sync(scenario)()
+        self.assertEqual(broker.connection_count(), 0)
+
+    def test_event_stream_requires_session_and_streams_events(self):
+        self.client.login(username='owner', password='123')
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        app = EventStreamApp(broker=self.broker, user_loader=sync_to_async(load_user))
+
+        async def request(headers):
+            incoming, sent = asyncio.Queue(), []
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'method': 'GET', 'path': '/events/', 'headers': headers}
+            task = asyncio.ensure_future(app(scope, incoming.get, send))
+            return task, incoming, sent
+
+        async def scenario():
+            task, _, sent = await request([])
+            await task
+            self.assertEqual(sent[0]['status'], 401)
+
+            task, incoming, sent = await request([(b'cookie', cookie.encode())])
+            while len(sent) < 2:
+                await asyncio.sleep(0.01)
+            self.assertIn(b'event: stats\ndata: {"pending_received":0,"pending_sent":0}', sent[1]['body'])
+            await sync_to_async(self._propose)()
+            while not any(b'event: proposal' in message.get('body', b'') for message in sent):
+                await asyncio.sleep(0.01)
+            # Тихое соединение получает пинги, отключение клиента завершает поток
+            await asyncio.sleep(0.1)
+            self.assertIn(PING, [message.get('body') for message in sent])
+            await incoming.put({'type': 'http.disconnect'})
+            await asyncio.wait_for(task, 1)
+
+        async_to_sync(scenario)()
+        self.assertEqual(self.broker.connection_count(), 0)
+
+    def _propose(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.own)
+
+
+@unittest.skipIf(np is None, 'NumPy не установлен')
+class RecommendationTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(ADS_RECOMMENDATIONS_DIR=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_recommendations().reset()
+        self.addCleanup(get_recommendations().reset)
+
+        self.user = User.objects.create_user(username='viewer', password='123')
+        self.bike = self._ad(self.user, 'Горный велосипед', 'Велосипед на 21 скорость')
+        self.others = [User.objects.create(username=f'other{i}') for i in range(3)]
+        self.road_bike = self._ad(self.others[0], 'Шоссейный велосипед', 'Лёгкий велосипед')
+        self.kids_bike = self._ad(self.others[1], 'Детский велосипед', 'Велосипед для ребёнка')
+        self.sofa = self._ad(self.others[2], 'Диван', 'Мягкий диван')
+        self.frame = self._ad(self.others[2], 'Шлем', 'Шлем для горного спуска')
+        for title in ('Шкаф', 'Стол', 'Лампа', 'Ковёр', 'Телефон', 'Ноутбук'):
+            self._ad(self.others[2], title, f'{title} в хорошем состоянии')
+
+    def _ad(self, user, title, description):
+        return Ad.objects.create(user=user, title=title, description=description,
+                                 category='Транспорт', condition='Б/у')
+
+    def test_similar_ads_first_without_own_and_unrelated(self):
+        ids = get_recommendations().recommend(self.user)
+        self.assertEqual(set(ids[:2]), {self.road_bike.pk, self.kids_bike.pk})
+        self.assertIn(self.frame.pk, ids)
+        self.assertNotIn(self.bike.pk, ids)
+        self.assertNotIn(self.sofa.pk, ids)
+
+    def test_history_excludes_proposed_and_demotes_refusing_owner(self):
+        ExchangeProposal.objects.create(ad_sender=self.bike, ad_receiver=self.road_bike)
+        ids = get_recommendations().recommend(self.user)
+        self.assertNotIn(self.road_bike.pk, ids)
+
+        refused = ExchangeProposal.objects.create(ad_sender=self.bike, ad_receiver=self.kids_bike)
+        ExchangeProposal.objects.filter(pk=refused.pk).reject()
+        with self.captureOnCommitCallbacks(execute=True):
+            spare = self._ad(self.others[1], 'Велосипед', 'Ещё один велосипед')
+            twin = self._ad(self.others[0], 'Велосипед', 'Ещё один велосипед')
+        ids = get_recommendations().recommend(self.user)
+        self.assertNotIn(self.kids_bike.pk, ids)
+        self.assertLess(ids.index(twin.pk), ids.index(spare.pk))
+
+    def test_changes_are_incremental_and_index_is_shared_through_disk(self):
+        engine = get_recommendations()
+        engine.recommend(self.user)
+        index = engine.index
+        with self.captureOnCommitCallbacks(execute=True):
+            scooter = self._ad(self.others[2], 'Велосипед-самокат', 'Велосипед')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.road_bike.delete()
+        ids = engine.recommend(self.user)
+        self.assertIs(engine.index, index)
+        self.assertIn(scooter.pk, ids)
+        self.assertNotIn(self.road_bike.pk, ids)
+
+        # Другой процесс открывает сохранённые файлы и догружает изменения по updated_at
+        other = RecommendationEngine()
+        self.assertTrue(other.load())
+        self.assertIsInstance(other.index.data, np.memmap)
+        self.assertIn(scooter.pk, other.recommend(self.user))
+
+    @override_settings(ADS_TASKS_EAGER=False)
+    def test_request_does_not_build_index(self):
+        engine = get_recommendations()
+        self.assertEqual(engine.recommend(self.user), [])
+        self.assertIsNone(engine.index)
+        self.assertEqual(list(Task.objects.values_list('name', flat=True)), ['ads.tasks.build_recommendations'])
+        self.client.login(username='viewer', password='123')
+        choices = self.client.get('/exchange/new/').context['form'].fields['ad_receiver'].widget.choices
+        # Пока индекса нет — последние объявления
+        self.assertIn(self.sofa.pk, [value for value, _ in choices])
+
+        execute(Task.objects.get().pk)
+        self.assertIn(self.road_bike.pk, engine.recommend(self.user))
+
+    @override_settings(ADS_TASKS_EAGER=False)
+    def test_expired_index_reloads_newer_build_instead_of_rebuilding(self):
+        engine = get_recommendations()
+        RecommendationEngine().rebuild()
+        self.assertTrue(engine.load())
+        old = engine.index
+        with self.settings(ADS_RECOMMENDATIONS_REBUILD_INTERVAL=0):
+            # Ничего новее на диске: текущий индекс служит дальше, перестройка уходит в очередь
+            self.assertIs(engine.get_index(), old)
+            self.assertEqual(Task.objects.count(), 1)
+
+            # Другой процесс построил индекс — он подхватывается с диска, вторая задача не ставится
+            RecommendationEngine().rebuild()
+            self.assertIsNot(engine.get_index(), old)
+            self.assertEqual(Task.objects.count(), 1)
+
+    def test_form_lists_recommendations_but_accepts_any_ad(self):
+        self.client.login(username='viewer', password='123')
+        response = self.client.get('/exchange/new/')
+        choices = [value for value, _ in response.context['form'].fields['ad_receiver'].widget.choices]
+        self.assertIn(self.road_bike.pk, choices)
+        self.assertNotIn(self.sofa.pk, choices)
+
+        response = self.client.post('/exchange/new/', {'ad_sender': self.bike.pk, 'ad_receiver': self.sofa.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(ExchangeProposal.objects.filter(ad_receiver=self.sofa).exists())
+
+
+class DeletionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username='owner', password='123')
+        self.ad = Ad.objects.create(user=self.owner, title='Популярное', description='-',
+                                    category='Транспорт', condition='Б/у')
+        self.kept = Ad.objects.create(user=self.owner, title='Оставить', description='-',
+                                      category='Транспорт', condition='Б/у')
+        self.buyers = [User.objects.create(username=f'buyer{i}') for i in range(3)]
+        self.offers = [Ad.objects.create(user=user, title='Вещь', description='-', category='Транспорт',
+                                         condition='Б/у') for user in self.buyers]
+        for offer in self.offers:
+            ExchangeProposal.objects.create(ad_sender=offer, ad_receiver=self.ad)
+        ExchangeProposal.objects.create(ad_sender=self.offers[0], ad_receiver=self.kept)
+        # Предложение от удаляемого объявления уменьшит счётчик чужого
+        self.outgoing = ExchangeProposal.objects.create(ad_sender=self.ad, ad_receiver=self.offers[1])
+
+    def assertCountersConsistent(self):
+        self.assertEqual({name: drift for name, drift in reconcile_counters(fix=False).items() if drift != (0, 0)}, {})
+
+    def test_delete_view_purges_without_loading_proposals(self):
+        self.client.login(username='owner', password='123')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(f'/ads/{self.ad.pk}/delete/')
+        self.assertRedirects(response, '/my-ads/', fetch_redirect_response=False)
+        self.assertFalse(Ad.objects.filter(pk=self.ad.pk).exists())
+        self.assertEqual(list(ExchangeProposal.objects.values_list('ad_receiver', flat=True)), [self.kept.pk])
+        self.assertCountersConsistent()
+        # Предложения удаляются одним DELETE, а не загружаются и удаляются по одному
+        selects = [q['sql'] for q in context.captured_queries if 'FROM "ads_exchangeproposal"' in q['sql']
+                   and q['sql'].startswith('SELECT "ads_exchangeproposal"."id", "ads_exchangeproposal"."ad_sender_id"')]
+        self.assertEqual(selects, [])
+
+    def test_query_count_does_not_grow_with_cascade(self):
+        counts = []
+        for extra in (0, 20):
+            ad = Ad.objects.create(user=self.owner, title='Ещё', description='-', category='Транспорт',
+                                   condition='Б/у')
+            for _ in range(extra + 2):
+                ExchangeProposal.objects.create(ad_sender=self.offers[2], ad_receiver=ad)
+            with CaptureQueriesContext(connection) as context:
+                delete_ads([ad.pk])
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertCountersConsistent()
+
+    @override_settings(ADS_DELETE_SYNC_LIMIT=2, ADS_TASKS_EAGER=False)
+    def test_large_cascade_is_hidden_at_once_and_purged_in_background(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(delete_ads([self.ad.pk]))
+        self.assertTrue(Ad.objects.filter(pk=self.ad.pk).exists())
+        self.assertNotContains(self.client.get('/'), 'Популярное')
+        self.assertEqual(self.client.get(f'/api/ads/{self.ad.pk}/').status_code, 404)
+        ids = [item['id'] for item in self.client.get('/api/proposals/').json()['results']]
+        self.assertEqual(ids, list(ExchangeProposal.objects.filter(ad_receiver=self.kept).values_list('pk', flat=True)))
+
+        task_item = Task.objects.get(name='ads.tasks.purge_deleted_ads')
+        self.assertEqual(execute(claim('test', 10)[0]), Task.DONE)
+        self.assertFalse(Ad.objects.filter(pk=self.ad.pk).exists())
+        self.assertEqual(ExchangeProposal.objects.count(), 1)
+        self.assertCountersConsistent()
+        # Повторный запуск очистки безопасен
+        purge_ads(task_item.args[0])
+
+    def test_foreign_delete_receiver_falls_back_to_orm_delete(self):
+        seen = []
+
+        def receiver(sender, instance, **kwargs):
+            seen.append(instance.pk)
+
+        post_delete.connect(receiver, sender=ExchangeProposal)
+        self.addCleanup(post_delete.disconnect, receiver, sender=ExchangeProposal)
+        self.assertFalse(fast_delete_allowed())
+        delete_ads([self.ad.pk])
+        self.assertEqual(len(seen), 4)
+        self.assertCountersConsistent()
+
+    def test_delete_user(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertFalse(delete_user(self.owner))
+        self.assertFalse(User.objects.filter(pk=self.owner.pk).exists())
+        self.assertFalse(Ad.objects.filter(user_id=self.owner.pk).exists())
+        self.assertEqual(ExchangeProposal.objects.count(), 0)
+        self.assertCountersConsistent()
+
+    @override_settings(ADS_DELETE_SYNC_LIMIT=2, ADS_TASKS_EAGER=False)
+    def test_delete_user_in_background_blocks_login_at_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(delete_user(self.owner))
+        self.assertFalse(self.client.login(username='owner', password='123'))
+        self.assertFalse(Ad.objects.visible().filter(user=self.owner).exists())
+        execute(claim('test', 10)[0])
+        self.assertFalse(User.objects.filter(pk=self.owner.pk).exists())
+        self.assertCountersConsistent()
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='123')
+        self.ad = Ad.objects.create(user=self.owner, title='Велосипед', description='-', category='Транспорт',
+                                    condition='Б/у')
+        now = timezone.now()
+        self.proposals = []
+        for i in range(6):
+            sender = User.objects.create_user(username=f'sender{i}', password='123')
+            offer = Ad.objects.create(user=sender, title=f'Обмен {i}', description='-', category='Транспорт',
+                                      condition='Новый')
+            proposal = ExchangeProposal.objects.create(ad_sender=offer, ad_receiver=self.ad)
+            # Чётные — давно решены, нечётные — свежие или ещё ждут ответа
+            status = ExchangeProposal.PENDING if i == 5 else (ExchangeProposal.ACCEPTED if i == 0 else ExchangeProposal.REJECTED)
+            age = timedelta(days=400 if i % 2 == 0 else 1)
+            ExchangeProposal.objects.filter(pk=proposal.pk).update(
+                status=status, created_at=now - age + timedelta(minutes=i), updated_at=now - age + timedelta(minutes=i),
+            )
+            self.proposals.append(proposal.pk)
+        reconcile_counters()
+        self.old = self.proposals[0::2]
+
+    def assertCountersConsistent(self):
+        self.assertEqual({name: drift for name, drift in reconcile_counters(fix=False).items() if drift != (0, 0)}, {})
+
+    def received_ids(self):
+        ids, query = [], ''
+        while True:
+            response = self.client.get('/exchange/received/?' + query)
+            ids += [proposal.pk for proposal in response.context['proposals']]
+            page = response.context['page_obj']
+            if not page.has_next():
+                return ids
+            query = page.next_querystring
+
+    def test_archive_moves_old_resolved_proposals(self):
+        self.assertEqual(archive_proposals(batch_size=2), 3)
+        self.assertEqual(set(ArchivedProposal.objects.values_list('pk', flat=True)), set(self.old))
+        self.assertEqual(set(ExchangeProposal.objects.values_list('pk', flat=True)), set(self.proposals) - set(self.old))
+        self.assertEqual(ArchivedProposal.objects.get(pk=self.old[0]).status, ExchangeProposal.ACCEPTED)
+        # Перенос не удаление: счётчики те же
+        self.assertEqual(UserStats.objects.get(user=self.owner).proposals_received, 6)
+        self.assertCountersConsistent()
+
+    def test_command_is_resumable(self):
+        out = StringIO()
+        call_command('archive_proposals', '--batch-size', '2', '--max-batches', '1', '--sleep', '0', stdout=out)
+        self.assertEqual(ArchivedProposal.objects.count(), 2)
+        call_command('archive_proposals', '--dry-run', stdout=out)
+        self.assertIn('К переносу: 1', out.getvalue())
+        call_command('archive_proposals', '--sleep', '0', stdout=out)
+        self.assertEqual(ArchivedProposal.objects.count(), 3)
+        self.assertEqual(archive_proposals(), 0)
+
+    def test_history_views_read_archive(self):
+        expected = list(ExchangeProposal.objects.order_by('-created_at', '-id').values_list('pk', flat=True))
+        self.client.login(username='owner', password='123')
+        self.assertEqual(self.received_ids(), expected)
+        archive_proposals()
+        self.assertEqual(self.received_ids(), expected)
+        history = ProposalHistory().filter(ad_receiver=self.ad).order_by('-created_at', '-id')
+        self.assertEqual(history.count(), 6)
+        self.assertEqual([proposal.pk for proposal in history[1:4]], expected[1:4])
+        with self.assertNumQueries(1):
+            self.assertEqual([proposal.pk for proposal in history.filter(status=ExchangeProposal.PENDING)[:5]],
+                             [self.proposals[5]])
+
+        response = self.client.get('/api/proposals/', {'mine': 'received', 'limit': 4})
+        page = response.json()
+        response = self.client.get('/api/proposals/', {'mine': 'received', 'cursor': page['next']})
+        self.assertEqual([row['id'] for row in page['results'] + response.json()['results']], expected)
+        self.assertEqual(self.client.get(f'/api/proposals/{self.old[0]}/').json()['status'], ExchangeProposal.ACCEPTED)
+        response = self.client.post(f'/api/proposals/{self.old[1]}/accept/')
+        self.assertEqual(response.status_code, 409)
+
+    def test_export_merges_archive_by_id(self):
+        archive_proposals()
+        User.objects.filter(pk=self.owner.pk).update(is_staff=True)
+        self.client.login(username='owner', password='123')
+        response = self.client.get('/exchange/export/', {'format': 'ndjson'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], sorted(self.proposals))
+
+    def test_deleting_ad_purges_archive(self):
+        archive_proposals()
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_ads([self.ad.pk])
+        self.assertFalse(ArchivedProposal.objects.exists())
+        self.assertCountersConsistent()
+
+        ad = Ad.objects.create(user=self.owner, title='Лодка', description='-', category='Транспорт', condition='Б/у')
+        proposal = ExchangeProposal.objects.create(ad_sender=Ad.objects.exclude(user=self.owner).first(), ad_receiver=ad,
+                                                   status=ExchangeProposal.REJECTED)
+        ExchangeProposal.objects.filter(pk=proposal.pk).update(updated_at=timezone.now() - timedelta(days=400))
+        archive_proposals()
+        # Обычный каскад ORM тоже уменьшает счётчики за архивные строки
+        ad.delete()
+        self.assertCountersConsistent()
+
+
+class ProductionProfileTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        from bartersystem import production_settings
+
+        self.profile = production_settings
+        self.user = User.objects.create_user(username='owner', password='123')
+        Ad.objects.create(user=self.user, title='Велосипед', description='Горный ' * 100, category='sport',
+                          condition='used')
+
+    def session_queries(self, engine):
+        client = Client()
+        with self.settings(SESSION_ENGINE=engine):
+            client.force_login(self.user)
+            with CaptureQueriesContext(connection) as context:
+                response = client.get('/my-ads/')
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries if 'django_session' in query['sql']]
+
+    def test_profile(self):
+        self.assertFalse(self.profile.DEBUG)
+        loaders = self.profile.TEMPLATES[0]['OPTIONS']['loaders']
+        self.assertEqual(loaders[0][0], 'django.template.loaders.cached.Loader')
+        # Базовые настройки профиль не меняет
+        self.assertNotIn('loaders', settings.TEMPLATES[0]['OPTIONS'])
+        middleware = self.profile.MIDDLEWARE
+        self.assertLess(middleware.index('django.middleware.gzip.GZipMiddleware'),
+                        middleware.index('django.middleware.http.ConditionalGetMiddleware'))
+        self.assertNotIn('django.middleware.gzip.GZipMiddleware', settings.MIDDLEWARE)
+
+    def test_cache_sessions_skip_session_table(self):
+        self.assertTrue(self.session_queries('django.contrib.sessions.backends.db'))
+        self.assertEqual(self.session_queries('django.contrib.sessions.backends.cache'), [])
+        self.assertEqual(self.session_queries('django.contrib.sessions.backends.signed_cookies'), [])
+
+    def test_responses_are_compressed_with_etag(self):
+        with self.settings(MIDDLEWARE=self.profile.MIDDLEWARE, TEMPLATES=self.profile.TEMPLATES,
+                           ADS_FEED_CACHE_TIMEOUT=0):
+            response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertIn('Велосипед', gzip.decompress(response.content).decode())
+            repeated = self.client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response['ETag']})
+        self.assertEqual(repeated.status_code, 304)
+
+    def test_collectstatic_writes_hashed_precompressed_files(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storages = {**settings.STORAGES, 'staticfiles': self.profile.STORAGES['staticfiles']}
+        with self.settings(STATIC_ROOT=root, STORAGES=storages):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            storage = PrecompressedManifestStaticFilesStorage()
+            hashed = storage.stored_name('admin/css/base.css')
+        self.assertNotEqual(hashed, 'admin/css/base.css')
+        with open(os.path.join(root, hashed), 'rb') as original, open(os.path.join(root, hashed + '.gz'), 'rb') as packed:
+            self.assertEqual(gzip.decompress(packed.read()), original.read())
+        # Уже сжатые форматы не пережимаются
+        self.assertFalse([name for _, _, files in os.walk(root) for name in files if name.endswith('.png.gz')])
+
+    def test_benchmark_compares_each_setting(self):
+        seed_dataset(users=3, ads=10, proposals=10, seed=5, prefix='profile')
+        variants = dict(benchmark.profile_variants('bartersystem.production_settings'))
+        self.assertEqual(variants['current'], {})
+        self.assertIn('MIDDLEWARE', variants)
+        self.assertIn('SESSION_ENGINE=signed_cookies', variants)
+        report = benchmark.run_profile('bartersystem.production_settings', benchmark.SCENARIOS[:6],
+                                       repeat=1, warmup=0, trace_memory=False)
+        for label, variant in report['variants'].items():
+            self.assertTrue(all(result['ok'] for result in variant['results'].values()), label)
+        self.assertLess(report['variants']['MIDDLEWARE']['results']['ad_list']['response_kb'],
+                        report['variants']['current']['results']['ad_list']['response_kb'])
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        ratelimit._stores.clear()
+        self.addCleanup(ratelimit._stores.clear)
+        self.user = User.objects.create_user(username='owner', password='123')
+        self.other = User.objects.create_user(username='buyer', password='123')
+        self.bike = Ad.objects.create(user=self.user, title='Велосипед', description='-', category='sport',
+                                      condition='used')
+        self.sofa = Ad.objects.create(user=self.other, title='Диван', description='-', category='home',
+                                      condition='used')
+
+    def test_sliding_window(self):
+        store, rate = MemoryStore(), parse_rate('2/m')
+        self.assertEqual(rate, (2, 60))
+        self.assertEqual(parse_rate('5/10m'), (5, 600))
+        self.assertTrue(store.hit('k', rate, now=0).allowed)
+        self.assertTrue(store.hit('k', rate, now=1).allowed)
+        # Окно заполнено: в следующем окне вклад этого затухнет наполовину к 90-й секунде
+        self.assertEqual(store.hit('k', rate, now=2), (False, 88))
+        self.assertFalse(store.hit('k', rate, now=60).allowed)
+        self.assertTrue(store.hit('k', rate, now=90).allowed)
+        self.assertFalse(store.hit('k', rate, now=91).allowed)
+        # Через окно без запросов старые счётчики не учитываются
+        self.assertTrue(store.hit('k', rate, now=300).allowed)
+        for value in ('много', '0/h', '5/0m'):
+            with self.assertRaises(ValueError):
+                parse_rate(value)
+
+    def test_memory_store_is_bounded(self):
+        store, rate = MemoryStore(max_keys=3), parse_rate('1/h')
+        for key in 'abcd':
+            store.hit(key, rate, now=0)
+        store.hit('b', rate, now=1)
+        store.hit('e', rate, now=2)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(list(store.windows), ['d', 'b', 'e'])
+
+    def test_cache_store_is_shared_between_instances(self):
+        cache.clear()
+        rate = parse_rate('3/m')
+        first, second = CacheStore(), CacheStore()
+        self.assertTrue(first.hit('k', rate, now=0).allowed)
+        self.assertTrue(second.hit('k', rate, now=1).allowed)
+        self.assertTrue(async_to_sync(first.ahit)('k', rate, now=2).allowed)
+        self.assertEqual(second.hit('k', rate, now=3), (False, 77))
+        # Отклонённый запрос не учтён: счётчик окна остался 3
+        self.assertEqual(cache.get('k:0'), 3)
+        self.assertTrue(async_to_sync(second.ahit)('k', rate, now=80).allowed)
+
+    @override_settings(ADS_RATE_LIMITS={'exchange_create': {'user': '1/h', 'ip': '10/h'}})
+    def test_page_gets_429_with_retry_after(self):
+        self.client.force_login(self.user)
+        payload = {'ad_sender': self.bike.pk, 'ad_receiver': self.sofa.pk}
+        self.assertEqual(self.client.post('/exchange/new/', payload).status_code, 302)
+        response = self.client.post('/exchange/new/', payload)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 3000)
+        self.assertEqual(ExchangeProposal.objects.count(), 1)
+        # Чтение не ограничивается, у другого пользователя свой счётчик
+        self.assertEqual(self.client.get('/exchange/new/').status_code, 200)
+        self.client.force_login(self.other)
+        response = self.client.post('/exchange/new/', {'ad_sender': self.sofa.pk, 'ad_receiver': self.bike.pk})
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(ADS_RATE_LIMITS={'api_proposals': {'user': '10/h', 'ip': '1/h'}},
+                       ADS_RATE_LIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_api_limits_by_ip(self):
+        self.client.force_login(self.user)
+        payload = {'ad_sender': self.bike.pk, 'ad_receiver': self.sofa.pk}
+        headers = {'X-Forwarded-For': '198.51.100.1, 203.0.113.5'}
+        response = self.client.post('/api/proposals/', payload, content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.client.force_login(self.other)
+        # Подделанная левая запись не даёт нового адреса: считается добавленная прокси
+        response = self.client.post('/api/proposals/', {'ad_sender': self.sofa.pk, 'ad_receiver': self.bike.pk},
+                                    content_type='application/json',
+                                    headers={'X-Forwarded-For': '198.51.100.2, 203.0.113.5'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json(), {'error': 'Слишком много запросов',
+                                           'retry_after': int(response['Retry-After'])})
+        response = self.client.post('/api/proposals/', {'ad_sender': self.sofa.pk, 'ad_receiver': self.bike.pk},
+                                    content_type='application/json', headers={'X-Forwarded-For': '203.0.113.6'})
+        self.assertEqual(response.status_code, 201)
+
+    @override_settings(ADS_RATE_LIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR', ADS_RATE_LIMIT_TRUSTED_PROXIES=2)
+    def test_client_ip_skips_trusted_proxies(self):
+        factory = RequestFactory()
+        request = factory.get('/', headers={'X-Forwarded-For': '198.51.100.1, 203.0.113.5, 10.0.0.2'})
+        self.assertEqual(ratelimit.client_ip(request), '203.0.113.5')
+        request = factory.get('/', headers={'X-Forwarded-For': '203.0.113.5'})
+        self.assertEqual(ratelimit.client_ip(request), '203.0.113.5')
+        self.assertEqual(ratelimit.client_ip(factory.get('/')), '127.0.0.1')
+
+    @override_settings(ADS_RATE_LIMITS={'api_ads': {'user': '1/h'}})
+    async def test_async_handler_limits_by_user(self):
+        await self.async_client.aforce_login(self.user)
+        payload = {'title': 'Самокат', 'description': '-', 'category': 'Транспорт', 'condition': 'Б/у'}
+        response = await self.async_client.post('/api/ads/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = await self.async_client.post('/api/ads/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
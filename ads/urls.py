@@ -1,7 +1,18 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib.auth import views as auth_views
 from .views import (AdListView, AdCreateView, AdUpdateView, AdDeleteView, ExchangeProposalCreateView, ExchangeProposalListView, 
-                    SentProposalsView, ReceivedProposalsView, MyAdsView, SignUpView)
+                    ExchangeProposalExportView, SentProposalsView, TradeCyclesView, AdImageView, ReceivedProposalsView, MyAdsView, SignUpView,
+                    MetricsView)
+from .api import (AdApiView, AdCollectionApiView, ProposalAnswerApiView, ProposalApiView,
+                  ProposalCollectionApiView)
+
+if settings.ADS_ASYNC_VIEWS:
+    # Режим ASGI: представления только для чтения выполняются асинхронно
+    from .async_views import (AsyncAdListView as AdListView, AsyncMyAdsView as MyAdsView,
+                              AsyncExchangeProposalListView as ExchangeProposalListView,
+                              AsyncSentProposalsView as SentProposalsView,
+                              AsyncReceivedProposalsView as ReceivedProposalsView)
 
 urlpatterns = [
     # Объявления
@@ -10,12 +21,28 @@ urlpatterns = [
     path('my-ads/', MyAdsView.as_view(), name='my_ads'),
     path('ads/<int:pk>/edit/', AdUpdateView.as_view(), name='ad_edit'),
     path('ads/<int:pk>/delete/', AdDeleteView.as_view(), name='ad_delete'),
+    path('ads/<int:pk>/image/<slug:size>/', AdImageView.as_view(), name='ad_image'),
 
     # Обмены
     path('exchange/', ExchangeProposalListView.as_view(), name='exchange_list'),
     path('exchange/new/', ExchangeProposalCreateView.as_view(), name='exchange_create'),
+    path('exchange/export/', ExchangeProposalExportView.as_view(), name='exchange_export'),
+    path('exchange/sent/', SentProposalsView.as_view(), name='exchange_sent'),
+    path('exchange/received/', ReceivedProposalsView.as_view(), name='exchange_received'),
+    path('exchange/cycles/', TradeCyclesView.as_view(), name='trade_cycles'),
     
     # Вход/регистрация
     path('login/', auth_views.LoginView.as_view(template_name='ads/login.html', next_page='ad_list'), name='login'),
     path('signup/', SignUpView.as_view(), name='signup'),
+
+    # JSON API
+    path('api/ads/', AdCollectionApiView.as_view(), name='api_ads'),
+    path('api/ads/<int:pk>/', AdApiView.as_view(), name='api_ad'),
+    path('api/proposals/', ProposalCollectionApiView.as_view(), name='api_proposals'),
+    path('api/proposals/<int:pk>/', ProposalApiView.as_view(), name='api_proposal'),
+    path('api/proposals/<int:pk>/accept/', ProposalAnswerApiView.as_view(action='accept'), name='api_proposal_accept'),
+    path('api/proposals/<int:pk>/reject/', ProposalAnswerApiView.as_view(action='reject'), name='api_proposal_reject'),
+
+    # Служебное
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,11 +1,35 @@
+import csv
+import heapq
+import json
+from operator import itemgetter
+
+from django.core.exceptions import PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
+from django.conf import settings
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.shortcuts import render, redirect
+from django.views import View
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
+from django.utils.cache import add_never_cache_headers, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import cached_property
 from django.views.generic.edit import CreateView
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
-from .models import Ad, ExchangeProposal
+from .models import Ad, ArchivedProposal, ExchangeProposal, UserStats
+from .archive import ProposalHistory
+from .cache import CachedFeedMixin
+from .deletion import delete_ads
+from .facets import FacetCountsMixin
 from .forms import AdForm, ExchangeProposalForm
+from .images import ImageError, choose_format, get_image_cache, get_sizes, url_version
+from . import metrics
+from .matching import get_engine, load_cycles
+from .pagination import KeysetPaginationMixin
+from .routers import ReplicaReadMixin, read_db
+from .search import get_search_backend
 
 class SignUpView(CreateView):
     """Регистрация нового пользователя"""
@@ -19,57 +43,73 @@ class SignUpView(CreateView):
         login(self.request, user)
         return redirect(self.success_url)
 
-class MyAdsView(ListView):
-    """Список объявлений текущего пользователя"""
-    model = Ad
-    template_name = 'ads/my_ads.html'
-    context_object_name = 'ads'
-    ordering = ['-created_at']
-    paginate_by = 2
+class AdFilterMixin:
+    """Фильтрация объявлений по категории, состоянию и поисковому запросу"""
 
-    def get_queryset(self):
-        """Фильтрует объявления по текущему пользователю"""
-        qs = Ad.objects.filter(user=self.request.user).order_by('-created_at')
-        
+    def filter_ads(self, qs):
+        """Применяет фильтры из GET-параметров (category, condition, q)"""
         category = self.request.GET.get('category')
         condition = self.request.GET.get('condition')
-        search = self.request.GET.get('q')
 
         if category:
-            qs = qs.filter(category__icontains=category)
+            qs = qs.filter(category=category)
         if condition:
             qs = qs.filter(condition=condition)
-        if search:
-            qs = qs.filter(title__icontains=search)
 
+        return self.search_ads(qs).order_by(*self.get_keyset_ordering())
+
+    def search_ads(self, qs):
+        """Применяет только поисковый запрос (q)"""
+        search = self.request.GET.get('q')
+        if search:
+            qs = get_search_backend().search(qs, search)
         return qs
 
-class AdListView(ListView):
+    def get_keyset_ordering(self):
+        """При поиске сначала идут наиболее релевантные объявления"""
+        if self.request.GET.get('q'):
+            return ('-rank',) + tuple(self.keyset_ordering)
+        return self.keyset_ordering
+
+class MyAdsView(ReplicaReadMixin, AdFilterMixin, KeysetPaginationMixin, ListView):
+    """Список объявлений текущего пользователя"""
+    model = Ad
+    template_name = 'ads/my_ads.html'
+    context_object_name = 'ads'
+    ordering = ['-created_at', '-id']
+    paginate_by = 2
+
+    def dispatch(self, request, *args, **kwargs):
+        """Ограничивает доступ только для авторизованных пользователей"""
+        if not request.user.is_authenticated:
+            return redirect('/admin/login/')
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        """Фильтрует объявления по текущему пользователю"""
+        return self.filter_ads(Ad.objects.visible().filter(user=self.request.user).for_list())
+
+class AdListView(ReplicaReadMixin, CachedFeedMixin, FacetCountsMixin, AdFilterMixin, KeysetPaginationMixin, ListView):
     """Показ всех объявлений"""
     model = Ad
     template_name = 'ads/ad_list.html'
     context_object_name = 'ads'
-    ordering = ['-created_at']
+    ordering = ['-created_at', '-id']
     paginate_by = 2
-    
-    def get_queryset(self):
-        qs = Ad.objects.all().order_by('-created_at')
+
+    def get_base_queryset(self):
+        """Лента без фильтров: все объявления, кроме своих"""
+        qs = Ad.objects.visible()
         if self.request.user.is_authenticated:
             qs = qs.exclude(user=self.request.user)
-        
-        category = self.request.GET.get('category')
-        condition = self.request.GET.get('condition')
-        search = self.request.GET.get('q')
-
-        if category:
-            qs = qs.filter(category__icontains=category)
-        if condition:
-            qs = qs.filter(condition=condition)
-        if search:
-            qs = qs.filter(title__icontains=search)    
-        
         return qs
 
+    def get_queryset(self):
+        return self.filter_ads(self.get_base_queryset().for_feed())
+
+    def get_facet_queryset(self):
+        return self.search_ads(self.get_base_queryset())
+
 class AdCreateView(CreateView):
     """Создание нового объявления"""
     model = Ad
@@ -91,6 +131,7 @@ class AdCreateView(CreateView):
 class AdUpdateView(UpdateView):
     """Редактирование объявления (только автор)"""
     model = Ad
+    queryset = Ad.objects.visible()
     form_class = AdForm
     template_name = 'ads/ad_form.html'
     success_url = reverse_lazy('my_ads')
@@ -105,6 +146,7 @@ class AdUpdateView(UpdateView):
 class AdDeleteView(DeleteView):
     """Удаление объявления (только автор)"""
     model = Ad
+    queryset = Ad.objects.visible()
     template_name = 'ads/ad_confirm_delete.html'
     success_url = reverse_lazy('my_ads')
 
@@ -114,6 +156,11 @@ class AdDeleteView(DeleteView):
         if request.user != obj.user:
             return redirect('ad_list')
         return super().dispatch(request, *args, **kwargs)
+
+    def form_valid(self, form):
+        """Объявление скрывается сразу, предложения удаляются без загрузки в память (ads/deletion.py)"""
+        delete_ads([self.object.pk])
+        return redirect(self.get_success_url())
     
 class ExchangeProposalCreateView(CreateView):
     """Создание предложения обмена"""
@@ -124,9 +171,15 @@ class ExchangeProposalCreateView(CreateView):
     paginate_by = 2  
 
     def form_valid(self, form):
-        """Устанавливает статус 'Ожидает' перед сохранением предложения"""
-        form.instance.status = 'Ожидает'
+        """Новое предложение всегда ожидает ответа"""
+        form.instance.status = ExchangeProposal.PENDING
         return super().form_valid(form)
+
+    def get_success_url(self):
+        """Если предложение замкнуло цепочку обмена, показывает её"""
+        if get_engine().cycles_for_proposal(self.object, limit=1):
+            return reverse('trade_cycles')
+        return super().get_success_url()
     
     def dispatch(self, request, *args, **kwargs):
         """Ограничивает доступ только для авторизованных пользователей"""
@@ -146,7 +199,7 @@ class ExchangeProposalCreateView(CreateView):
         receiver_id = self.request.GET.get('receiver')
         if receiver_id:
             try:
-                context['receiver_ad'] = Ad.objects.get(pk=receiver_id)
+                context['receiver_ad'] = Ad.objects.visible().select_related('user').get(pk=receiver_id)
             except Ad.DoesNotExist:
                 context['receiver_ad'] = None
         return context
@@ -159,23 +212,21 @@ class ExchangeProposalCreateView(CreateView):
             initial['ad_receiver'] = receiver_id
         return initial
 
-class ExchangeProposalListView(ListView):
-    """Список всех предложений обмена с фильтрацией по статусу, отправителю и получателю"""
-    model = ExchangeProposal
-    template_name = 'exchanges/exchange_list.html'
-    context_object_name = 'proposals'
-    ordering = ['-created_at']
+STATUS_KEYS = {label: key for key, label in ExchangeProposal.STATUS_CHOICES}
 
-    def get_queryset(self):
-        """Применяет фильтры из GET-параметров (status, sender, receiver)"""
-        queryset = ExchangeProposal.objects.all()
+class ProposalFilterMixin:
+    """Фильтрация предложений обмена по статусу, отправителю и получателю"""
+
+    def filter_proposals(self, queryset):
+        """Применяет фильтры из GET-параметров (status, sender, receiver, mine)"""
         status = self.request.GET.get('status')
         sender = self.request.GET.get('sender')
         receiver = self.request.GET.get('receiver')
         mine = self.request.GET.get('mine')
 
         if status:
-            queryset = queryset.filter(status=status)
+            # Старые ссылки передают подпись статуса вместо ключа
+            queryset = queryset.filter(status=STATUS_KEYS.get(status, status))
         if sender:
             queryset = queryset.filter(ad_sender__user__username=sender)
         if receiver:
@@ -188,41 +239,243 @@ class ExchangeProposalListView(ListView):
         
         return queryset
 
-class SentProposalsView(ListView):
+class ExchangeProposalListView(ReplicaReadMixin, ProposalFilterMixin, KeysetPaginationMixin, ListView):
+    """Список всех предложений обмена с фильтрацией по статусу, отправителю и получателю"""
+    model = ExchangeProposal
+    template_name = 'exchanges/exchange_list.html'
+    context_object_name = 'proposals'
+    ordering = ['-created_at', '-id']
+    paginate_by = 2
+
+    def get_queryset(self):
+        """Применяет фильтры из GET-параметров (status, sender, receiver); история — вместе с архивом"""
+        return self.filter_proposals(ProposalHistory().visible().for_list()).order_by('-created_at', '-id')
+
+class ExchangeProposalExportView(ReplicaReadMixin, ProposalFilterMixin, View):
+    """Потоковая выгрузка истории предложений в CSV или NDJSON (только для персонала).
+
+    Строки читаются серверным курсором пачками по ``chunk_size`` и сразу
+    отдаются клиенту, поэтому память воркера не зависит от объёма истории.
+    Действующие и архивные предложения читаются двумя курсорами и
+    сливаются по id.
+    """
+    chunk_size = 2000
+    columns = [
+        'id', 'created_at', 'status', 'comment',
+        'ad_sender_id', 'ad_sender__title', 'ad_sender__user__username',
+        'ad_receiver_id', 'ad_receiver__title', 'ad_receiver__user__username',
+    ]
+
+    def dispatch(self, request, *args, **kwargs):
+        """Доступ только для персонала"""
+        if not request.user.is_authenticated:
+            return redirect('/admin/login/')
+        if not request.user.is_staff:
+            raise PermissionDenied
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in ('csv', 'ndjson'):
+            return HttpResponseBadRequest('Формат выгрузки: csv или ndjson')
+
+        # Строки читаются уже после выхода из представления, поэтому база выбирается заранее
+        rows = heapq.merge(*(
+            self.filter_proposals(model.objects.using(read_db(model)))
+            .order_by('id')
+            .values_list(*self.columns)
+            .iterator(chunk_size=self.chunk_size)
+            for model in (ExchangeProposal, ArchivedProposal)
+        ), key=itemgetter(0))
+        if export_format == 'csv':
+            content, content_type = self._csv(rows), 'text/csv; charset=utf-8'
+        else:
+            content, content_type = self._ndjson(rows), 'application/x-ndjson'
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="proposals.{export_format}"'
+        return response
+
+    def _csv(self, rows):
+        buffer = _LineBuffer()
+        writer = csv.writer(buffer)
+        writer.writerow(self.columns)
+        yield buffer.pop()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.pop()
+
+    def _ndjson(self, rows):
+        for row in rows:
+            yield json.dumps(dict(zip(self.columns, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+class _LineBuffer:
+    """Псевдофайл для csv.writer: отдаёт записанную строку вместо хранения"""
+
+    def __init__(self):
+        self.value = ''
+
+    def write(self, value):
+        self.value += value
+
+    def pop(self):
+        value, self.value = self.value, ''
+        return value
+
+class ProposalStatsMixin:
+    """Счётчики пользователя для бейджей и числа страниц без COUNT по предложениям"""
+    # Поле UserStats с общим числом объектов списка
+    count_field = None
+
+    @cached_property
+    def stats(self):
+        return UserStats.objects.for_user(self.request.user)
+
+    def get_count_func(self):
+        return lambda: getattr(self.stats, self.count_field)
+
+    @property
+    def events_url(self):
+        """Адрес SSE-потока уведомлений; поток есть только под ASGI (bartersystem/asgi.py)"""
+        return settings.ADS_EVENTS_PATH if settings.ADS_ASYNC_VIEWS else ''
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['stats'] = self.stats
+        return context
+
+class SentProposalsView(ReplicaReadMixin, ProposalStatsMixin, KeysetPaginationMixin, ListView):
     """Показать предложения, отправленные текущим пользователем"""
     model = ExchangeProposal
     template_name = 'exchanges/exchange_sent.html'
     context_object_name = 'proposals'
-    ordering = ['-created_at']
+    ordering = ['-created_at', '-id']
     paginate_by = 2
+    count_field = 'proposals_sent'
+
+    def dispatch(self, request, *args, **kwargs):
+        """Ограничивает доступ только для авторизованных пользователей"""
+        if not request.user.is_authenticated:
+            return redirect('/admin/login/')
+        return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self):
-        """Фильтрует предложения, где текущий пользователь является получателем"""
-        return ExchangeProposal.objects.filter(ad_sender__user=self.request.user)
+        """Фильтрует предложения, где текущий пользователь является отправителем"""
+        return ProposalHistory().visible().for_list().filter(
+            ad_sender__user=self.request.user
+        ).order_by('-created_at', '-id')
 
-class ReceivedProposalsView(ListView):
+class ReceivedProposalsView(ReplicaReadMixin, ProposalStatsMixin, KeysetPaginationMixin, ListView):
     """Показать предложения, полученные текущим пользователем"""
     model = ExchangeProposal
     template_name = 'exchanges/exchange_received.html'
     context_object_name = 'proposals'
-    ordering = ['-created_at']
+    ordering = ['-created_at', '-id']
     paginate_by = 2
+    count_field = 'proposals_received'
+    # Сколько выбранных предложений обрабатывается за один запрос
+    bulk_limit = 500
+
+    def dispatch(self, request, *args, **kwargs):
+        """Ограничивает доступ только для авторизованных пользователей"""
+        if not request.user.is_authenticated:
+            return redirect('/admin/login/')
+        return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self):
         """Фильтрует предложения, где текущий пользователь является получателем"""
-        return ExchangeProposal.objects.filter(ad_receiver__user=self.request.user)
+        return ProposalHistory().visible().for_list().filter(
+            ad_receiver__user=self.request.user
+        ).order_by('-created_at', '-id')
     
     def post(self, request, *args, **kwargs):
-        """Обрабатывает изменение статуса предложения: принять или отклонить"""
-        proposal_id = request.POST.get('proposal_id')
+        """Принимает или отклоняет одно предложение, выбранные или все ожидающие.
+
+        Статус меняется только у ожидающих предложений на объявления
+        текущего пользователя, см. ``ExchangeProposalQuerySet.accept``.
+        """
         action = request.POST.get('action')
+        inbox = ExchangeProposal.objects.visible().filter(ad_receiver__user=request.user)
+        if action == 'reject_all':
+            inbox.reject()
+        elif action in ('accept', 'reject'):
+            ids = request.POST.getlist('proposal_ids') or request.POST.getlist('proposal_id')
+            ids = [pk for pk in ids[:self.bulk_limit] if pk.isdigit()]
+            if ids:
+                selected = inbox.filter(pk__in=ids)
+                if action == 'accept':
+                    selected.accept()
+                else:
+                    selected.reject()
 
-        if proposal_id and action in ['Принята', 'Отклонена']:
+        return redirect('exchange_received')
+
+class TradeCyclesView(View):
+    """Цепочки обмена с участием объявлений текущего пользователя"""
+    template_name = 'exchanges/trade_cycles.html'
+    limit = 20
+
+    def dispatch(self, request, *args, **kwargs):
+        """Ограничивает доступ только для авторизованных пользователей"""
+        if not request.user.is_authenticated:
+            return redirect('/admin/login/')
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        cycles = get_engine().cycles_for_user(request.user, limit=self.limit)
+        return render(request, self.template_name, {'cycles': load_cycles(cycles, user=request.user)})
+
+class AdImageView(View):
+    """Миниатюра изображения объявления из дискового кэша.
+
+    Адрес содержит ``?v=`` — хэш текущей ссылки на изображение, поэтому
+    ответ можно кэшировать в браузере бессрочно. Если изображение не
+    скачивается, браузер перенаправляется на исходную ссылку.
+    """
+
+    def get(self, request, pk, size):
+        if size not in get_sizes():
+            raise Http404('Неизвестный размер изображения')
+        url = Ad.objects.visible().filter(pk=pk).values_list('image_url', flat=True).first()
+        if not url:
+            raise Http404('У объявления нет изображения')
+
+        image_format = choose_format(request.headers.get('Accept'))
+        for attempt in range(2):
             try:
-                proposal = ExchangeProposal.objects.get(pk=proposal_id, ad_receiver__user=request.user)
-                proposal.status = action
-                proposal.save()
-            except ExchangeProposal.DoesNotExist:
-                pass
+                path, etag, content_type = get_image_cache().thumbnail(url, size, image_format)
+                handle = open(path, 'rb')
+            except ImageError:
+                return redirect(url)
+            except FileNotFoundError:
+                # Файл вытеснен из кэша между проверкой и чтением — строим заново
+                if attempt:
+                    raise
+                continue
+            break
+
+        etag = f'"{etag}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            handle.close()
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(handle, content_type=content_type)
+        response['ETag'] = etag
+        if request.GET.get('v') == url_version(url):
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = 'public, max-age=300'
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+class MetricsView(View):
+    """Метрики процесса в формате Prometheus: для сотрудников или по ``ADS_METRICS_TOKEN``"""
 
-        return redirect('exchange_received')
\ No newline at end of file
+    def get(self, request):
+        token = getattr(settings, 'ADS_METRICS_TOKEN', '')
+        authorization = request.headers.get('Authorization', '')
+        if not (request.user.is_staff or token and constant_time_compare(authorization, f'Bearer {token}')):
+            raise PermissionDenied
+        response = HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+        add_never_cache_headers(response)
+        return response
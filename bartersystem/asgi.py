@@ -12,5 +12,16 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bartersystem.settings')
+# Под ASGI-сервером списки объявлений и предложений обслуживаются асинхронными представлениями
+os.environ.setdefault('ADS_ASYNC_VIEWS', '1')
+# Асинхронные запросы выполняют ORM в разных потоках, постоянные соединения там не переиспользуются;
+# для повторного использования соединений под ASGI включается пул (DB_POOL=1)
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# SSE-поток уведомлений обслуживается в обход обработчика Django (см. ads/events.py)
+from django.conf import settings  # noqa: E402
+from ads.events import EventStreamApp, mount  # noqa: E402
+
+application = mount(settings.ADS_EVENTS_PATH, EventStreamApp(), django_application)
@@ -0,0 +1,55 @@
+"""Профиль для боевого сервера: ``DJANGO_SETTINGS_MODULE=bartersystem.production_settings``.
+
+Отличия от ``settings.py``: выключен DEBUG (журнал SQL-запросов не копится
+в памяти, ошибки не отдают страницу отладки), шаблоны компилируются один
+раз на процесс, сессия не читается из таблицы на каждом запросе, ответы
+сжимаются и получают ETag, статика собирается с хешами в именах и заранее
+сжатыми копиями. Выигрыш каждой настройки по отдельности показывает
+``python manage.py run_benchmark --profile bartersystem.production_settings``.
+"""
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import CACHES, MIDDLEWARE, TEMPLATES
+
+DEBUG = False
+ALLOWED_HOSTS = list(filter(None, os.getenv('ALLOWED_HOSTS', '').split(',')))
+
+# Скомпилированные шаблоны живут до перезапуска процесса: после выкладки воркеры нужно перезапустить
+TEMPLATES = [{
+    **TEMPLATES[0],
+    'APP_DIRS': False,
+    'OPTIONS': {
+        **TEMPLATES[0]['OPTIONS'],
+        'loaders': [('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ])],
+    },
+}]
+
+# Сессии (SESSION_BACKEND): 'cached_db' — чтение из кэша, запись и в таблицу (по умолчанию при общем кэше:
+# REDIS_URL или CACHE_DIR), 'cache' — только кэш, без запросов к базе, но сессии теряются вместе с кэшем,
+# 'signed_cookies' — данные в подписанной cookie, без хранилища вовсе, 'db' — таблица (по умолчанию без общего
+# кэша: копия сессии в памяти одного воркера устаревала бы, когда сессию меняет другой)
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'db' if CACHES['default']['BACKEND'].endswith('LocMemCache') else 'cached_db')
+SESSION_ENGINE = f'django.contrib.sessions.backends.{SESSION_BACKEND}'
+
+# Сжатие ответов и ETag/304 для страниц без собственной проверки свежести: GZip — до всего, что меняет тело
+# ответа, ConditionalGet — после GZip, чтобы ETag считался по несжатому телу
+MIDDLEWARE = [
+    MIDDLEWARE[0],
+    'django.middleware.gzip.GZipMiddleware',
+    'django.middleware.http.ConditionalGetMiddleware',
+    *MIDDLEWARE[1:],
+]
+
+# Статика: имена с хешем содержимого (кэшируется браузером навсегда) и рядом .gz (и .br, если установлен
+# brotli) — веб-сервер отдаёт их без сжатия на лету (nginx: gzip_static on). Перед запуском — collectstatic
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'ads.storage.PrecompressedManifestStaticFilesStorage'},
+}
+
+# Фоновые задачи выполняет воркер (run_worker), а не запрос
+ADS_TASKS_EAGER = os.getenv('ADS_TASKS_EAGER') == '1'
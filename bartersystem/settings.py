@@ -1,13 +1,15 @@
 from pathlib import Path
 from dotenv import load_dotenv
 import os
+import tempfile
 
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 SECRET_KEY = os.getenv('SECRET_KEY')
-DEBUG = True
+# Режим разработки; для боевого сервера — профиль bartersystem/production_settings.py
+DEBUG = os.getenv('DEBUG', '1') == '1'
 ALLOWED_HOSTS = []
 
 INSTALLED_APPS = [
@@ -17,6 +19,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'ads',
 ]
 
@@ -26,6 +29,9 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'ads.middleware.RequestMetricsMiddleware',
+    'ads.middleware.ReplicaRoutingMiddleware',
+    'ads.middleware.RateLimitMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -50,17 +56,49 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'bartersystem.wsgi.application'
 
-DATABASES = {
-    'default': {
+# Соединения: DB_POOL=1 — пул psycopg 3 (пакет psycopg[pool] вместо psycopg2) с размерами и тайм-аутом ожидания
+# свободного соединения, иначе постоянные соединения на DB_CONN_MAX_AGE секунд с проверкой перед повторным
+# использованием (0 — закрывать после каждого запроса)
+DB_POOL = os.getenv('DB_POOL') == '1'
+
+
+def database(host, port):
+    config = {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': os.getenv('DB_NAME'),
         'USER': os.getenv('DB_USER'),
         'PASSWORD': os.getenv('DB_PASSWORD'),
-        'HOST': os.getenv('DB_HOST'),
-        'PORT': os.getenv('DB_PORT'),
+        'HOST': host,
+        'PORT': port,
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
     }
+    if DB_POOL:
+        config['CONN_MAX_AGE'] = 0
+        config['OPTIONS'] = {'pool': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+            'timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        }}
+    return config
+
+
+DATABASES = {
+    'default': database(os.getenv('DB_HOST'), os.getenv('DB_PORT')),
 }
 
+# Реплики для чтения списков: DB_REPLICAS=host1:5432,host2 — псевдонимы replica_1, replica_2, ...
+# (в тестах они зеркалируют default). После записи пользователь ADS_DB_STICKY_SECONDS секунд читает с основной базы
+for number, address in enumerate(filter(None, os.getenv('DB_REPLICAS', '').split(',')), start=1):
+    replica_host, _, replica_port = address.strip().partition(':')
+    DATABASES[f'replica_{number}'] = {
+        **database(replica_host, replica_port or os.getenv('DB_PORT')),
+        'TEST': {'MIRROR': 'default'},
+    }
+ADS_DB_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+ADS_DB_STICKY_SECONDS = int(os.getenv('ADS_DB_STICKY_SECONDS', '10'))
+DATABASE_ROUTERS = ['ads.routers.ReplicaRouter']
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -82,5 +120,113 @@ USE_I18N = True
 USE_TZ = True
 
 STATIC_URL = 'static/'
+# Куда collectstatic собирает статику для раздачи веб-сервером
+STATIC_ROOT = os.getenv('STATIC_ROOT', BASE_DIR / 'staticfiles')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Пагинация списков объявлений: 'keyset' (по курсору) или 'offset' (по номеру страницы).
+# Подсчёт общего числа: None — не считать, 'exact' — COUNT(*), 'estimate' — оценка планировщика.
+ADS_PAGINATION_MODE = os.getenv('ADS_PAGINATION_MODE', 'keyset')
+ADS_PAGINATION_COUNT_MODE = os.getenv('ADS_PAGINATION_COUNT_MODE', 'estimate') or None
+
+# Поиск по объявлениям: 'auto' (PostgreSQL tsvector или инвертированный индекс), 'postgres', 'python'
+ADS_SEARCH_BACKEND = os.getenv('ADS_SEARCH_BACKEND', 'auto')
+
+# Кэш: Redis-совместимый сервер (REDIS_URL), файловый (CACHE_DIR) или память процесса
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+elif os.getenv('CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_DIR'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Время жизни кэша страниц ленты и карточек объявлений, секунды (0 — отключить)
+ADS_FEED_CACHE_TIMEOUT = int(os.getenv('ADS_FEED_CACHE_TIMEOUT', '300'))
+
+# Время жизни кэша счётчиков фильтров ленты, секунды (0 — считать при каждом запросе)
+ADS_FACETS_CACHE_TIMEOUT = int(os.getenv('ADS_FACETS_CACHE_TIMEOUT', '60'))
+
+# Асинхронные представления для списков (включается автоматически в bartersystem/asgi.py)
+ADS_ASYNC_VIEWS = os.getenv('ADS_ASYNC_VIEWS') == '1'
+
+# Цепочки обмена: каталог снимка графа, максимум участников, период догрузки новых предложений и полной
+# перестройки графа фоновой задачей, секунды
+ADS_MATCHING_DIR = os.getenv('ADS_MATCHING_DIR', os.path.join(tempfile.gettempdir(), 'bartersystem-matching'))
+ADS_MATCHING_MAX_LENGTH = int(os.getenv('ADS_MATCHING_MAX_LENGTH', '4'))
+ADS_MATCHING_REFRESH_INTERVAL = int(os.getenv('ADS_MATCHING_REFRESH_INTERVAL', '5'))
+ADS_MATCHING_REBUILD_INTERVAL = int(os.getenv('ADS_MATCHING_REBUILD_INTERVAL', '600'))
+
+# Рекомендации для обмена (нужен numpy): каталог индекса, размер списка, период догрузки изменений
+# и полной перестройки, секунды
+ADS_RECOMMENDATIONS_DIR = os.getenv('ADS_RECOMMENDATIONS_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'bartersystem-recommendations'))
+ADS_RECOMMENDATIONS_LIMIT = int(os.getenv('ADS_RECOMMENDATIONS_LIMIT', '50'))
+ADS_RECOMMENDATIONS_REFRESH_INTERVAL = int(os.getenv('ADS_RECOMMENDATIONS_REFRESH_INTERVAL', '30'))
+ADS_RECOMMENDATIONS_REBUILD_INTERVAL = int(os.getenv('ADS_RECOMMENDATIONS_REBUILD_INTERVAL', '3600'))
+
+# Прокси изображений: каталог и предельный объём дискового кэша миниатюр; разрешить скачивание с адресов
+# локальной сети (только для разработки: иначе адрес проверяется и соединение закрепляется за ним)
+ADS_IMAGE_CACHE_DIR = os.getenv('ADS_IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'bartersystem-images'))
+ADS_IMAGE_CACHE_MAX_BYTES = int(os.getenv('ADS_IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+ADS_IMAGE_ALLOW_PRIVATE = os.getenv('ADS_IMAGE_ALLOW_PRIVATE', '0') == '1'
+
+# Фоновые задачи: выполнять сразу без воркера (по умолчанию при DEBUG), задержка первого повтора и потолок задержки, тайм-аут зависшей задачи и срок хранения выполненных, секунды
+ADS_TASKS_EAGER = os.getenv('ADS_TASKS_EAGER', '1' if DEBUG else '0') == '1'
+ADS_TASKS_RETRY_DELAY = int(os.getenv('ADS_TASKS_RETRY_DELAY', '5'))
+ADS_TASKS_RETRY_MAX_DELAY = int(os.getenv('ADS_TASKS_RETRY_MAX_DELAY', '3600'))
+ADS_TASKS_TIMEOUT = int(os.getenv('ADS_TASKS_TIMEOUT', '600'))
+ADS_TASKS_RETENTION = int(os.getenv('ADS_TASKS_RETENTION', str(24 * 3600)))
+
+# Архив предложений (manage.py archive_proposals): решённые предложения, не менявшиеся столько дней
+ADS_ARCHIVE_AFTER_DAYS = int(os.getenv('ADS_ARCHIVE_AFTER_DAYS', '180'))
+
+# Удаление объявлений: каскад до стольких предложений очищается в запросе, больший — фоновой задачей
+ADS_DELETE_SYNC_LIMIT = int(os.getenv('ADS_DELETE_SYNC_LIMIT', '1000'))
+
+# Ограничение частоты записи (ads/ratelimit.py): лимиты по имени маршрута на пользователя и на IP («число/период»,
+# период s, m, h, d), хранилище счётчиков (ads.ratelimit.MemoryStore — в памяти воркера, ads.ratelimit.CacheStore —
+# в общем кэше, по умолчанию при REDIS_URL), предел ключей в памяти, заголовок с адресом клиента за прокси и
+# число своих прокси перед приложением: адрес берётся на столько записей от правого края заголовка
+ADS_RATE_LIMITS = {
+    'exchange_create': {'user': '30/h', 'ip': '120/h'},
+    'api_proposals': {'user': '30/h', 'ip': '120/h'},
+    'ad_create': {'user': '20/h', 'ip': '60/h'},
+    'api_ads': {'user': '20/h', 'ip': '60/h'},
+}
+ADS_RATE_LIMIT_STORE = os.getenv(
+    'ADS_RATE_LIMIT_STORE', 'ads.ratelimit.CacheStore' if os.getenv('REDIS_URL') else 'ads.ratelimit.MemoryStore')
+ADS_RATE_LIMIT_MAX_KEYS = int(os.getenv('ADS_RATE_LIMIT_MAX_KEYS', '100000'))
+ADS_RATE_LIMIT_IP_HEADER = os.getenv('ADS_RATE_LIMIT_IP_HEADER', '')
+ADS_RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('ADS_RATE_LIMIT_TRUSTED_PROXIES', '1'))
+
+# Метрики запросов (/metrics/): токен для Prometheus (Authorization: Bearer ...), замер пиковой памяти через
+# tracemalloc (заметно замедляет), токен и каталог для профилирования по заголовку X-Profile
+ADS_METRICS_TOKEN = os.getenv('ADS_METRICS_TOKEN', '')
+ADS_METRICS_TRACE_MEMORY = os.getenv('ADS_METRICS_TRACE_MEMORY') == '1'
+ADS_PROFILE_TOKEN = os.getenv('ADS_PROFILE_TOKEN', '')
+ADS_PROFILE_DIR = os.getenv('ADS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'bartersystem-profiles'))
+
+# Уведомления о предложениях (SSE-поток под ASGI): брокер (ads.notifications.LocalBroker — в пределах процесса,
+# ads.notifications.RedisBroker — между воркерами), адрес потока, пинг и время жизни соединения, секунды,
+# и сколько событий копится для медленного клиента
+ADS_NOTIFICATIONS_BROKER = os.getenv('ADS_NOTIFICATIONS_BROKER', 'ads.notifications.LocalBroker')
+ADS_NOTIFICATIONS_REDIS_URL = os.getenv('ADS_NOTIFICATIONS_REDIS_URL', os.getenv('REDIS_URL', ''))
+ADS_EVENTS_PATH = '/events/'
+ADS_EVENTS_HEARTBEAT = int(os.getenv('ADS_EVENTS_HEARTBEAT', '15'))
+ADS_EVENTS_MAX_AGE = int(os.getenv('ADS_EVENTS_MAX_AGE', '3600'))
+ADS_EVENTS_QUEUE_SIZE = int(os.getenv('ADS_EVENTS_QUEUE_SIZE', '100'))
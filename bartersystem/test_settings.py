@@ -0,0 +1,17 @@
+"""Настройки для тестов без PostgreSQL: две базы SQLite изображают основную базу и реплику.
+
+Реплика — отдельная база, а не зеркало, поэтому тесты видят, откуда
+прочитаны данные. Запуск: ``python manage.py test ads --settings=bartersystem.test_settings``.
+"""
+from .settings import *  # noqa: F401,F403
+
+SECRET_KEY = SECRET_KEY or 'test'  # noqa: F405
+
+DATABASES = {
+    alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / f'{alias}.sqlite3'}  # noqa: F405
+    for alias in ('default', 'replica')
+}
+# Реплика включается только в тестах маршрутизации (override_settings): остальные тесты пишут и читают default
+ADS_DB_REPLICAS = []
+# Лимиты частоты включаются только в их тестах: остальные тесты создают объявления и предложения без счёта
+ADS_RATE_LIMITS = {}